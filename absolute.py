@@ -0,0 +1,287 @@
+######################## Absolute positions ##############################
+
+# The AG-UC8 can measure the absolute position of a stage (MA command, on a scale of 0 to 1000 of its travel range),
+# but only by scanning the whole range, which takes up to two minutes per axis, sweeping the stage across it. It cannot
+# be asked routinely. AbsolutePositionService measures a stage when asked to and then keeps that measurement:
+#  - the first measurement of a stage is explicit: Measure(stage), or every stage at start-up if
+#    AGILIS_MEASURE_AT_STARTUP is set. A stage that was never measured is left alone, since the scan moves it;
+#  - the last measurement of each stage is cached with its step counter at the time. The motion since then is tracked
+#    from the step counters the poller reads anyway (see poller.py), so no query is needed to know how far a stage is
+#    from where it was measured;
+#  - steps are not all the same size (they depend on the direction and the load), so the estimated drift of a stage
+#    grows with the steps it moved since it was measured (DRIFT_PER_STEP);
+#  - a stage that has a measurement is measured again once its drift exceeds the tolerance (AGILIS_DRIFT_TOLERANCE,
+#    in steps) and nothing has moved for IDLE_WINDOW seconds, or, if it moved at all, once nothing has moved for
+#    REFRESH_WINDOW seconds: it is idle anyway;
+#  - measurements run in the background, one stage at a time. The worker is only busy for the few commands that
+#    start one and poll for its end (in the poll lane, with backoff);
+#  - Cancel aborts the measurement in progress at once, with a stop in the stop lane that goes ahead of the motion
+#    commands queued after it: the GUI calls it before it moves anything. The scan of an aborted measurement may have
+#    moved the stage, so its cached position is no longer trusted until it is measured again.
+# Transports without the MA command (Newport's .NET library) get no measurements.
+
+import collections
+import os
+import threading
+import time
+
+import motion
+from motion_worker import LANE_STOP, LANE_POLL
+
+DRIFT_TOLERANCE = float(os.environ.get("AGILIS_DRIFT_TOLERANCE",100.0)) # steps
+MEASURE_AT_STARTUP = os.environ.get("AGILIS_MEASURE_AT_STARTUP","") not in ("","0") # measure every stage at start-up
+DRIFT_PER_STEP = 0.05    # drift (steps) per step moved since the last measurement
+IDLE_WINDOW = 10.0       # seconds without motion before a stage beyond the tolerance is measured
+REFRESH_WINDOW = 60.0    # seconds without motion before a stage that moved at all is measured
+RETRY_INTERVAL = 60.0    # seconds before a measurement that failed is tried again
+SERVICE_INTERVAL = 0.25  # seconds between two checks of what is due
+MEASURE_POLL_MIN = 0.1   # seconds between the first polls of a measurement in progress
+MEASURE_POLL_MAX = 2.0   # the longest interval the polls back off to
+MEASURE_TIMEOUT = 300.0  # seconds after which a measurement that never ended is aborted
+
+# value: position from 0 to 1000 of the travel range. steps: step counter of the stage when it was measured.
+# time: time.time() of the measurement.
+Measurement = collections.namedtuple("Measurement",("value","steps","time"))
+
+# <summary>
+# Runs on the motion worker: starts the position measurement of the stage, unless fnCancelled() returns True or
+# another stage is moving. Returns True if it was started, None if the stage turned out to be moving (e.g. a step
+# move of a script, which fnMoving does not know about), False if it failed.
+# </summary>
+def Start_Measurement(oCmdLib,stage_map,stage,fnMoving,fnCancelled):
+    if fnCancelled() or any(moving != stage for moving in fnMoving()):
+        return None
+    (nChannel,nAxis) = stage_map[stage]
+    if not oCmdLib.SetChannel(nChannel):
+        return False
+    (bStatus,nStatus) = oCmdLib.GetAxisStatus(nAxis)
+    if not bStatus:
+        return False
+    if nStatus != 0:
+        return None
+    return oCmdLib.StartMeasurePosition(nAxis)
+
+# <summary>
+# Runs on the motion worker: returns (bStatus, position or None while it runs, step counter) of the measurement of the
+# stage. bStatus is False if the measurement is over without a position: another channel was selected since (which
+# aborts it), or the controller has none.
+# </summary>
+def Read_Measurement(oCmdLib,stage_map,stage):
+    (nChannel,nAxis) = stage_map[stage]
+    if getattr(oCmdLib,"nChannel",nChannel) != nChannel:
+        return (False,None,0)
+    (bStatus,nValue) = oCmdLib.GetMeasuredPosition(nAxis)
+    if not bStatus or nValue is None:
+        return (bStatus,None,0)
+    (bStatus,nSteps) = oCmdLib.GetStepCount(nAxis)
+    return (bStatus,nValue,nSteps)
+
+# <summary>
+# Runs on the motion worker: aborts the measurement of the stage. If another channel has been selected since, the
+# measurement was aborted by that already, and selecting its channel again would stop the stages moving now.
+# </summary>
+def Abort_Measurement(oCmdLib,stage_map,stage):
+    (nChannel,nAxis) = stage_map[stage]
+    if getattr(oCmdLib,"nChannel",nChannel) != nChannel:
+        return True
+    return oCmdLib.StopMotion(nAxis)
+
+class AbsolutePositionService:
+    # <summary>
+    # worker: the MotionWorker that owns the controller. fnMoving returns the stages that are (or are about to be)
+    # moving; the stage being measured may be among them. fnCounters returns the step counters known, as a
+    # PositionPoller snapshot (stage -> (steps, time of the read)). fnCmdLib and stage_map: see stepmove.StepMover.
+    # fTolerance: drift (steps) beyond which a stage is measured again. bMeasureAll: measure every stage once nothing
+    # moves, as if Measure had been called for each.
+    # </summary>
+    def __init__(self,worker,fnMoving,fnCounters,fnCmdLib=None,stage_map=None,fTolerance=DRIFT_TOLERANCE,
+                 fIdleWindow=IDLE_WINDOW,fRefreshWindow=REFRESH_WINDOW,fInterval=SERVICE_INTERVAL,
+                 bMeasureAll=MEASURE_AT_STARTUP):
+        self.worker = worker
+        self.fnMoving = fnMoving
+        self.fnCounters = fnCounters
+        self.fnCmdLib = (lambda:motion.oCmdLib) if fnCmdLib is None else fnCmdLib
+        self.stage_map = motion.stage_map if stage_map is None else stage_map
+        self.fTolerance = fTolerance
+        self.fIdleWindow = fIdleWindow
+        self.fRefreshWindow = fRefreshWindow
+        self.fInterval = fInterval
+        self.measurements = dict() # maps stages to their last Measurement
+        self.counters = dict()     # maps stages to their last step counter seen
+        self.travel = dict()       # maps stages to the steps they moved since their measurement
+        self.failed = dict()       # maps stages to the time.monotonic() their last measurement failed
+        self.requested = set(self.stage_map) if bMeasureAll else set() # stages to measure whatever their drift
+        self.measuring = None      # the stage being measured
+        self.tLastMotion = time.monotonic()
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        # statistics
+        self.nMeasurements = 0
+        self.nCancelled = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run,name="absolute-positions",daemon=True)
+        self.thread.start()
+
+    # <summary>
+    # Returns (measured position from 0 to 1000, steps moved since, estimated drift in steps) of the stage, or
+    # (None, None, None) if it was never measured. The drift is infinite after an aborted measurement.
+    # </summary>
+    def Position(self,stage):
+        with self.lock:
+            measurement = self.measurements.get(stage)
+            if measurement is None:
+                return (None,None,None)
+            return (measurement.value,self.counters.get(stage,measurement.steps) - measurement.steps,
+                    self._drift(stage))
+
+    # <summary>
+    # Has the stage measured once nothing has moved for the idle window, whatever its drift: the first measurement of
+    # a stage is only made when asked for.
+    # </summary>
+    def Measure(self,stage):
+        with self.lock:
+            self.requested.add(stage)
+
+    # <summary>
+    # Returns the last measurement of every stage measured, as a dict mapping stages to Measurements.
+    # </summary>
+    def Measurements(self):
+        with self.lock:
+            return dict(self.measurements)
+
+    def _drift(self,stage):
+        if stage not in self.measurements:
+            return float("inf")
+        return DRIFT_PER_STEP*self.travel.get(stage,0)
+
+    # <summary>
+    # Returns the stages being measured (a list of at most one).
+    # </summary>
+    def Measuring(self):
+        stage = self.measuring
+        return [] if stage is None else [stage]
+
+    # <summary>
+    # Aborts the measurement in progress, if any, without waiting. Returns True if there was one.
+    # </summary>
+    def Cancel(self):
+        with self.lock:
+            stage = self.measuring
+            if stage is None or self.cancelled.is_set():
+                return False
+            self.cancelled.set()
+            self.tLastMotion = time.monotonic()
+        self.worker.Submit(Abort_Measurement,self.fnCmdLib(),self.stage_map,stage,lane=LANE_STOP)
+        return True
+
+    # <summary>
+    # Adds the motion shown by the step counters read since the last call to the travel of the stages.
+    # </summary>
+    def _track(self):
+        with self.lock:
+            for (stage,(nSteps,tRead)) in self.fnCounters().items():
+                nPrevious = self.counters.get(stage)
+                if nPrevious is not None:
+                    self.travel[stage] = self.travel.get(stage,0) + abs(nSteps - nPrevious)
+                self.counters[stage] = nSteps
+
+    # <summary>
+    # Returns the stage to measure now, or None. Stages asked for and stages beyond the tolerance go first, then those
+    # on the selected channel. Stages that were never measured are only measured when asked for.
+    # </summary>
+    def _due(self,tNow):
+        if any(self.fnMoving()):
+            self.tLastMotion = tNow
+            return None
+        oCmdLib = self.fnCmdLib()
+        if oCmdLib is None or not hasattr(oCmdLib,"GetMeasuredPosition"):
+            return None
+        fIdle = tNow - self.tLastMotion
+        nSelected = getattr(oCmdLib,"nChannel",None)
+        lodue = []
+        with self.lock:
+            for stage in self.stage_map:
+                if tNow - self.failed.get(stage,-RETRY_INTERVAL) < RETRY_INTERVAL:
+                    continue
+                if stage not in self.requested and stage not in self.measurements:
+                    continue
+                bBeyond = stage in self.requested or self._drift(stage) > self.fTolerance
+                if (bBeyond and fIdle >= self.fIdleWindow) or (self.travel.get(stage,0) and fIdle >= self.fRefreshWindow):
+                    lodue.append((not bBeyond,self.stage_map[stage][0] != nSelected,self.stage_map[stage],stage))
+        return min(lodue)[-1] if lodue else None
+
+    # <summary>
+    # Measures the stage: starts the measurement, then polls for its end with backoff until it is over, cancelled
+    # (by Cancel, or because another stage started moving) or timed out.
+    # </summary>
+    def _measure(self,stage):
+        with self.lock:
+            self.measuring = stage
+            self.cancelled.clear()
+        oCmdLib = self.fnCmdLib()
+        try:
+            future = self.worker.Submit(Start_Measurement,oCmdLib,self.stage_map,stage,self.fnMoving,
+                                        self.cancelled.is_set,lane=LANE_POLL,axes=[stage])
+            try:
+                bStarted = future.result()
+            except BaseException: # cancelled or stale
+                bStarted = False
+            if bStarted is None:
+                self.tLastMotion = time.monotonic()
+                return
+            if not bStarted:
+                self.failed[stage] = time.monotonic()
+                return
+
+            tStart = time.monotonic()
+            fPoll = MEASURE_POLL_MIN
+            while not self.cancelled.wait(fPoll):
+                if self.stop.is_set() or any(moving != stage for moving in self.fnMoving()) or \
+                   time.monotonic() - tStart > MEASURE_TIMEOUT:
+                    self.Cancel()
+                    break
+                fPoll = min(2*fPoll,MEASURE_POLL_MAX)
+                future = self.worker.Submit(Read_Measurement,oCmdLib,self.stage_map,stage,lane=LANE_POLL,
+                                            axes=[stage])
+                try:
+                    (bStatus,nValue,nSteps) = future.result()
+                except BaseException: # try again at the next poll
+                    continue
+                if not bStatus:
+                    break
+                if nValue is not None:
+                    with self.lock:
+                        self.measurements[stage] = Measurement(nValue,nSteps,time.time())
+                        self.counters[stage] = nSteps
+                        self.travel[stage] = 0
+                        self.failed.pop(stage,None)
+                        self.requested.discard(stage)
+                    self.nMeasurements += 1
+                    return
+
+            # Aborted: the scan may have moved the stage anywhere in its range
+            with self.lock:
+                if self.cancelled.is_set():
+                    self.nCancelled += 1
+                else:
+                    self.failed[stage] = time.monotonic()
+                if stage in self.measurements:
+                    self.travel[stage] = float("inf")
+        finally:
+            with self.lock:
+                self.measuring = None
+
+    def _run(self):
+        while not self.stop.wait(self.fInterval):
+            self._track()
+            stage = self._due(time.monotonic())
+            if stage is not None:
+                self._measure(stage)
+
+    # <summary>
+    # Stops the service, aborting the measurement in progress.
+    # </summary>
+    def Shutdown(self):
+        self.stop.set()
+        self.Cancel()
+        self.thread.join()
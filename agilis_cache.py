@@ -0,0 +1,192 @@
+######################## Channel and jog-state cache ##############################
+
+# Start_Motion, Stop_Motion and the stop helpers select the channel before every command, even though the controller
+# is almost always on that channel already (x and y share channel 1). CachedCmdLib wraps a CmdLibAgilis object and
+# remembers which channel is selected and which jog speed was last sent to each (channel, axis), so commands that are
+# provably no-ops are not sent over the serial link at all.
+#
+# Step amplitudes (SU) are configuration rather than motion: they only change when we set them, so they are cached
+# per (channel, axis, direction), and reading one that is known costs no serial transaction at all. They are set and
+# read with the serial transport's signed SU convention; over the .NET library, the adapter underneath (see
+# agilis_dotnet.py) sends them to the DLL's Positive / Negative methods.
+#
+# Stop commands are never skipped: an axis can stop (or be moved) without us knowing, and a stop is what we rely on
+# when something goes wrong. On any error or exception, and whenever the device is (re)opened or closed, the cache is
+# forgotten and the next commands go to the controller again.
+
+class CachedCmdLib:
+    def __init__(self,oCmdLib):
+        self.oCmdLib = oCmdLib
+        self.nChannel = None     # currently selected channel, None when unknown
+        self.jog_speeds = dict() # maps (channel, axis) to the jog speed last sent to it (0 = stopped)
+        self.amplitudes = dict() # maps (channel, axis, positive direction?) to its step amplitude (signed, like SU)
+        # counters: maps each command to [number sent to the controller, number skipped by the cache]
+        self.counters = dict()
+        self.nInvalidations = 0
+
+    # Any method the cache does not know about goes straight to the wrapped CmdLibAgilis object.
+    def __getattr__(self,strName):
+        return getattr(self.oCmdLib,strName)
+
+    # <summary>
+    # Forgets everything the cache knows about the controller state.
+    # </summary>
+    def Invalidate(self):
+        self.nChannel = None
+        self.jog_speeds.clear()
+        self.amplitudes.clear()
+        self.nInvalidations += 1
+
+    def _count(self,strCommand,bSent):
+        counter = self.counters.setdefault(strCommand,[0,0])
+        counter[0 if bSent else 1] += 1
+
+    # <summary>
+    # Sends a command to the wrapped object. The cache is invalidated if the command raises, or if bOk(result) is
+    # False, because we can then no longer be sure what state the controller is in.
+    # </summary>
+    def _send(self,strCommand,bOk,*args):
+        self._count(strCommand,True)
+        try:
+            result = getattr(self.oCmdLib,strCommand)(*args)
+        except:
+            self.Invalidate()
+            raise
+        if not bOk(result):
+            self.Invalidate()
+        return result
+
+    def Open(self,strDeviceKey):
+        self.Invalidate()
+        return self._send("Open",lambda nResult:nResult == 0,strDeviceKey)
+
+    def Close(self):
+        self.Invalidate()
+        return self._send("Close",lambda result:True)
+
+    def SetRemoteMode(self):
+        return self._send("SetRemoteMode",bool)
+
+    # <summary>
+    # Selects the channel, unless it is already selected. Selecting another channel stops the axes of the previous
+    # one on the controller, so their cached jog speeds are reset.
+    # </summary>
+    def SetChannel(self,nChannel):
+        if nChannel == self.nChannel:
+            self._count("SetChannel",False)
+            return True
+
+        nPrevious = self.nChannel
+        bStatus = self._send("SetChannel",bool,nChannel)
+        if bStatus:
+            for (nChan,nAxis) in self.jog_speeds:
+                if nChan == nPrevious:
+                    self.jog_speeds[(nChan,nAxis)] = 0
+            self.nChannel = nChannel
+        return bStatus
+
+    # <summary>
+    # Starts jogging the axis on the current channel, unless it is already known to be jogging at that speed.
+    # </summary>
+    def StartJogging(self,nAxis,nJogSpeed):
+        key = (self.nChannel,nAxis)
+        if self.nChannel is not None and nJogSpeed != 0 and self.jog_speeds.get(key) == nJogSpeed:
+            self._count("StartJogging",False)
+            return True
+
+        bStatus = self._send("StartJogging",bool,nAxis,nJogSpeed)
+        if bStatus and self.nChannel is not None:
+            self.jog_speeds[key] = nJogSpeed
+        return bStatus
+
+    # <summary>
+    # Starts a relative move of the axis on the current channel. Always sent; the axis is no longer jogging afterwards.
+    # </summary>
+    def RelativeMove(self,nAxis,nSteps):
+        bStatus = self._send("RelativeMove",bool,nAxis,nSteps)
+        if bStatus and self.nChannel is not None:
+            self.jog_speeds[(self.nChannel,nAxis)] = 0
+        return bStatus
+
+    # <summary>
+    # Starts an absolute move of the axis on the current channel. Always sent; the axis is no longer jogging
+    # afterwards.
+    # </summary>
+    def AbsoluteMove(self,nAxis,nTarget):
+        bStatus = self._send("AbsoluteMove",bool,nAxis,nTarget)
+        if bStatus and self.nChannel is not None:
+            self.jog_speeds[(self.nChannel,nAxis)] = 0
+        return bStatus
+
+    # <summary>
+    # Starts an absolute position measurement of the axis on the current channel. Always sent; the axis is no longer
+    # jogging afterwards.
+    # </summary>
+    def StartMeasurePosition(self,nAxis):
+        bStatus = self._send("StartMeasurePosition",bool,nAxis)
+        if bStatus and self.nChannel is not None:
+            self.jog_speeds[(self.nChannel,nAxis)] = 0
+        return bStatus
+
+    # <summary>
+    # Sets the step amplitude of the axis on the current channel (see agilis_serial.py), unless it is known to be set
+    # to that value already.
+    # </summary>
+    def SetStepAmplitude(self,nAxis,nAmplitude):
+        key = (self.nChannel,nAxis,nAmplitude > 0)
+        if self.nChannel is not None and self.amplitudes.get(key) == nAmplitude:
+            self._count("SetStepAmplitude",False)
+            return True
+
+        bStatus = self._send("SetStepAmplitude",bool,nAxis,nAmplitude)
+        if bStatus and self.nChannel is not None:
+            self.amplitudes[key] = nAmplitude
+        return bStatus
+
+    # <summary>
+    # Returns (status, step amplitude) of the axis on the current channel in the direction, from the cache if known.
+    # </summary>
+    def GetStepAmplitude(self,nAxis,bPositive):
+        key = (self.nChannel,nAxis,bool(bPositive))
+        if self.nChannel is not None and key in self.amplitudes:
+            self._count("GetStepAmplitude",False)
+            return (True,self.amplitudes[key])
+
+        result = self._send("GetStepAmplitude",lambda result:result[0],nAxis,bPositive)
+        if result[0] and self.nChannel is not None:
+            self.amplitudes[key] = result[1]
+        return result
+
+    # <summary>
+    # Returns the cached step amplitude of (channel, axis) in the direction, or None if it is not known. Sends nothing,
+    # so it does not need the channel to be selected.
+    # </summary>
+    def Cached_Step_Amplitude(self,nChannel,nAxis,bPositive):
+        return self.amplitudes.get((nChannel,nAxis,bool(bPositive)))
+
+    # <summary>
+    # Stops the axis on the current channel. Always sent, see the top of this file.
+    # </summary>
+    def StopMotion(self,nAxis):
+        bStatus = self._send("StopMotion",bool,nAxis)
+        if bStatus and self.nChannel is not None:
+            self.jog_speeds[(self.nChannel,nAxis)] = 0
+        return bStatus
+
+    # <summary>
+    # Returns (number of commands sent, number of serial transactions saved by the cache).
+    # </summary>
+    def Totals(self):
+        return (sum(counter[0] for counter in self.counters.values()),
+                sum(counter[1] for counter in self.counters.values()))
+
+    # <summary>
+    # Returns a human-readable summary of the counters, one line per command.
+    # </summary>
+    def Report(self):
+        lolines = ["{:<14} sent = {:<6} saved = {}".format(strCommand,counter[0],counter[1])
+                   for (strCommand,counter) in sorted(self.counters.items())]
+        (nSent,nSaved) = self.Totals()
+        lolines.append("Total serial transactions: sent = {}, saved = {} ({} cache invalidations)".format(
+                       nSent,nSaved,self.nInvalidations))
+        return "\n".join(lolines)
@@ -0,0 +1,82 @@
+######################## .NET controller library adapter ##############################
+
+# Newport's CmdLibAgilis (CmdLibAgilis.dll) and the pure-Python serial transport (agilis_serial.py) share the motion
+# commands (SetChannel, StartJogging, StopMotion, RelativeMove, AbsoluteMove, ...), but the DLL names its queries and
+# the step amplitude commands differently. DotNetCmdLib wraps a CmdLibAgilis object and gives it the serial
+# transport's names, so the rest of the program has one API whichever transport it talks to:
+#  - GetStepCount (TP) is GetStepsAccumulated;
+#  - GetStepAmplitude / SetStepAmplitude (SU) take the direction from the sign, like the SU command, and call
+#    Get/SetStepAmplitudePositive or Get/SetStepAmplitudeNegative, which take the amplitude without a sign (1 to 50).
+#    The negative direction's amplitude is returned negative, like SU-?;
+#  - GetErrorCode (TE) is GetErrorPreviousCommand, GetVersion (VE) is GetFirmwareVersion.
+# The DLL's queries return their value through an out parameter: pythonnet returns (status, value), and a placeholder
+# is passed for it, as in the GetJogMode call kept in motion.py.
+#
+# The DLL's MeasurePosition (MA) only returns once the scan of the travel range is over, up to minutes later, and the
+# motion worker would be blocked all that time. It is not adapted: absolute position measurements (see absolute.py)
+# need the serial transport.
+
+# <summary>
+# Returns oCmdLib with the serial transport's method names: a DotNetCmdLib if it is a CmdLibAgilis object, oCmdLib
+# itself otherwise.
+# </summary>
+def Adapt_CmdLib(oCmdLib):
+    if hasattr(oCmdLib,"GetStepsAccumulated") and not hasattr(oCmdLib,"GetStepCount"):
+        return DotNetCmdLib(oCmdLib)
+    return oCmdLib
+
+class DotNetCmdLib:
+    def __init__(self,oCmdLib):
+        self.oCmdLib = oCmdLib
+
+    # Any other method goes straight to the wrapped CmdLibAgilis object.
+    def __getattr__(self,strName):
+        return getattr(self.oCmdLib,strName)
+
+    # <summary>
+    # Returns (status, step counter) of the axis on the current channel.
+    # </summary>
+    def GetStepCount(self,nAxis):
+        return self.oCmdLib.GetStepsAccumulated(nAxis,0)
+
+    # <summary>
+    # Returns (status, state) of the axis on the current channel: 0 = ready, 1 = stepping, 2 = jogging, 3 = moving to
+    # a limit or measuring its position.
+    # </summary>
+    def GetAxisStatus(self,nAxis):
+        return self.oCmdLib.GetAxisStatus(nAxis,0)
+
+    # <summary>
+    # Sets the step amplitude of the axis on the current channel: a positive nAmplitude sets the amplitude of the
+    # positive direction, a negative one that of the negative direction.
+    # </summary>
+    def SetStepAmplitude(self,nAxis,nAmplitude):
+        if nAmplitude > 0:
+            return self.oCmdLib.SetStepAmplitudePositive(nAxis,nAmplitude)
+        if nAmplitude < 0:
+            return self.oCmdLib.SetStepAmplitudeNegative(nAxis,-nAmplitude)
+        return False
+
+    # <summary>
+    # Returns (status, step amplitude) of the axis on the current channel in the direction: positive for the positive
+    # direction, negative for the negative one.
+    # </summary>
+    def GetStepAmplitude(self,nAxis,bPositive):
+        if bPositive:
+            (bStatus,nAmplitude) = self.oCmdLib.GetStepAmplitudePositive(nAxis,0)
+            return (bStatus,abs(nAmplitude))
+        (bStatus,nAmplitude) = self.oCmdLib.GetStepAmplitudeNegative(nAxis,0)
+        return (bStatus,-abs(nAmplitude))
+
+    # <summary>
+    # Returns (status, error code of the last command).
+    # </summary>
+    def GetErrorCode(self):
+        return self.oCmdLib.GetErrorPreviousCommand(0)
+
+    # <summary>
+    # Returns (status, firmware version), e.g. "AG-UC8 v2.2.1".
+    # </summary>
+    def GetVersion(self):
+        (bStatus,strVersion) = self.oCmdLib.GetFirmwareVersion("")
+        return (bStatus,str(strVersion or ""))
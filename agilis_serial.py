@@ -0,0 +1,399 @@
+######################## Pure-Python AG-UC8 serial transport ##############################
+
+# A drop-in replacement for Newport's .NET VCPIOLib/CmdLibAgilis pair, talking the AG-UC8 ASCII protocol directly on
+# the controller's (virtual) serial port. It does not need pythonnet or the DLLs, so it also runs on Linux.
+#
+# SerialDeviceIO stands in for VCPIOLib (device discovery), and AgilisSerial for CmdLibAgilis: the methods have the
+# same names and return the same kind of values (Open returns 0 on success, the other commands return True/False,
+# and queries return a (status, value) tuple like pythonnet does for out parameters).
+#
+# The AG-UC8 does not answer set commands (only queries), so a command "succeeds" once it has been written. Use
+# GetErrorCode (TE) to have a command checked by the controller: PacedCmdLib does so after the commands that start
+# motion or change a setting (see pacing.py).
+# The one exception is the position measurement (MA), which is answered when the scan is over, minutes later: that
+# answer is picked up by GetMeasuredPosition, or set aside by the queries sent in the meantime. The answer only names
+# the axis, so the measurements are kept per (channel, axis) of the channel selected when they were started, and
+# selecting another channel drops those that are still running: switching channel aborts them.
+#
+# pyserial is only needed where POSIX termios is not available (i.e. on Windows).
+
+import glob
+import os
+import select
+import time
+
+from aguc8 import MAX_RELATIVE_STEPS, MAX_STEP_AMPLITUDE, MEASURE_RANGE
+
+try:
+    import termios
+    import tty
+except ImportError:
+    termios = None
+
+try:
+    import serial
+    import serial.tools.list_ports
+except ImportError:
+    serial = None
+
+BAUD_RATE = 921600
+TERMINATOR = b"\r\n"
+
+# Serial devices the controller may show up as, per platform (pyserial's port list is used on Windows).
+DEVICE_PATTERNS = ["/dev/serial/by-id/*Agilis*", "/dev/serial/by-id/*Newport*", "/dev/ttyUSB*", "/dev/ttyACM*",
+                   "/dev/cu.usbserial*"]
+
+# Absolute positions (MA and PA commands) are given from 0 to ABSOLUTE_RANGE of the travel range.
+ABSOLUTE_RANGE = MEASURE_RANGE
+
+# AG-UC8 error codes returned by TE
+ERROR_CODES = dict({0:"No error", -1:"Unknown command", -2:"Axis out of range", -3:"Wrong format for parameter",
+                    -4:"Parameter out of range", -5:"Not allowed in local mode", -6:"Not allowed in current state"})
+
+# Every command app.py sends is encoded once, here, rather than formatted on every call.
+CMD_REMOTE  = b"MR" + TERMINATOR
+CMD_LOCAL   = b"ML" + TERMINATOR
+CMD_ERROR   = b"TE" + TERMINATOR
+CMD_VERSION = b"VE" + TERMINATOR
+CMD_CHANNEL = dict((nChannel,b"CC%d" % nChannel + TERMINATOR) for nChannel in range(1,5))
+CMD_JOG     = dict(((nAxis,nSpeed),b"%dJA%d" % (nAxis,nSpeed) + TERMINATOR) for nAxis in (1,2) for nSpeed in range(-4,5))
+CMD_STOP    = dict((nAxis,b"%dST" % nAxis + TERMINATOR) for nAxis in (1,2))
+CMD_STEPS   = dict((nAxis,b"%dTP" % nAxis + TERMINATOR) for nAxis in (1,2))
+CMD_STATUS  = dict((nAxis,b"%dTS" % nAxis + TERMINATOR) for nAxis in (1,2))
+CMD_MEASURE = dict((nAxis,b"%dMA" % nAxis + TERMINATOR) for nAxis in (1,2))
+CMD_ABSOLUTE = dict(((nAxis,nTarget),b"%dPA%d" % (nAxis,nTarget) + TERMINATOR) for nAxis in (1,2)
+                    for nTarget in range(ABSOLUTE_RANGE+1))
+CMD_AMPLITUDE = dict(((nAxis,nAmplitude),b"%dSU%+d" % (nAxis,nAmplitude) + TERMINATOR) for nAxis in (1,2)
+                     for nAmplitude in range(-MAX_STEP_AMPLITUDE,MAX_STEP_AMPLITUDE+1) if nAmplitude != 0)
+CMD_AMPLITUDE_QUERY = dict(((nAxis,bPositive),b"%dSU%s?" % (nAxis,b"+" if bPositive else b"-") + TERMINATOR)
+                           for nAxis in (1,2) for bPositive in (True,False))
+
+########################### Serial ports ########################################
+
+# <summary>
+# A serial port opened with POSIX termios. Works for USB serial adapters as well as pseudo-terminals.
+# </summary>
+class _PosixPort:
+    def __init__(self,strPath,nBaudRate):
+        self.fd = os.open(strPath,os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        try:
+            tty.setraw(self.fd)
+            attributes = termios.tcgetattr(self.fd)
+            nSpeed = getattr(termios,"B%d" % nBaudRate,None)
+            if nSpeed is not None:
+                attributes[4] = attributes[5] = nSpeed
+            attributes[2] |= termios.CLOCAL | termios.CREAD
+            termios.tcsetattr(self.fd,termios.TCSANOW,attributes)
+        except:
+            os.close(self.fd)
+            raise
+        self.buffer = b""
+
+    def write(self,bData):
+        while bData:
+            select.select([],[self.fd],[],1.0)
+            bData = bData[os.write(self.fd,bData):]
+
+    # <summary>
+    # Returns the next line (without terminator), or None if none arrived within fTimeout seconds (0: only the lines
+    # already received).
+    # </summary>
+    def read_line(self,fTimeout):
+        tDeadline = time.monotonic() + fTimeout
+        while TERMINATOR not in self.buffer:
+            fRemaining = max(tDeadline - time.monotonic(),0.0)
+            if not select.select([self.fd],[],[],fRemaining)[0]:
+                return None
+            self.buffer += os.read(self.fd,256)
+        (bLine,self.buffer) = self.buffer.split(TERMINATOR,1)
+        return bLine
+
+    def flush_input(self):
+        self.buffer = b""
+        termios.tcflush(self.fd,termios.TCIFLUSH)
+
+    def close(self):
+        os.close(self.fd)
+
+# <summary>
+# A serial port opened with pyserial, used where termios is not available.
+# </summary>
+class _PySerialPort:
+    def __init__(self,strPath,nBaudRate):
+        self.port = serial.Serial(strPath,nBaudRate,timeout=0)
+
+    def write(self,bData):
+        self.port.write(bData)
+
+    def read_line(self,fTimeout):
+        self.port.timeout = fTimeout
+        bLine = self.port.read_until(TERMINATOR)
+        if not bLine.endswith(TERMINATOR):
+            return None
+        return bLine[:-len(TERMINATOR)]
+
+    def flush_input(self):
+        self.port.reset_input_buffer()
+
+    def close(self):
+        self.port.close()
+
+def Open_Port(strPath,nBaudRate=BAUD_RATE):
+    if termios is not None:
+        return _PosixPort(strPath,nBaudRate)
+    if serial is not None:
+        return _PySerialPort(strPath,nBaudRate)
+    raise RuntimeError("Opening a serial port needs termios or pyserial.")
+
+########################### Device discovery ####################################
+
+class SerialDeviceIO:
+    # <summary>
+    # Stands in for VCPIOLib. bLogging: print the device keys that were discovered.
+    # </summary>
+    def __init__(self,bLogging=False,lopatterns=None):
+        self.bLogging = bLogging
+        self.lopatterns = DEVICE_PATTERNS if lopatterns is None else lopatterns
+        self.strDeviceKeyList = []
+
+    # <summary>
+    # Discovers the serial devices the controller may be connected to. Returns the number of devices found.
+    # </summary>
+    def DiscoverDevices(self):
+        lokeys = []
+        if serial is not None and termios is None:
+            lokeys = [port.device for port in serial.tools.list_ports.comports()]
+        else:
+            for strPattern in self.lopatterns:
+                for strPath in sorted(glob.glob(strPattern)):
+                    strPath = os.path.realpath(strPath)
+                    if strPath not in lokeys:
+                        lokeys.append(strPath)
+        self.strDeviceKeyList = lokeys
+        if self.bLogging:
+            print("Discovered devices: {}".format(", ".join(lokeys) or "none"))
+        return len(lokeys)
+
+    def GetDeviceKeys(self):
+        return list(self.strDeviceKeyList)
+
+    def Shutdown(self):
+        self.strDeviceKeyList = []
+
+########################### Commands ############################################
+
+class AgilisSerial:
+    # Every object opens its own port, so devices can be probed concurrently (see discovery.Concurrent_Probes).
+    bConcurrentProbes = True
+
+    # <summary>
+    # Stands in for CmdLibAgilis. oDeviceIO is accepted for symmetry with CmdLibAgilis (oDeviceIO) and not used.
+    # fTimeout: how long (seconds) to wait for the answer to a query.
+    # </summary>
+    def __init__(self,oDeviceIO=None,fTimeout=0.1,nBaudRate=BAUD_RATE):
+        self.fTimeout = fTimeout
+        self.nBaudRate = nBaudRate
+        self.port = None
+        self.nChannel = None   # the channel last selected, None until one is
+        self.measured = dict() # maps (channel, axis) to the answer of its position measurement, None until it arrives
+
+    # <summary>
+    # Opens the serial device. Returns 0 if the device was opened, -1 otherwise.
+    # </summary>
+    def Open(self,strDeviceKey):
+        self.Close()
+        try:
+            self.port = Open_Port(strDeviceKey,self.nBaudRate)
+        except (OSError,RuntimeError) as e:
+            print("Could not open {}: {}".format(strDeviceKey,e))
+            return -1
+        return 0
+
+    def Close(self):
+        if self.port is not None:
+            self.port.close()
+            self.port = None
+        self.nChannel = None
+        self.measured.clear()
+
+    def _send(self,bCommand):
+        if self.port is None or bCommand is None:
+            return False
+        try:
+            self.port.write(bCommand)
+        except OSError:
+            return False
+        return True
+
+    # <summary>
+    # Sends a query and returns (True, answer without the echoed prefix), or (False, "") on timeout or error.
+    # </summary>
+    def _query(self,bCommand,bPrefix):
+        if self.port is None:
+            return (False,"")
+        try:
+            if None in self.measured.values():
+                self._collect_measurements()
+            self.port.flush_input()
+            self.port.write(bCommand)
+            bLine = self.port.read_line(self.fTimeout)
+            while bLine is not None and self._measurement_answer(bLine):
+                bLine = self.port.read_line(self.fTimeout)
+        except OSError:
+            return (False,"")
+        if bLine is None or not bLine.startswith(bPrefix):
+            return (False,"")
+        return (True,bLine[len(bPrefix):].decode("ascii","replace").strip())
+
+    def SetRemoteMode(self):
+        return self._send(CMD_REMOTE)
+
+    def SetLocalMode(self):
+        return self._send(CMD_LOCAL)
+
+    # <summary>
+    # Selects the channel (CC). The answers of the measurements already received are kept first: once another channel
+    # is selected, an answer could not be told from one of the new channel's.
+    # </summary>
+    def SetChannel(self,nChannel):
+        if nChannel != self.nChannel and None in self.measured.values() and self.port is not None:
+            try:
+                self._collect_measurements()
+            except OSError:
+                pass
+        if not self._send(CMD_CHANNEL.get(nChannel)):
+            return False
+        if nChannel != self.nChannel:
+            self.measured = dict((key,nValue) for (key,nValue) in self.measured.items()
+                                 if key[0] == nChannel or nValue is not None)
+            self.nChannel = nChannel
+        return True
+
+    def StartJogging(self,nAxis,nJogSpeed):
+        return self._send(CMD_JOG.get((nAxis,nJogSpeed)))
+
+    # <summary>
+    # Starts a relative move of nSteps on the axis of the current channel (PR). The step count is not known in
+    # advance, so this command is formatted on every call.
+    # </summary>
+    def RelativeMove(self,nAxis,nSteps):
+        if nAxis not in (1,2) or abs(nSteps) > MAX_RELATIVE_STEPS:
+            return False
+        return self._send(b"%dPR%d" % (nAxis,nSteps) + TERMINATOR)
+
+    # <summary>
+    # Moves the axis on the current channel to nTarget, from 0 to ABSOLUTE_RANGE of the travel range (PA). Like a
+    # position measurement, this takes a scan of the travel range first.
+    # </summary>
+    def AbsoluteMove(self,nAxis,nTarget):
+        return self._send(CMD_ABSOLUTE.get((nAxis,nTarget)))
+
+    # <summary>
+    # Sets the step amplitude of the axis on the current channel (SU): a positive nAmplitude sets the amplitude of the
+    # positive direction, a negative one that of the negative direction (1 to MAX_STEP_AMPLITUDE).
+    # </summary>
+    def SetStepAmplitude(self,nAxis,nAmplitude):
+        return self._send(CMD_AMPLITUDE.get((nAxis,nAmplitude)))
+
+    # <summary>
+    # Stops the axis on the current channel (ST). This also aborts its position measurement, which is then never
+    # answered.
+    # </summary>
+    def StopMotion(self,nAxis):
+        if self.measured.get((self.nChannel,nAxis),0) is None:
+            del self.measured[(self.nChannel,nAxis)]
+        return self._send(CMD_STOP.get(nAxis))
+
+    # <summary>
+    # Starts an absolute position measurement of the axis on the current channel (MA). The controller scans the whole
+    # travel range and answers when it is done; GetMeasuredPosition returns the answer.
+    # </summary>
+    def StartMeasurePosition(self,nAxis):
+        if not self._send(CMD_MEASURE.get(nAxis)):
+            return False
+        self.measured[(self.nChannel,nAxis)] = None
+        return True
+
+    # <summary>
+    # Returns (True, position from 0 to 1000) once the measurement of the axis has been answered, (True, None) while
+    # it runs, or (False, 0) if no measurement was started. Does not wait.
+    # </summary>
+    def GetMeasuredPosition(self,nAxis):
+        key = (self.nChannel,nAxis)
+        if key not in self.measured:
+            return (False,0)
+        if self.measured[key] is None and self.port is not None:
+            try:
+                self._collect_measurements()
+            except OSError:
+                return (False,0)
+        return (True,self.measured[key])
+
+    # <summary>
+    # Reads the lines already received and keeps the answers of the position measurements. Anything else is left
+    # over from earlier queries and dropped.
+    # </summary>
+    def _collect_measurements(self):
+        bLine = self.port.read_line(0.0)
+        while bLine is not None:
+            self._measurement_answer(bLine)
+            bLine = self.port.read_line(0.0)
+
+    # <summary>
+    # Returns True if the line answers a position measurement that is waiting for it on the current channel (e.g.
+    # "1MA512"), and keeps the position.
+    # </summary>
+    def _measurement_answer(self,bLine):
+        for (nChannel,nAxis) in self.measured:
+            bPrefix = b"%dMA" % nAxis
+            if nChannel == self.nChannel and self.measured[(nChannel,nAxis)] is None and bLine.startswith(bPrefix):
+                try:
+                    self.measured[(nChannel,nAxis)] = int(bLine[len(bPrefix):])
+                except ValueError:
+                    return False
+                return True
+        return False
+
+    # <summary>
+    # Returns (status, error code of the last command), see ERROR_CODES.
+    # </summary>
+    def GetErrorCode(self):
+        return self._query_int(CMD_ERROR,b"TE")
+
+    # <summary>
+    # Sends a query whose answer is an integer, e.g. "1TP-123". Returns (status, value).
+    # </summary>
+    def _query_int(self,bCommand,bPrefix):
+        if bCommand is None:
+            return (False,0)
+        (bStatus,strValue) = self._query(bCommand,bPrefix)
+        try:
+            return (bStatus,int(strValue) if bStatus else 0)
+        except ValueError:
+            return (False,0)
+
+    # <summary>
+    # Returns (status, step counter) of the axis on the current channel (TP).
+    # </summary>
+    def GetStepCount(self,nAxis):
+        return self._query_int(CMD_STEPS.get(nAxis),b"%dTP" % nAxis)
+
+    # <summary>
+    # Returns (status, axis status) of the axis on the current channel (TS): 0 = ready, 1 = stepping, 2 = jogging,
+    # 3 = moving to a limit.
+    # </summary>
+    def GetAxisStatus(self,nAxis):
+        return self._query_int(CMD_STATUS.get(nAxis),b"%dTS" % nAxis)
+
+    # <summary>
+    # Returns (status, step amplitude) of the axis on the current channel in the direction (SU+? / SU-?): positive for
+    # the positive direction, negative for the negative one.
+    # </summary>
+    def GetStepAmplitude(self,nAxis,bPositive):
+        return self._query_int(CMD_AMPLITUDE_QUERY.get((nAxis,bool(bPositive))),b"%dSU" % nAxis)
+
+    # <summary>
+    # Returns (status, controller version string), e.g. (True, "AG-UC8 v2.2.1").
+    # </summary>
+    def GetVersion(self):
+        return self._query(CMD_VERSION,b"")
@@ -0,0 +1,508 @@
+######################## Simulated AG-UC8 controller ##############################
+
+# A stand-in for Newport's CmdLibAgilis so the motion code can be exercised without the physical controller or the
+# .NET DLLs. It models what matters for timing:
+#  - every command takes fCommandLatency, and selecting a different channel takes fChannelLatency on top of that;
+#  - only one channel can be driven at a time: selecting another channel stops the axes of the previous one;
+#  - jog speeds 1-4 move the axis at the step rates of the AG-UC8 (STEP_RATES), and every axis has a step counter;
+#  - a relative move of n steps takes n/RELATIVE_STEP_RATE seconds, and is refused while the axis is moving;
+#  - an absolute position measurement (MA) takes fMeasureDuration seconds, during which the axis scans its travel range
+#    (TRAVEL_STEPS, the step counters start in the middle) and ends where it started. Any motion command or a switch
+#    to another channel aborts it. An absolute move (PA) measures the position the same way first, then steps to
+#    the target.
+# Every command is recorded in loCommandLog as (timestamp, command, args) so benchmarks can see when it "arrived".
+#
+# Time comes from a clock object: WallClock (the default) really waits, VirtualClock only advances a counter, so a
+# simulated session of minutes runs in milliseconds and gives the same timings on every run.
+
+import os
+import re
+import select
+import threading
+import time
+
+from aguc8 import STEP_RATES, RELATIVE_STEP_RATE, MAX_RELATIVE_STEPS, MAX_STEP_AMPLITUDE, DEFAULT_STEP_AMPLITUDE
+from aguc8 import MEASURE_RANGE, MEASURE_DURATION
+
+TRAVEL_STEPS = 240000 # steps across the travel range of a simulated stage
+
+########################### Clocks ##############################################
+
+class WallClock:
+    def now(self):
+        return time.perf_counter()
+
+    def sleep(self,fSeconds):
+        if fSeconds > 0:
+            time.sleep(fSeconds)
+
+# <summary>
+# A clock that does not wait: sleep only moves now() forward. Starts at 0.
+# </summary>
+class VirtualClock:
+    def __init__(self):
+        self.t = 0.0
+        self.lock = threading.Lock()
+
+    def now(self):
+        return self.t
+
+    def sleep(self,fSeconds):
+        if fSeconds > 0:
+            with self.lock:
+                self.t += fSeconds
+
+########################### Controller ##########################################
+
+class SimCmdLibAgilis:
+    # <summary>
+    # fCommandLatency: seconds each command takes to complete, 5 ms by default.
+    # fChannelLatency: extra seconds SetChannel takes when it selects a different channel.
+    # oClock: WallClock (default) or VirtualClock.
+    # fMeasureDuration: seconds an absolute position measurement (MA) takes.
+    # </summary>
+    def __init__(self,fCommandLatency=0.005,fChannelLatency=0.0,oClock=None,fMeasureDuration=MEASURE_DURATION):
+        self.fCommandLatency = fCommandLatency
+        self.fChannelLatency = fChannelLatency
+        self.fMeasureDuration = fMeasureDuration
+        self.oClock = WallClock() if oClock is None else oClock
+        self.nChannel = 0
+        self.bRemote = False
+        self.strDeviceKey = ""
+        # jog_speeds: maps (channel, axis) to the jog speed it is moving at (0 = stopped)
+        self.jog_speeds = dict()
+        # steps: maps (channel, axis) to its step counter at jog_started[(channel, axis)]
+        self.steps = dict()
+        self.jog_started = dict()
+        # moves: maps (channel, axis) to (start time, steps) of its last relative move
+        self.moves = dict()
+        # amplitudes: maps (channel, axis, positive direction?) to its step amplitude
+        self.amplitudes = dict()
+        # measurements: maps (channel, axis) to the start time of its last position measurement
+        self.measurements = dict()
+        self.loCommandLog = []
+
+    def _command(self,strCommand,*args,fExtraLatency=0.0):
+        self.oClock.sleep(self.fCommandLatency + fExtraLatency)
+        self.loCommandLog.append((self.oClock.now(),strCommand,args))
+
+    # <summary>
+    # Changes the jog speed of (channel, axis), bringing its step counter up to date first. This also ends a relative
+    # move or a position measurement in progress.
+    # </summary>
+    def _set_jog(self,key,nJogSpeed):
+        self.steps[key] = self.Step_Count(*key)
+        self.moves.pop(key,None)
+        self._abort_measurement(key)
+        self.jog_started[key] = self.oClock.now()
+        self.jog_speeds[key] = nJogSpeed
+
+    # <summary>
+    # Returns the step counter of (channel, axis) right now.
+    # </summary>
+    def Step_Count(self,nChannel,nAxis):
+        key = (nChannel,nAxis)
+        if key in self.moves:
+            (tStart,nSteps) = self.moves[key]
+            nDone = min(abs(nSteps),max(int(RELATIVE_STEP_RATE*(self.oClock.now() - tStart)),0))
+            return self.steps.get(key,0) + (nDone if nSteps > 0 else -nDone)
+        nJogSpeed = self.jog_speeds.get(key,0)
+        fElapsed = self.oClock.now() - self.jog_started.get(key,0.0)
+        nSign = 1 if nJogSpeed > 0 else -1
+        return self.steps.get(key,0) + nSign*int(STEP_RATES[abs(nJogSpeed)]*fElapsed)
+
+    # <summary>
+    # Returns 0 if the device was opened, like CmdLibAgilis.Open.
+    # </summary>
+    def Open(self,strDeviceKey):
+        self._command("Open",strDeviceKey)
+        self.strDeviceKey = strDeviceKey
+        return 0
+
+    def Close(self):
+        self._command("Close")
+        self.strDeviceKey = ""
+
+    def SetRemoteMode(self):
+        self._command("SetRemoteMode")
+        self.bRemote = True
+        return True
+
+    # <summary>
+    # Selects the channel. The controller can only drive one channel at a time, so switching channel stops every
+    # axis of the previous channel.
+    # </summary>
+    def SetChannel(self,nChannel):
+        bSwitch = nChannel != self.nChannel
+        self._command("SetChannel",nChannel,fExtraLatency=self.fChannelLatency if bSwitch else 0.0)
+        if bSwitch:
+            for (nChan,nAxis) in set(self.jog_speeds) | set(self.measurements):
+                if nChan == self.nChannel:
+                    self._set_jog((nChan,nAxis),0)
+        self.nChannel = nChannel
+        return True
+
+    def StartJogging(self,nAxis,nJogSpeed):
+        self._command("StartJogging",nAxis,nJogSpeed)
+        if not -4 <= nJogSpeed <= 4:
+            return False
+        self._set_jog((self.nChannel,nAxis),nJogSpeed)
+        return True
+
+    # <summary>
+    # Starts a relative move of nSteps on the axis of the current channel, like the PR command. Returns False if the
+    # axis is moving or nSteps is out of range.
+    # </summary>
+    def RelativeMove(self,nAxis,nSteps):
+        self._command("RelativeMove",nAxis,nSteps)
+        key = (self.nChannel,nAxis)
+        if abs(nSteps) > MAX_RELATIVE_STEPS or self._status(key) != 0:
+            return False
+        self._set_jog(key,0)
+        self.moves[key] = (self.oClock.now(),nSteps)
+        return True
+
+    # <summary>
+    # Moves the axis on the current channel to nTarget (0 to MEASURE_RANGE of the travel range), like the PA command:
+    # the position is measured first (fMeasureDuration), then the axis steps to the target. Returns False if the axis
+    # is moving or nTarget is out of range.
+    # </summary>
+    def AbsoluteMove(self,nAxis,nTarget):
+        self._command("AbsoluteMove",nAxis,nTarget)
+        key = (self.nChannel,nAxis)
+        if not 0 <= nTarget <= MEASURE_RANGE or self._status(key) != 0:
+            return False
+        self._set_jog(key,0)
+        nSteps = nTarget*TRAVEL_STEPS//MEASURE_RANGE - (TRAVEL_STEPS//2 + self.steps.get(key,0))
+        self.moves[key] = (self.oClock.now() + self.fMeasureDuration,nSteps)
+        return True
+
+    # <summary>
+    # Sets the step amplitude of the axis on the current channel, like the SU command: a positive nAmplitude sets the
+    # amplitude of the positive direction, a negative one that of the negative direction. Returns False if out of range.
+    # </summary>
+    def SetStepAmplitude(self,nAxis,nAmplitude):
+        self._command("SetStepAmplitude",nAxis,nAmplitude)
+        if nAmplitude == 0 or abs(nAmplitude) > MAX_STEP_AMPLITUDE:
+            return False
+        self.amplitudes[(self.nChannel,nAxis,nAmplitude > 0)] = abs(nAmplitude)
+        return True
+
+    # <summary>
+    # Returns (True, step amplitude) of the axis on the current channel in the direction, like the SU+? / SU-?
+    # queries: positive for the positive direction, negative for the negative one.
+    # </summary>
+    def GetStepAmplitude(self,nAxis,bPositive):
+        self._command("GetStepAmplitude",nAxis,bPositive)
+        nAmplitude = self.amplitudes.get((self.nChannel,nAxis,bool(bPositive)),DEFAULT_STEP_AMPLITUDE)
+        return (True,nAmplitude if bPositive else -nAmplitude)
+
+    # <summary>
+    # Returns (True, firmware version), like the VE command.
+    # </summary>
+    def GetVersion(self):
+        self._command("GetVersion")
+        return (True,AGUC8_VERSION)
+
+    # <summary>
+    # Starts an absolute position measurement of the axis on the current channel, like the MA command. Returns False
+    # if the axis is moving. The result is read with GetMeasuredPosition.
+    # </summary>
+    def StartMeasurePosition(self,nAxis):
+        self._command("StartMeasurePosition",nAxis)
+        key = (self.nChannel,nAxis)
+        if self._status(key) != 0:
+            return False
+        self._set_jog(key,0)
+        self.measurements[key] = self.oClock.now()
+        return True
+
+    # <summary>
+    # Returns the result of the last position measurement of the axis on the current channel: (True, None) while it
+    # runs, (True, position from 0 to MEASURE_RANGE) once it is over, (False, 0) if there is none or it was aborted.
+    # </summary>
+    def GetMeasuredPosition(self,nAxis):
+        self._command("GetMeasuredPosition",nAxis)
+        return self.Measurement(self.nChannel,nAxis)
+
+    # <summary>
+    # Same as GetMeasuredPosition for (channel, axis), without the command latency: for the pty controller.
+    # </summary>
+    def Measurement(self,nChannel,nAxis):
+        key = (nChannel,nAxis)
+        if key not in self.measurements:
+            return (False,0)
+        if self.oClock.now() - self.measurements[key] < self.fMeasureDuration:
+            return (True,None)
+        fPosition = (TRAVEL_STEPS//2 + self.Step_Count(nChannel,nAxis))/TRAVEL_STEPS
+        return (True,int(round(MEASURE_RANGE*min(max(fPosition,0.0),1.0))))
+
+    # <summary>
+    # Aborts the position measurement of (channel, axis) if it is still running. A finished one is kept.
+    # </summary>
+    def _abort_measurement(self,key):
+        if key in self.measurements and self.oClock.now() - self.measurements[key] < self.fMeasureDuration:
+            del self.measurements[key]
+
+    def StopMotion(self,nAxis):
+        self._command("StopMotion",nAxis)
+        self._set_jog((self.nChannel,nAxis),0)
+        return True
+
+    # <summary>
+    # Returns (True, step counter) of the axis on the current channel, like the TP query.
+    # </summary>
+    def GetStepCount(self,nAxis):
+        self._command("GetStepCount",nAxis)
+        return (True,self.Step_Count(self.nChannel,nAxis))
+
+    # <summary>
+    # Returns the status of (channel, axis): 0 = ready, 1 = stepping (relative move), 2 = jogging, 3 = measuring its
+    # position (moving to the limits).
+    # </summary>
+    def _status(self,key):
+        if self.jog_speeds.get(key,0):
+            return 2
+        if key in self.moves:
+            (tStart,nSteps) = self.moves[key]
+            if RELATIVE_STEP_RATE*(self.oClock.now() - tStart) < abs(nSteps):
+                return 1
+        if key in self.measurements and self.oClock.now() - self.measurements[key] < self.fMeasureDuration:
+            return 3
+        return 0
+
+    # <summary>
+    # Returns (True, status) of the axis on the current channel, like the TS query: 0 = ready, 1 = stepping,
+    # 2 = jogging, 3 = measuring its position.
+    # </summary>
+    def GetAxisStatus(self,nAxis):
+        self._command("GetAxisStatus",nAxis)
+        return (True,self._status((self.nChannel,nAxis)))
+
+    # <summary>
+    # Returns True if any axis of any channel is jogging, stepping or measuring its position.
+    # </summary>
+    def Is_Moving(self):
+        return any(self._status(key) for key in set(self.jog_speeds) | set(self.moves) | set(self.measurements))
+
+######################## .NET-shaped controller ##############################
+
+# DotNetSimCmdLib offers a SimCmdLibAgilis under the names and signatures of Newport's CmdLibAgilis.dll: queries take a
+# placeholder for their out parameter and return (status, value), as they do through pythonnet. The code meant for the
+# .NET transport can so be run without Windows or the DLLs. Only the methods the program uses are modelled.
+
+class DotNetSimCmdLib:
+    def __init__(self,oController=None):
+        self.oController = SimCmdLibAgilis(0.0) if oController is None else oController
+
+    def Open(self,strDeviceKey):
+        return self.oController.Open(strDeviceKey)
+
+    def Close(self):
+        return self.oController.Close()
+
+    def SetRemoteMode(self):
+        return self.oController.SetRemoteMode()
+
+    def SetChannel(self,nChannel):
+        return self.oController.SetChannel(nChannel)
+
+    def StartJogging(self,nAxis,nJogSpeed):
+        return self.oController.StartJogging(nAxis,nJogSpeed)
+
+    def StopMotion(self,nAxis):
+        return self.oController.StopMotion(nAxis)
+
+    def RelativeMove(self,nAxis,nSteps):
+        return self.oController.RelativeMove(nAxis,nSteps)
+
+    def AbsoluteMove(self,nAxis,nTarget):
+        return self.oController.AbsoluteMove(nAxis,nTarget)
+
+    def GetAxisStatus(self,nAxis,nStatus):
+        return self.oController.GetAxisStatus(nAxis)
+
+    def GetStepsAccumulated(self,nAxis,nSteps):
+        return self.oController.GetStepCount(nAxis)
+
+    def SetStepAmplitudePositive(self,nAxis,nAmplitude):
+        return nAmplitude > 0 and self.oController.SetStepAmplitude(nAxis,nAmplitude)
+
+    def SetStepAmplitudeNegative(self,nAxis,nAmplitude):
+        return nAmplitude > 0 and self.oController.SetStepAmplitude(nAxis,-nAmplitude)
+
+    def GetStepAmplitudePositive(self,nAxis,nAmplitude):
+        return self.oController.GetStepAmplitude(nAxis,True)
+
+    def GetStepAmplitudeNegative(self,nAxis,nAmplitude):
+        return self.oController.GetStepAmplitude(nAxis,False)
+
+    def GetErrorPreviousCommand(self,nError):
+        return (True,0)
+
+    def GetFirmwareVersion(self,strVersion):
+        return self.oController.GetVersion()
+
+######################## Pseudo-terminal backed controller ##############################
+
+# PtyAgilisController speaks the AG-UC8 ASCII protocol on a pseudo-terminal, on behalf of a SimCmdLibAgilis. The
+# slave end (strDeviceKey) can be opened like the controller's serial port, e.g. by agilis_serial.AgilisSerial, so the
+# serial transport can be exercised end to end without hardware. POSIX only.
+
+AGUC8_VERSION = "AG-UC8 v2.2.1"
+
+# <summary>
+# Matches an AG-UC8 command: optional axis number, two-letter command, optional parameter.
+# </summary>
+COMMAND_PATTERN = re.compile(r"^([0-9]*)([A-Z]{2})(.*)$")
+
+class PtyAgilisController:
+    # <summary>
+    # oController: the SimCmdLibAgilis carrying out the commands (a new one without latency if None).
+    # fReplyLatency: extra delay (seconds) before each query is answered.
+    # </summary>
+    def __init__(self,oController=None,fReplyLatency=0.0):
+        import pty
+        import tty
+        self.oController = SimCmdLibAgilis(0.0) if oController is None else oController
+        self.fReplyLatency = fReplyLatency
+        self.nError = 0
+        self.measuring = [] # (channel, axis) of the position measurements (MA) not answered yet
+        (self.master,self.slave) = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.strDeviceKey = os.ttyname(self.slave)
+        self.bRunning = True
+        self.thread = threading.Thread(target=self._run,name="agilis-pty",daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        bBuffer = b""
+        while self.bRunning:
+            self._answer_measurements()
+            if not select.select([self.master],[],[],0.05)[0]:
+                continue
+            try:
+                bBuffer += os.read(self.master,256)
+            except OSError:
+                return
+            while b"\r\n" in bBuffer:
+                (bLine,bBuffer) = bBuffer.split(b"\r\n",1)
+                strReply = self._handle(bLine.decode("ascii","replace").strip())
+                if strReply is not None:
+                    if self.fReplyLatency:
+                        time.sleep(self.fReplyLatency)
+                    os.write(self.master,strReply.encode("ascii") + b"\r\n")
+
+    # <summary>
+    # The controller answers a position measurement (MA) when it is over: sends the answers of those that are.
+    # Aborted measurements are never answered.
+    # </summary>
+    def _answer_measurements(self):
+        for (nChannel,nAxis) in list(self.measuring):
+            (bStatus,nPosition) = self.oController.Measurement(nChannel,nAxis)
+            if bStatus and nPosition is None:
+                continue
+            self.measuring.remove((nChannel,nAxis))
+            if bStatus:
+                os.write(self.master,"{}MA{}".format(nAxis,nPosition).encode("ascii") + b"\r\n")
+
+    # <summary>
+    # Carries out one command line. Returns the reply to send back, or None for set commands.
+    # </summary>
+    def _handle(self,strLine):
+        match = COMMAND_PATTERN.match(strLine)
+        if match is None:
+            self.nError = -1
+            return None
+        (strAxis,strCommand,strParameter) = match.groups()
+        nAxis = int(strAxis) if strAxis else None
+
+        if strCommand == "TE":
+            (nError,self.nError) = (self.nError,0)
+            return "TE{}".format(nError)
+        if strCommand == "VE":
+            return AGUC8_VERSION
+        if strCommand == "MR":
+            self.oController.SetRemoteMode()
+            return None
+        if strCommand == "ML":
+            self.oController.bRemote = False
+            return None
+        if not self.oController.bRemote:
+            self.nError = -5
+            return None
+        if strCommand == "CC":
+            if strParameter not in ("1","2","3","4"):
+                self.nError = -4
+                return None
+            self.oController.SetChannel(int(strParameter))
+            return None
+        if nAxis not in (1,2):
+            self.nError = -2 if strCommand in ("JA","MA","PA","PR","SU","ST","TP","TS") else -1
+            return None
+        if strCommand == "JA":
+            try:
+                nSpeed = int(strParameter)
+            except ValueError:
+                self.nError = -3
+                return None
+            if not -4 <= nSpeed <= 4:
+                self.nError = -4
+                return None
+            self.oController.StartJogging(nAxis,nSpeed)
+            return None
+        if strCommand == "PR":
+            try:
+                nSteps = int(strParameter)
+            except ValueError:
+                self.nError = -3
+                return None
+            if abs(nSteps) > MAX_RELATIVE_STEPS:
+                self.nError = -4
+            elif not self.oController.RelativeMove(nAxis,nSteps):
+                self.nError = -6
+            return None
+        if strCommand == "PA":
+            try:
+                nTarget = int(strParameter)
+            except ValueError:
+                self.nError = -3
+                return None
+            if not 0 <= nTarget <= MEASURE_RANGE:
+                self.nError = -4
+            elif not self.oController.AbsoluteMove(nAxis,nTarget):
+                self.nError = -6
+            return None
+        if strCommand == "SU":
+            if strParameter in ("+?","-?"):
+                return "{}SU{:+d}".format(nAxis,self.oController.GetStepAmplitude(nAxis,strParameter == "+?")[1])
+            try:
+                nAmplitude = int(strParameter)
+            except ValueError:
+                self.nError = -3
+                return None
+            if not self.oController.SetStepAmplitude(nAxis,nAmplitude):
+                self.nError = -4
+            return None
+        if strCommand == "MA":
+            if self.oController.StartMeasurePosition(nAxis):
+                self.measuring.append((self.oController.nChannel,nAxis))
+            else:
+                self.nError = -6
+            return None
+        if strCommand == "ST":
+            self.oController.StopMotion(nAxis)
+            return None
+        if strCommand == "TP":
+            return "{}TP{}".format(nAxis,self.oController.GetStepCount(nAxis)[1])
+        if strCommand == "TS":
+            return "{}TS{}".format(nAxis,self.oController.GetAxisStatus(nAxis)[1])
+        self.nError = -1
+        return None
+
+    def Close(self):
+        self.bRunning = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
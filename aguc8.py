@@ -0,0 +1,24 @@
+######################## AG-UC8 constants ##############################
+
+# What the controller does, from the AG-UC8 manual, for the code that plans or estimates motion (batch.py,
+# estimator.py, goto.py), the transports (agilis_serial.py) and the simulator (agilis_sim.py). These are nominal
+# figures: a stage's own step rates and step sizes come from its calibration (see calibration.py).
+
+# Steps per second of each jog speed (JA command). 2 and 3 use fixed step amplitudes, 1 and 4 the amplitude set with
+# SU.
+STEP_RATES = dict({0:0, 1:5, 2:100, 3:1700, 4:666})
+
+# Steps per second of a relative move (PR command).
+RELATIVE_STEP_RATE = 1000
+
+# The largest relative move the controller accepts (PR command), in steps.
+MAX_RELATIVE_STEPS = 2147483647
+
+# Step amplitudes (SU command): 1 to 50 in each direction, 16 after power-up.
+MAX_STEP_AMPLITUDE = 50
+DEFAULT_STEP_AMPLITUDE = 16
+
+# Absolute position measurement (MA command) and absolute moves (PA command): the position is given on a scale of 0 to
+# MEASURE_RANGE of the travel range, after a scan of the whole range that takes up to MEASURE_DURATION seconds.
+MEASURE_RANGE = 1000
+MEASURE_DURATION = 120.0
@@ -0,0 +1,87 @@
+######################## Step amplitudes ##############################
+
+# The step amplitude (SU command) sets how far a piezo step goes, from 1 to 50, separately for the positive and the
+# negative direction of every (channel, axis). It applies to jog speeds 1 and 4 and to relative moves (see
+# aguc8.py). Large amplitudes cover distance fast; small ones give fine, repeatable steps for the final approach.
+#
+#  - Step_Amplitudes / Configure_Step_Amplitudes read and set the amplitudes of stages. The values are cached by
+#    CachedCmdLib (see agilis_cache.py), so reading an amplitude that is known, or setting one to the value it already
+#    has, costs no serial transaction;
+#  - a configuration of several stages is applied in one pass ordered by channel, the selected channel first: one
+#    SetChannel per channel, not one per value;
+#  - profiles (STEP_AMPLITUDE_PROFILES) name a pair of amplitudes, e.g. coarse for travel and fine for the approach, and
+#    Apply_Profiles switches stages between them. AGILIS_STEP_PROFILES sets the profiles applied when the GUI starts,
+#    e.g. "x=coarse,y=coarse,z=fine".
+# Selecting a channel stops the stages of the other channel, so amplitudes are only set while those are idle.
+#
+# These functions run on the motion worker.
+
+import os
+
+# Profiles: (positive amplitude, negative amplitude), signed like the SU command.
+STEP_AMPLITUDE_PROFILES = dict({"coarse":(50,-50), "fine":(10,-10)})
+
+# Profiles applied at start-up (see the top of this file). Empty: the amplitudes are left as they are.
+STARTUP_PROFILES = os.environ.get("AGILIS_STEP_PROFILES","")
+
+# <summary>
+# Parses a list of profiles like "x=coarse,y=coarse,z=fine". Returns a dict mapping stages to profile names. Raises
+# ValueError for an unknown stage or profile.
+# </summary>
+def Parse_Profiles(strProfiles,stage_map,profiles=STEP_AMPLITUDE_PROFILES):
+    stage_profiles = dict()
+    for strItem in strProfiles.split(","):
+        if not strItem.strip():
+            continue
+        (stage,_,strProfile) = strItem.partition("=")
+        (stage,strProfile) = (stage.strip(),strProfile.strip())
+        if stage not in stage_map:
+            raise ValueError("Unknown stage {!r} in {!r}".format(stage,strProfiles))
+        if strProfile not in profiles:
+            raise ValueError("Unknown step amplitude profile {!r} in {!r}".format(strProfile,strProfiles))
+        stage_profiles[stage] = strProfile
+    return stage_profiles
+
+# <summary>
+# Returns (bStatus, positive amplitude, negative amplitude) of the stage. Amplitudes the cache knows are returned
+# without selecting the channel or querying the controller.
+# </summary>
+def Step_Amplitudes(oCmdLib,stage_map,stage):
+    (nChannel,nAxis) = stage_map[stage]
+    if hasattr(oCmdLib,"Cached_Step_Amplitude"):
+        locached = [oCmdLib.Cached_Step_Amplitude(nChannel,nAxis,bPositive) for bPositive in (True,False)]
+        if None not in locached:
+            return (True,locached[0],locached[1])
+    if not oCmdLib.SetChannel(nChannel):
+        return (False,0,0)
+    (bPositive,nPositive) = oCmdLib.GetStepAmplitude(nAxis,True)
+    (bNegative,nNegative) = oCmdLib.GetStepAmplitude(nAxis,False)
+    return (bPositive and bNegative,nPositive,nNegative)
+
+# <summary>
+# Sets the step amplitudes of stages: settings maps stages to (positive amplitude, negative amplitude), signed like
+# the SU command. The stages are configured channel by channel, the selected channel first. If fnMoving is given and
+# returns a stage that selecting one of these channels would stop, nothing is set. Returns True if every value was set.
+# </summary>
+def Configure_Step_Amplitudes(oCmdLib,stage_map,settings,fnMoving=None):
+    nSelected = getattr(oCmdLib,"nChannel",None)
+    lostages = sorted(settings,key=lambda stage:(stage_map[stage][0] != nSelected,stage_map[stage]))
+    lochannels = set(stage_map[stage][0] for stage in lostages)
+    if fnMoving is not None and any(lochannels - set([stage_map[stage][0]]) for stage in fnMoving()):
+        return False
+    for stage in lostages:
+        (nChannel,nAxis) = stage_map[stage]
+        if not oCmdLib.SetChannel(nChannel):
+            return False
+        for nAmplitude in settings[stage]:
+            if not oCmdLib.SetStepAmplitude(nAxis,nAmplitude):
+                return False
+    return True
+
+# <summary>
+# Switches stages to step amplitude profiles: stage_profiles maps stages to profile names. See
+# Configure_Step_Amplitudes.
+# </summary>
+def Apply_Profiles(oCmdLib,stage_map,stage_profiles,fnMoving=None,profiles=STEP_AMPLITUDE_PROFILES):
+    return Configure_Step_Amplitudes(oCmdLib,stage_map,dict((stage,profiles[strProfile])
+                                                           for (stage,strProfile) in stage_profiles.items()),fnMoving)
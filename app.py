@@ -2,257 +2,130 @@
 
 import sys
 import os
-import inspect
-# Import the .NET Common Language Runtime (CLR) to allow interaction with .NET
-import clr
-import numpy as np
+import json
 import time
+import tkinter as tk
+import tkinter.font as font
 
-print ("Python %s\n\n" % (sys.version,))
-
-strCurrFile = os.path.abspath (inspect.stack()[0][1])
-print ("Executing File = %s\n" % strCurrFile)
-
-# Initialize the DLL folder path to where the DLLs are located
-strPathDllFolder = os.path.dirname (strCurrFile)
-print ("Executing Dir  = %s\n" % strPathDllFolder)
-
-# Add the DLL folder path to the system search path (before adding references)
-sys.path.append (strPathDllFolder)
-
-# Add a reference to each .NET assembly required
-clr.AddReference ("CmdLibAgilis")
-clr.AddReference ("VCPIOLib")
-
-# Import a class from a namespace
-from Newport.Motion.CmdLibAgilis import *
-from Newport.VCPIOLib import *
-from System.Text import StringBuilder
-
-########################### Global variables ###############################
+import motion
+from motion import Initializer, Start_Motion, Stop_Motion, Stop_All_Motion
+from motion import stage_map, axis_speeds, axis_status, dir_status
+from motion import speed_list, speed_list_dict, speed_list_z, init_x, init_y, init_z
+from estop import Emergency_Stop, Stop_Channel
+from motion_worker import MotionWorker, LANE_STOP
+import metrics
+from events import EVENTS, Record
+from keyrepeat import KeyRepeatFilter
+from poller import PositionPoller
+from estimator import PositionEstimator
+from calibration import CalibrationStore, Controller_Key, Current_Amplitudes
+from absolute import AbsolutePositionService
+from session import SESSION
+from amplitude import STARTUP_PROFILES, Parse_Profiles, Apply_Profiles
 
-# Defined below are several "speed_list" variables. speed_list contains the text that will appear in the
-# drop-down menu from which a speed is selected. The actual speed settings that the motor controller accepts
-# are integers 1 to 4. They are mapped to their corresponding "level" of speed in speed_list_dict.
-# speed_list_z and speed_list_dict_z do a similar thing, but only with the two lowest speeds. This is because
-# having a high speed for the vertical motorized stage risks damaging the sample or microscope objective lens.
-######### TODO: Change z options back to only very slow and slow for above reason!!!
-speed_list = ["Very slow", "Slow", "Fast", "Very fast"]
-speed_list_dict = ({"Very slow":1,"Slow":2,"Fast":3,"Very fast":4})
-speed_list_z = ["Very slow", "Slow", "Fast", "Very fast"]
-speed_list_dict_z = ({"Very slow":1,"Slow":2,"Fast":3,"Very fast":4})
+###################################################################################################
+######################################### TKINTER  GUI ############################################
+###################################################################################################
 
-# stage map: Maps the motorized stages' names to values the code can work with. tuples are (channel, axis). The motor controller 
-# can only send commands to one channel at a time, but it can send commands to multiple axes on the same channel. 
-# For this reason we wish to have x and y linear stages on the same channel so that we can control them simultaneously using 
-# arrow keys. 
-stage_map   = dict({'x':(1,1),'y':(1,2),'z':(3,1)})
+# The GUI of the motor control program. The motion layer (device discovery, starting and stopping the stages) is in
+# motion.py. Run with: python app.py
 
-#axis_speeds is initialized to slow, slow, very slow for x,y,z. Lowest -> highest: 1,2,3,4.  
-init_x = "Slow"
-init_y = "Slow"
-init_z = "Very slow"
-axis_speeds = dict({'x':speed_list_dict[init_x],'y':speed_list_dict[init_y],'z':speed_list_dict[init_z]})
+# root, mydict, speed_values, key_filter, position_label, worker, poller, estimator and absolute are created by main().
+root = None
+mydict = None
+speed_values = None
+key_filter = None
+position_label = None
+worker = None
+poller = None
+estimator = None
+absolute = None
 
-# runnable: A global variable which is True if the computer successfully connected to the AGU-C8 motor controller,
-# False otherwise. 
-runnable = False # arbitrary value that is neither true nor false. When runnable has this value, we know that Initializer()
-                 # has not been called yet. ???
+# Interval (ms) at which the positions shown are refreshed from the poller's snapshot (see poller.py).
+POSITION_INTERVAL = 100
 
-#jogspeed       = 0
-#measuredposition = 0
-#positivestepamplitude = 0
+# If set, the raw x/y key events are saved to this file (JSON) on exit, to be replayed with bench_keyrepeat.py.
+KEY_RECORDING_PATH = os.environ.get("AGILIS_KEY_RECORDING","")
 
-########################### Helpers ########################################
+# All device I/O happens on the motion I/O thread (see motion_worker.py), so the GUI never waits for the controller.
+# Initializer runs there too, which makes the worker the owner of oCmdLib and oDeviceIO. It is submitted in the stop
+# lane so that no command can overtake it, with a timeout long enough for device discovery.
+INITIALIZE_TIMEOUT = 60.0 # seconds
 
-# <summary>
-# This method opens the first valid device in the list of discovered devices.
-# </summary>
-def OpenFirstValidDevice () :
-    # For each device key in the list
-    for oDeviceKey in strDeviceKeyList :
-        strDeviceKey = str (oDeviceKey)
-        
-        # If the device was opened
-        if (oCmdLib.Open (strDeviceKey) == 0) :
-            return strDeviceKey
+# axis_status and dir_status (see motion.py) are updated once the controller has carried out the corresponding command.
+# requested_status: the direction ("positive"/"negative") each axis has been asked to move in, or False. It is updated
+# as soon as a command is submitted, so key events that arrive before the previous command has completed are judged
+# against what the stages are about to do rather than what they were doing.
+requested_status = dict({'x':False,'y':False,'z':False})
 
-    # No device was opened
-    return ""
+# Interval (ms) at which the Tk loop picks up finished commands from the worker.
+CALLBACK_INTERVAL = 10
 
 # <summary>
-# This function gets the jog speed of the specified axis.
+# Runs the callbacks of the commands the worker has finished, then schedules itself again.
 # </summary>
-# def GetJogSpeed():
-#     global jogspeed
-#     bStatus,jogspeed = oCmdLib.GetJogMode(nAxis,jogspeed)
-    
-#     if (bStatus):
-#         return True
-    
-#     print ("ERROR! Could not get the jog speed.\n")
-#     return False
+def run_callbacks():
+    root.after(CALLBACK_INTERVAL,run_callbacks)
+    worker.Run_Callbacks()
 
 # <summary>
-# This function sets the jog speed of the specified axis.
+# Returns the stages that are moving or have been asked to move, or are measuring their absolute position, for the
+# position poller and the absolute position service (called from their threads).
 # </summary>
-def SetJogSpeed(nAxis,targetjogspeed):
-    bStatus = oCmdLib.StartJogging(nAxis,targetjogspeed)
-    
-    if (bStatus):
-        return True
-    
-    print("ERROR! Could not set the jog mode!\n")
-    return False
+def moving_stages():
+    lomoving = [axis for axis in axis_status if axis_status[axis] or requested_status[axis]]
+    return lomoving + absolute.Measuring() if absolute is not None else lomoving
 
 # <summary>
-# This function stops motion along the specified axis.
+# Shows the estimated positions of the stages (see estimator.py), from the motion events, the poller's snapshot of
+# the step counters and the absolute measurements (no controller query), then schedules itself again.
 # </summary>
-def StopTheJogging(nAxis):
-    bStatus = oCmdLib.StopMotion(nAxis)
-    if (bStatus):
-        return True
-    
-    print("ERROR! Could not stop jogging!\n")
-    return False
-
-############################ Open device, start communication ##############################
+def show_positions():
+    root.after(POSITION_INTERVAL,show_positions)
+    estimator.Update_Counters(poller.snapshot)
+    estimator.Update_Absolute(absolute.Measurements())
+    lopositions = []
+    for axis in ['x','y','z']:
+        (fSteps,fStd) = estimator.Position(axis)
+        lopositions.append("{}: {}".format(axis,"?" if fSteps is None else "{:.0f} ± {:.0f}".format(fSteps,fStd)))
+    position_label.config(text="   ".join(lopositions) + "  (steps)")
 
 # <summary>
-# Initializer: When called, checks if any valid devices are connected and opens the first one. IF MULTIPLE DEVICES CONNECTED
-# THIS MAY HAVE TO BE CHANGED! (e.g. if camera is also connected-> test this out!???)
-# Returns TRUE if a valid device was found, FALSE otherwise.
+# Queues a stop of each of the given channels, in the stop lane.
 # </summary>
-def Initializer():
-    global stage_map, strDeviceKey, strDeviceKeyList, oCmdLib, oDeviceIO, runnable
-    print ("Waiting for device discovery...\n")
-    
-    runnable = False # ???
-
-    # Call the Virtual COM Port I/O Library constructor with 
-    # true passed in so that logging is turned on for this sample
-    oDeviceIO = VCPIOLib (True)
-    oCmdLib = CmdLibAgilis (oDeviceIO)
-
-    # Discover the devices that are available for communication
-    oDeviceIO.DiscoverDevices ()
-
-    # Get the list of discovered devices
-    strDeviceKeyList = np.array ([])
-    strDeviceKeyList = oDeviceIO.GetDeviceKeys ()
-
-    # If no devices were discovered
-    if (not strDeviceKeyList) : ## (not strDeviceKeyList) = True if empty!
-        print ("No devices discovered.\n")
-    else :
-        # Open the first valid device in the list of discovered devices
-        strDeviceKey = OpenFirstValidDevice ()
-        #print ("Device Key = %s" % strDeviceKey)
-
-        # If the device was opened
-        if (strDeviceKey != "") :
-            # Set the controller to Remote Mode
-            if (oCmdLib.SetRemoteMode ()) :
-
-                runnable = True
-            else :
-                print ("Could not put the controller into Remote Mode.\n")
-
-        else :
-            print ("Could not open the device.\n")
-
-    return runnable
-
-############################# Helpers to start and stop motion #########################
+def sweep_idle_channels(lochannel):
+    for nChannel in lochannel:
+        worker.Submit(Stop_Channel,motion.oCmdLib,nChannel,lane=LANE_STOP)
 
 # <summary>
-# Starts motion along input axis in input direction at input speed
-# Returns True if motion started successfully, False otherwise.
+# Emergency stop used by the GUI: the moving stages are halted first (see Emergency_Stop), and the idle channels are
+# swept once that has completed. Axes that have been asked to move but not confirmed yet count as moving.
+# Motion commands still queued are cancelled.
 # </summary>
-def Start_Motion(axis,direction,speed):
-    global stage_map, strDeviceKey, strDeviceKeyList, oCmdLib, oDeviceIO, runnable
-    runnable2 = False
-    if runnable: # We need to have called Initializer() before we can set channel and send commands
-        (nChannel,nAxis) = stage_map[axis]
-        if direction=='positive':
-            targetjogspeed = speed
-        else:
-            targetjogspeed = -1*speed
-
-        if (oCmdLib.SetChannel (nChannel)):
-            SetJogSpeed(nAxis,targetjogspeed)
-
-            runnable2 = True
-        else:
-            print ("Could not set the current channel in Start_Motion.\n")
-
+def emergency_stop():
+    global axis_status, requested_status
+    moving = dict((axis,bool(axis_status[axis] or requested_status[axis])) for axis in axis_status)
+    SESSION.Stop_All()
+    absolute.Cancel()
+    for axis in requested_status:
+        requested_status[axis] = False
+    worker.Submit(lambda:Emergency_Stop(motion.oCmdLib,stage_map,moving),callback=emergency_stopped,
+                  lane=LANE_STOP,axes=stage_map)
+
+def emergency_stopped(future):
+    global mydict, axis_status, dir_status
+    if not future.cancelled() and future.exception() is None and future.result()[0]:
+        Record("emergency_stop",result=True,strMessage="All motion has been stopped.")
+        for axis in ['x','y','z']:
+            axis_status[axis] = False
+            dir_status[axis]  = False
+            for direction in ['positive', 'negative']:
+                (mydict[(axis,direction)]).config(bg='white')
+                (mydict[(axis,direction)]).config(activebackground='white')
+        sweep_idle_channels(future.result()[1])
     else:
-        print("Initialization failed.\n")
-    return runnable2
-
-# <summary>
-# Stops motion along input axis.
-# Returns True if motion stopped successfully,
-# False otherwise.
-# </summary>
-def Stop_Motion(axis):
-    global stage_map, strDeviceKey, strDeviceKeyList, oCmdLib, oDeviceIO
-    (nChannel,nAxis) = stage_map[axis]
-    runnable3 = False
-    #print("STOP_MOTION: nChannel = ",nChannel)
-    if (oCmdLib.SetChannel (nChannel)):
-        if StopTheJogging(nAxis):
-            runnable3 = True
-    else:
-        print("ERROR! Command to end motion failed! THIS SHOULD NEVER BE PRINTED!!")
-    return runnable3
-# <summary>
-# Stops motion along ALL axes on the AG-UC8 motor controller.
-# Returns True if all motion stopped successfully, False
-# otherwise.
-# </summary>
-def Stop_All_Motion():
-    global stage_map, strDeviceKey, strDeviceKeyList, oCmdLib, oDeviceIO
-    # Below, iterate over all channels and axes. AG-UC8 motor controller
-    # has 4 channels each with 2 axes.
-    lochannel = [1,2,3,4]
-    loaxis    = [1,2]
-    runnable4 = False
-    time.sleep(0.1)         # see below for reason
-    for nChannel in lochannel:
-        for nAxis in loaxis:
-            if (oCmdLib.SetChannel (nChannel)):
-                if StopTheJogging(nAxis):
-                    runnable4 = True
-                else:
-                    runnable4 = False
-            time.sleep(0.1) # Without this there are issues. I think the AGU-C8 controller
-                            # needs time to carry out its commands. (Can the issues also be
-                            # caused by fast inputs? This would be a problem!)
-    if runnable4 == True:
-        print("All motion has been stopped.")
-    else:
-        print('ERROR! Command to end all motion failed! THIS SHOULD NEVER BE PRINTED!!.')
-    return runnable4
-
-###################################################################################################
-######################################### TKINTER  GUI ############################################
-###################################################################################################
-
-import tkinter as tk
-import tkinter.font as font
-root = tk.Tk()
-#root.geometry("210x275") # selects specific dimensions. Problematic as this needs to be changed any time you add a new widget.
-root.title('Motor Control')
-root.resizable(0, 0) # makes window un-resizeable
-thefont = font.Font(size=30)
-
-Initializer() # opens devices, begins communication
-
-# next two global variables track which axes and directions are active/running.
-# dir_status will contain "positive"/"negative" 
-axis_status = dict({'x':False,'y':False,'z':False})
-dir_status  = dict({'x':False,'y':False,'z':False})
+        Record("emergency_stop",result=False,strMessage="Emergency stop failed!! Sweeping all channels.")
+        sweep_idle_channels([1,2,3,4])
 
 # <summary>
 # Runs the stage specified by 'axis' in the specified direction. If run_motor is called on a stage
@@ -262,170 +135,341 @@ dir_status  = dict({'x':False,'y':False,'z':False})
 # </summary>
 def run_motor(axis,direction):
     try:
-        global mydict, axis_status, dir_status, axis_speeds
-        if axis_status[axis] == False: # We will only turn ON a linear stage if it is NOT already running!
-            if ((axis=='x' or axis=='y') and axis_status['z'] == False) or (axis=='z' and (axis_status['x'] == False and axis_status['y'] == False)):
+        global mydict, requested_status, axis_speeds
+        if requested_status[axis] == False: # We will only turn ON a linear stage if it is NOT already running!
+            if ((axis=='x' or axis=='y') and requested_status['z'] == False) or (axis=='z' and (requested_status['x'] == False and requested_status['y'] == False)):
                 # This condition is here because the z stage is connected in a separate channel to x and y linear
                 # stages (the latter 2 of which are connected together). If z is running and then we send a command to run x/y,
                 # the motor controller will first turn off z and then turn on x/y (because it cannot keep 2 separate channels
                 # running simultaneously). This would make z stop while the program thinks it is still running, so might as well
                 # not permit x/y to be activated while z is running and vice versa.
-                print('motor began moving in {} {}.'.format(direction,axis))
+                Record("run_motor",axis,direction,strMessage='motor began moving in {} {}.'.format(direction,axis))
                 (mydict[(axis,direction)]).config(bg='blue') # for x and y, since they never get pressed so never display "active bgrnd"
                 (mydict[(axis,direction)]).config(activebackground='blue') #for z, since button 1 makes them active
-                if Start_Motion(axis,direction,axis_speeds[axis]):
-                    axis_status[axis] = True # we are now moving in this axis, so this indicates it
-                    dir_status[axis]  = direction
-                    print("axis = {}, axis_status = {}, dir_status = {}".format(axis, axis_status[axis],dir_status[axis]))
-                else: # this part is questionable. rework ???
-                    print("Could not start motion. The program will be terminated.\n")
-                    Stop_All_Motion()
-                    root.destroy()
-
-        elif (axis_status[axis]==True and dir_status[axis]==direction and axis=='z'): # if z axis is already running in input direction and we press
-            stop_motor(axis,direction)                                                # button again, we want the z motor to stop. (This is not pretty code
-            if (axis_status[axis] or dir_status[axis]):                               # structure, since this makes a stop command in a run_motor function.)
-                print("Error! Stop function did not work. This shouldn't occur!")
-                print(axis_status[axis],dir_status[axis])
+                requested_status[axis] = direction
+                SESSION.Start(axis,direction,axis_speeds[axis])
+                absolute.Cancel() # an absolute position measurement in progress is aborted before the stage starts
+                tStart = time.perf_counter()
+                worker.Submit(Start_Motion,axis,direction,axis_speeds[axis],
+                              callback=lambda future:motor_started(axis,direction,future,tStart),axes=[axis])
+
+        elif (requested_status[axis]==direction and axis=='z'): # if z axis is already running in input direction and we press
+            stop_motor(axis,direction)                          # button again, we want the z motor to stop. (This is not pretty code
+                                                                # structure, since this makes a stop command in a run_motor function.)
     except:
-        Stop_All_Motion()
-        print("AN ERROR OCCURRED IN run_motor!")
-        
+        emergency_stop()
+        Record("run_motor",axis,direction,False,strMessage="AN ERROR OCCURRED IN run_motor!")
+
+def motor_started(axis,direction,future,tStart=None):
+    global mydict, axis_status, dir_status, requested_status
+    fDuration = time.perf_counter() - tStart if tStart is not None else 0.0
+    if future.cancelled():
+        # Either a stop for this axis overtook the start (nothing to do), or the start was too late to be sent.
+        if requested_status[axis] == direction:
+            Record("Start_Motion",axis,direction,"expired",fDuration,
+                   "Start command for {} {} expired before it could be sent.".format(direction,axis))
+            SESSION.Stop(axis,direction) # the start was recorded: a replay must not keep the jog running
+            requested_status[axis] = False
+            (mydict[(axis,direction)]).config(bg='white')
+            (mydict[(axis,direction)]).config(activebackground='white')
+    elif future.exception() is None and future.result():
+        axis_status[axis] = True # we are now moving in this axis, so this indicates it
+        dir_status[axis]  = direction
+        Record("Start_Motion",axis,direction,True,fDuration,
+               "axis = {}, axis_status = {}, dir_status = {}".format(axis, axis_status[axis],dir_status[axis]))
+    else: # this part is questionable. rework ???
+        Record("Start_Motion",axis,direction,False,fDuration,
+               "Could not start motion. The program will be terminated.\n")
+        SESSION.Stop_All()
+        worker.Submit(Stop_All_Motion,callback=lambda future:root.destroy(),lane=LANE_STOP,axes=stage_map)
 
 def stop_motor(axis,direction):
     try:
-        global mydict, axis_status, dir_status
-        if axis_status[axis]==True and (dir_status[axis]==direction):  # only acts if the axis IS already running AND IN GIVEN DIRECTION
+        global mydict, requested_status
+        if requested_status[axis]==direction:  # only acts if the axis IS already running AND IN GIVEN DIRECTION
             (mydict[(axis,direction)]).config(bg='white')
-            print("Motion along {} stopped.".format(axis))
-            Stop_Motion(axis)
-            axis_status[axis] = False
-            dir_status[axis]  = False
+            Record("stop_motor",axis,direction,strMessage="Motion along {} stopped.".format(axis))
+            requested_status[axis] = False
+            SESSION.Stop(axis,direction)
+            tStart = time.perf_counter()
+            worker.Submit(Stop_Motion,axis,callback=lambda future:motor_stopped(axis,future,tStart),lane=LANE_STOP,
+                          axes=[axis])
     except:
-        Stop_All_Motion()
-        print("AN ERROR OCCURRED IN stop_motor!")
+        emergency_stop()
+        Record("stop_motor",axis,direction,False,strMessage="AN ERROR OCCURRED IN stop_motor!")
+
+def motor_stopped(axis,future,tStart=None):
+    global axis_status, dir_status
+    fDuration = time.perf_counter() - tStart if tStart is not None else 0.0
+    if not future.cancelled() and future.exception() is None and future.result():
+        axis_status[axis] = False
+        dir_status[axis]  = False
+        Record("Stop_Motion",axis,result=True,fDuration=fDuration)
+    else:
+        Record("Stop_Motion",axis,result=False,fDuration=fDuration,
+               strMessage="Error! Stop function did not work. This shouldn't occur!")
+        emergency_stop()
 
 def manage_speeds(axis,selection):
     try:
         global axis_speeds
         axis_speeds[axis] = selection
-        print("Speed in {} has been set to {}.\n".format(axis,selection))
+        SESSION.Speed(axis,selection)
+        Record("manage_speeds",axis,result=selection,
+               strMessage="Speed in {} has been set to {}.\n".format(axis,selection))
     except:
-        Stop_All_Motion()
-        print("AN ERROR OCCURRED IN manage_speeds!")
+        emergency_stop()
+        Record("manage_speeds",axis,result=False,strMessage="AN ERROR OCCURRED IN manage_speeds!")
         
 def emergency_stop_button():
     try:
-        global mydict, axis_status, dir_status
-        if Stop_All_Motion():
-            for axis in ['x','y','z']:
-                axis_status[axis] = False
-                dir_status[axis]  = False
-                for direction in ['positive', 'negative']:
-                    (mydict[(axis,direction)]).config(bg='white')
-                    (mydict[(axis,direction)]).config(activebackground='white')
-        else:
-            print("Stop_All_Motion() failed in emergency_stop_button!!")
+        emergency_stop()
     except:
-        print("AN ERROR OCCURRED IN emergency_stop_button!")
-
-##################################  x motion  ##################################
-move_x_right = tk.Button(root,text='right',bg='white')
-move_x_right['font'] = thefont
-move_x_right.grid(column=2,row=0,ipadx=1,ipady=1)
-
-x_speed_frame = tk.Frame(root)
-x_speed_frame.grid(column=1,row=0,padx=20,pady=10)
-stage_label = tk.Label(x_speed_frame,text="Horizontal stage 1")
-stage_label.grid()
-x_speed_value = tk.StringVar(root)
-x_speed_value.set(init_x) # Set the default value of the speed selection tab
-x_speed_select = tk.OptionMenu(x_speed_frame, x_speed_value, *speed_list,command=lambda selection:manage_speeds('x',speed_list_dict[selection]))
-x_speed_select.config(width=13)
-x_speed_select.grid()
-
-move_x_left = tk.Button(root,text='left',bg='white')
-move_x_left['font'] = thefont
-move_x_left.grid(column=0,row=0,ipadx=1,ipady=1)
-##################################  y motion  ##################################
-move_y_right = tk.Button(root,text='in',bg='white')
-move_y_right['font'] = thefont
-move_y_right.grid(column=2,row=1,ipadx=1,ipady=1)
-
-y_speed_frame = tk.Frame(root)
-y_speed_frame.grid(column=1,row=1,padx=20,pady=10)
-stage_label = tk.Label(y_speed_frame,text="Horizontal stage 2")
-stage_label.grid()
-y_speed_value = tk.StringVar(root)
-y_speed_value.set(init_y) # Set the default value of the speed selection tab
-y_speed_select = tk.OptionMenu(y_speed_frame, y_speed_value, *speed_list,command=lambda selection:manage_speeds('y',speed_list_dict[selection]))
-y_speed_select.config(width=13)
-y_speed_select.grid()
-
-move_y_left = tk.Button(root,text='out',bg='white')
-move_y_left['font'] = thefont
-move_y_left.grid(column=0,row=1,ipadx=1,ipady=1)
-
-##################################  z motion  ##################################
-move_z_right = tk.Button(root,text='down',bg='white')
-move_z_right['font'] = thefont
-move_z_right.grid(column=2,row=3,ipadx=1,ipady=1)
-move_z_right.bind('<ButtonPress-1>',lambda event:run_motor('z','positive'))
-#move_z_right.bind('<ButtonRelease-1>',lambda event:stop_motor('z','positive'))
-
-z_speed_frame = tk.Frame(root)
-z_speed_frame.grid(column=1,row=3,padx=20,pady=10)
-stage_label = tk.Label(z_speed_frame,text="Vertical stage")
-stage_label.grid()
-z_speed_value = tk.StringVar(root)
-z_speed_value.set(init_z) # Set the default value of the speed selection tab
-z_speed_select = tk.OptionMenu(z_speed_frame, z_speed_value, *speed_list_z,command=lambda selection:manage_speeds('z',speed_list_dict[selection]))
-z_speed_select.config(width=13)
-z_speed_select.grid()
-
-move_z_left = tk.Button(root,text='up',bg='white')
-move_z_left['font'] = thefont
-move_z_left.grid(column=0,row=3,ipadx=1,ipady=1)
-move_z_left.bind('<ButtonPress-1>',lambda event:run_motor('z','negative'))
-#move_z_left.bind('<ButtonRelease-1>',lambda event:stop_motor('z','negative'))
-################################  other stuff  #################################
-emergency_button = tk.Button(root, text="STOP ALL MOTION!")
-emergency_button['font'] = font.Font(size=10)
-emergency_button.grid(column=0,columnspan=3,row=4,ipadx=1,ipady=1)
-emergency_button.bind('<ButtonPress-1>', lambda event:emergency_stop_button())
-
-main_button = tk.Button(root,text="Click here for x-y motion")
-main_button['font'] = font.Font(size=10)
-main_button.grid(column=0,columnspan=3,row=5,ipadx=1,ipady=1)
-
-main_button.bind('<Right>',lambda event:run_motor('x','positive'))
-main_button.bind('<KeyRelease-Right>',lambda event:stop_motor('x','positive'))
-main_button.bind('<Left>',lambda event:run_motor('x','negative'))
-main_button.bind('<KeyRelease-Left>',lambda event:stop_motor('x','negative'))
-main_button.bind('<Up>',lambda event:run_motor('y','positive'))
-main_button.bind('<KeyRelease-Up>',lambda event:stop_motor('y','positive'))
-main_button.bind('<Down>',lambda event:run_motor('y','negative'))
-main_button.bind('<KeyRelease-Down>',lambda event:stop_motor('y','negative'))
-
-main_button.focus_set()
-
-# mydict: maps the 3 axes/motors (x,y,z) and 2 directions (positive, negative) to their
-# respective buttons defined above. mydict must be defined after button definition and
-# before root.mainloop() is called.
-mydict = dict({
-            ('z','negative'):move_z_left,
-            ('z','positive'):move_z_right,
-            ('y','negative'):move_y_left,
-            ('y','positive'):move_y_right,
-            ('x','negative'):move_x_left,
-            ('x','positive'):move_x_right,
-        })
-
-root.mainloop()
-# Close the device
-oCmdLib.Close ()
-
-print ("Shutting down.")
-
-# Shut down all communication
-oDeviceIO.Shutdown ()
\ No newline at end of file
+        Record("emergency_stop_button",result=False,strMessage="AN ERROR OCCURRED IN emergency_stop_button!")
+
+# <summary>
+# Closes the device and shuts down all communication. Runs on the motion I/O thread, after the commands that are
+# still queued.
+# </summary>
+def Close_Device():
+    # Close the device
+    motion.oCmdLib.Close ()
+    print (motion.oCmdLib.Report ())
+    print (motion.oCmdLib.Pacing_Report ())
+
+    print ("Shutting down.")
+
+    # Shut down all communication
+    motion.oDeviceIO.Shutdown ()
+
+# <summary>
+# Creates the main window and its widgets, and binds them to the callbacks above.
+# </summary>
+def build_gui():
+    global root, mydict, speed_values, key_filter, position_label
+    root = tk.Tk()
+    #root.geometry("210x275") # selects specific dimensions. Problematic as this needs to be changed any time you add a new widget.
+    root.title('Motor Control')
+    root.resizable(0, 0) # makes window un-resizeable
+    thefont = font.Font(size=30)
+
+    ##################################  x motion  ##################################
+    move_x_right = tk.Button(root,text='right',bg='white')
+    move_x_right['font'] = thefont
+    move_x_right.grid(column=2,row=0,ipadx=1,ipady=1)
+
+    x_speed_frame = tk.Frame(root)
+    x_speed_frame.grid(column=1,row=0,padx=20,pady=10)
+    stage_label = tk.Label(x_speed_frame,text="Horizontal stage 1")
+    stage_label.grid()
+    x_speed_value = tk.StringVar(root)
+    x_speed_value.set(init_x) # Set the default value of the speed selection tab
+    x_speed_select = tk.OptionMenu(x_speed_frame, x_speed_value, *speed_list,command=lambda selection:manage_speeds('x',speed_list_dict[selection]))
+    x_speed_select.config(width=13)
+    x_speed_select.grid()
+
+    move_x_left = tk.Button(root,text='left',bg='white')
+    move_x_left['font'] = thefont
+    move_x_left.grid(column=0,row=0,ipadx=1,ipady=1)
+    ##################################  y motion  ##################################
+    move_y_right = tk.Button(root,text='in',bg='white')
+    move_y_right['font'] = thefont
+    move_y_right.grid(column=2,row=1,ipadx=1,ipady=1)
+
+    y_speed_frame = tk.Frame(root)
+    y_speed_frame.grid(column=1,row=1,padx=20,pady=10)
+    stage_label = tk.Label(y_speed_frame,text="Horizontal stage 2")
+    stage_label.grid()
+    y_speed_value = tk.StringVar(root)
+    y_speed_value.set(init_y) # Set the default value of the speed selection tab
+    y_speed_select = tk.OptionMenu(y_speed_frame, y_speed_value, *speed_list,command=lambda selection:manage_speeds('y',speed_list_dict[selection]))
+    y_speed_select.config(width=13)
+    y_speed_select.grid()
+
+    move_y_left = tk.Button(root,text='out',bg='white')
+    move_y_left['font'] = thefont
+    move_y_left.grid(column=0,row=1,ipadx=1,ipady=1)
+
+    ##################################  z motion  ##################################
+    move_z_right = tk.Button(root,text='down',bg='white')
+    move_z_right['font'] = thefont
+    move_z_right.grid(column=2,row=3,ipadx=1,ipady=1)
+    move_z_right.bind('<ButtonPress-1>',lambda event:run_motor('z','positive'))
+    #move_z_right.bind('<ButtonRelease-1>',lambda event:stop_motor('z','positive'))
+
+    z_speed_frame = tk.Frame(root)
+    z_speed_frame.grid(column=1,row=3,padx=20,pady=10)
+    stage_label = tk.Label(z_speed_frame,text="Vertical stage")
+    stage_label.grid()
+    z_speed_value = tk.StringVar(root)
+    z_speed_value.set(init_z) # Set the default value of the speed selection tab
+    z_speed_select = tk.OptionMenu(z_speed_frame, z_speed_value, *speed_list_z,command=lambda selection:manage_speeds('z',speed_list_dict[selection]))
+    z_speed_select.config(width=13)
+    z_speed_select.grid()
+
+    move_z_left = tk.Button(root,text='up',bg='white')
+    move_z_left['font'] = thefont
+    move_z_left.grid(column=0,row=3,ipadx=1,ipady=1)
+    move_z_left.bind('<ButtonPress-1>',lambda event:run_motor('z','negative'))
+    #move_z_left.bind('<ButtonRelease-1>',lambda event:stop_motor('z','negative'))
+    ################################  other stuff  #################################
+    emergency_button = tk.Button(root, text="STOP ALL MOTION!")
+    emergency_button['font'] = font.Font(size=10)
+    emergency_button.grid(column=0,columnspan=3,row=4,ipadx=1,ipady=1)
+    emergency_button.bind('<ButtonPress-1>', lambda event:emergency_stop_button())
+
+    main_button = tk.Button(root,text="Click here for x-y motion")
+    main_button['font'] = font.Font(size=10)
+    main_button.grid(column=0,columnspan=3,row=5,ipadx=1,ipady=1)
+
+    position_label = tk.Label(root,text="")
+    position_label.grid(column=0,columnspan=3,row=6,pady=5)
+
+    # Holding an arrow key auto-repeats it: the key filter turns a held key into one run_motor and one stop_motor
+    # (see keyrepeat.py).
+    key_filter = KeyRepeatFilter(root.after,root.after_cancel,lambda key:run_motor(*key),lambda key:stop_motor(*key))
+    if KEY_RECORDING_PATH:
+        key_filter.lorecording = []
+    main_button.bind('<Right>',lambda event:key_filter.Press(('x','positive')))
+    main_button.bind('<KeyRelease-Right>',lambda event:key_filter.Release(('x','positive')))
+    main_button.bind('<Left>',lambda event:key_filter.Press(('x','negative')))
+    main_button.bind('<KeyRelease-Left>',lambda event:key_filter.Release(('x','negative')))
+    main_button.bind('<Up>',lambda event:key_filter.Press(('y','positive')))
+    main_button.bind('<KeyRelease-Up>',lambda event:key_filter.Release(('y','positive')))
+    main_button.bind('<Down>',lambda event:key_filter.Press(('y','negative')))
+    main_button.bind('<KeyRelease-Down>',lambda event:key_filter.Release(('y','negative')))
+    main_button.bind('<FocusOut>',lambda event:key_filter.Release_All())
+
+    main_button.focus_set()
+
+    # mydict: maps the 3 axes/motors (x,y,z) and 2 directions (positive, negative) to their
+    # respective buttons defined above. mydict must be defined after button definition and
+    # before root.mainloop() is called.
+    mydict = dict({
+                ('z','negative'):move_z_left,
+                ('z','positive'):move_z_right,
+                ('y','negative'):move_y_left,
+                ('y','positive'):move_y_right,
+                ('x','negative'):move_x_left,
+                ('x','positive'):move_x_right,
+            })
+
+    # speed_values: keeps the speed selection variables alive for as long as the window exists.
+    speed_values = dict({'x':x_speed_value,'y':y_speed_value,'z':z_speed_value})
+    return root
+
+# <summary>
+# Saves the recorded key events (see KEY_RECORDING_PATH) as a list of [ms since the first event, kind, axis,
+# direction].
+# </summary>
+def save_key_recording():
+    if not KEY_RECORDING_PATH or not key_filter.lorecording:
+        return
+    tFirst = key_filter.lorecording[0][0]
+    try:
+        with open(KEY_RECORDING_PATH,"w") as f:
+            json.dump([[round(1000*(t-tFirst),3),strKind,axis,direction]
+                       for (t,strKind,(axis,direction)) in key_filter.lorecording],f)
+    except OSError as e:
+        print ("Could not save the key recording to %s: %s" % (KEY_RECORDING_PATH,e))
+
+# <summary>
+# Tk reports exceptions raised in callbacks itself, so they never reach sys.excepthook: dump the motion events here too.
+# </summary>
+def report_callback_exception(*args):
+    EVENTS.On_Crash()
+    tk.Tk.report_callback_exception(root,*args)
+
+# <summary>
+# Applies the step amplitude profiles of AGILIS_STEP_PROFILES (see amplitude.py), once the device is open. Runs on the
+# motion I/O thread.
+# </summary>
+def configure_step_amplitudes():
+    if not motion.runnable or not STARTUP_PROFILES:
+        return
+    try:
+        stage_profiles = Parse_Profiles(STARTUP_PROFILES,stage_map)
+    except ValueError as e:
+        Record("SetStepAmplitude",result=False,strMessage=str(e))
+        return
+    if Apply_Profiles(motion.oCmdLib,stage_map,stage_profiles):
+        Record("SetStepAmplitude",result=True,strMessage="Step amplitude profiles: {}".format(STARTUP_PROFILES))
+    else:
+        Record("SetStepAmplitude",result=False,strMessage="Could not set the step amplitude profiles.")
+
+# <summary>
+# Gives the position estimator the step rates calibrated for the controller, at the step amplitudes the stages are set
+# to (see calibration.py), once the device is open. Runs on the motion I/O thread.
+# </summary>
+def load_calibrations():
+    if not motion.runnable:
+        return
+    store = CalibrationStore()
+    calibrations = dict()
+    for axis in stage_map:
+        calibration = store.Find(Controller_Key(),axis,Current_Amplitudes(motion.oCmdLib,stage_map,axis))
+        if calibration is not None:
+            calibrations[axis] = calibration
+    estimator.Set_Calibrations(calibrations)
+
+# <summary>
+# Exposes the command metrics (see metrics.py) over HTTP and/or as a file, if AGILIS_METRICS_PORT / AGILIS_METRICS_FILE
+# are set. Failing to do so is reported but does not stop the program.
+# </summary>
+def start_metrics():
+    if metrics.METRICS_PORT:
+        try:
+            metrics.Start_Http_Server(int(metrics.METRICS_PORT))
+            print ("Metrics on http://127.0.0.1:%s/metrics\n" % metrics.METRICS_PORT)
+        except (OSError,ValueError) as e:
+            print ("Could not serve the metrics on port %s: %s\n" % (metrics.METRICS_PORT,e))
+    if metrics.METRICS_FILE:
+        metrics.Start_Textfile_Writer(metrics.METRICS_FILE)
+        print ("Metrics written to %s\n" % metrics.METRICS_FILE)
+
+# <summary>
+# GUI entry point: starts the motion I/O thread, opens the device on it, and runs the Tk main loop until the window
+# is closed.
+# </summary>
+def main():
+    global worker, poller, estimator, absolute
+    print ("Python %s\n\n" % (sys.version,))
+    print ("Executing File = %s\n" % os.path.abspath (__file__))
+
+    # The motion events (see events.py) are written to the console and the event log by a background thread, and
+    # dumped if the program crashes.
+    EVENTS.Start()
+    EVENTS.Install_Crash_Handler()
+    # Every start, stop and speed change is recorded, to be replayed with session.py.
+    SESSION.Open()
+
+    # If a command hangs and is abandoned (see motion_worker.py), the channel/jog cache can no longer be trusted.
+    worker = MotionWorker(on_hung=lambda:motion.oCmdLib.Invalidate())
+    metrics.Register_Worker(worker)
+    start_metrics()
+    worker.Submit(Initializer,lane=LANE_STOP,timeout=INITIALIZE_TIMEOUT) # opens devices, begins communication
+    worker.Submit(configure_step_amplitudes,lane=LANE_STOP,timeout=INITIALIZE_TIMEOUT)
+    poller = PositionPoller(worker,moving_stages)
+    estimator = PositionEstimator()
+    worker.Submit(load_calibrations,lane=LANE_STOP,timeout=INITIALIZE_TIMEOUT)
+    absolute = AbsolutePositionService(worker,moving_stages,lambda:poller.snapshot)
+
+    build_gui()
+    root.report_callback_exception = report_callback_exception
+    run_callbacks()
+    show_positions()
+    root.mainloop()
+    print (key_filter.Report ())
+    save_key_recording()
+
+    absolute.Shutdown()
+    poller.Shutdown()
+    worker.Submit(Close_Device,lane=LANE_STOP,timeout=INITIALIZE_TIMEOUT)
+    worker.Shutdown()
+    EVENTS.Shutdown()
+    SESSION.Close()
+    if metrics.METRICS_FILE:
+        metrics.REGISTRY.Write_Textfile(metrics.METRICS_FILE)
+
+if __name__ == "__main__":
+    main()
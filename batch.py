@@ -0,0 +1,357 @@
+######################## Headless batch mode ##############################
+
+# Runs move programs without the GUI, e.g. overnight sequences:
+#
+#     python batch.py program.csv [more programs...] [--dry-run] [--report report.csv] [--simulate]
+#
+# A program is a CSV file with a header line, or a JSON Lines file (.json/.jsonl, one object per line), with the
+# fields command, stage, direction and value. Blank lines and lines starting with # are skipped. Commands:
+#  - jog   stage direction seconds : jogs the stage at its current speed for that long, then stops it;
+#  - step  stage [direction] steps : moves the stage by that many steps (see stepmove.py), and waits until it is
+#                                    there. Backwards: either negative steps or "negative" (then the steps have no
+#                                    sign), not both;
+#  - wait  seconds                 : waits;
+#  - stop  [stage]                 : stops the stage, or all stages if none is given;
+#  - speed stage level             : sets the speed of the stage to a level of speed_list_dict (name or 1-4);
+#  - profile stage name            : switches the stage to a step amplitude profile (see amplitude.py).
+# e.g. (CSV):
+#
+#     command,stage,direction,value
+#     speed,x,,Fast
+#     jog,x,positive,2.5
+#     step,z,negative,200
+#     wait,,,1
+#
+# Programs are read a line at a time while they run, so a program can be as long as needed. Each line is carried out
+# as soon as the previous one is done, through the same motion functions as the GUI (Initializer, Start_Motion,
+# Stop_Motion, Stop_All_Motion) on the motion I/O thread, so the only pacing is the controller's own.
+# With --dry-run, nothing is sent to the controller: every line is checked and its duration estimated.
+# Every line is written to the report (CSV) as soon as it is done: its estimated and actual duration and its result.
+# If a line fails, all motion is stopped and the batch ends.
+
+import argparse
+import collections
+import csv
+import json
+import os
+import sys
+import time
+
+import motion
+from motion import Initializer, Start_Motion, Stop_Motion, Stop_All_Motion
+from motion import stage_map, speed_list_dict, speed_list_dict_z
+from motion_worker import MotionWorker, LANE_STOP
+from aguc8 import STEP_RATES, RELATIVE_STEP_RATE
+from amplitude import STEP_AMPLITUDE_PROFILES, Apply_Profiles
+from estop import AGUC8_CHANNELS
+from events import EVENTS, Record
+from stepmove import StepMover
+
+COMMANDS = ("jog","step","wait","stop","speed","profile")
+FIELDS = ("command","stage","direction","value")
+
+COMMAND_TIME = 0.005       # estimated seconds per controller command (dry run)
+INITIALIZE_TIMEOUT = 60.0  # seconds, see app.py
+STEP_TIMEOUT = 600.0       # seconds a step line may take
+PROFILE_TIMEOUT = 10.0     # seconds a profile line may wait on the motion I/O thread (several controller commands)
+
+REPORT_FIELDS = ("line","command","stage","direction","value","estimated","started","duration","result","message")
+
+# <summary>
+# One program line, checked: value is the duration (jog, wait), the signed number of steps (step), the speed level
+# (speed) or the profile name (profile).
+# </summary>
+Line = collections.namedtuple("Line",["nLine","strCommand","stage","direction","value"])
+
+############################ Reading programs ##############################
+
+# <summary>
+# Checks the fields (a dict, see FIELDS) of line nLine of a program. Returns the Line. Raises ValueError if the line is
+# not valid.
+# </summary>
+def Parse_Line(nLine,fields):
+    def field(strName):
+        value = fields.get(strName)
+        return "" if value is None else str(value).strip()
+
+    strCommand = field("command").lower()
+    stage = field("stage").lower()
+    direction = field("direction").lower()
+    strValue = field("value")
+    try:
+        if strCommand not in COMMANDS:
+            raise ValueError("unknown command {!r}".format(strCommand))
+        if stage not in stage_map and (strCommand not in ("wait","stop") or stage not in ("","all")):
+            raise ValueError("unknown stage {!r}".format(stage))
+        if direction not in ("","positive","negative"):
+            raise ValueError("the direction must be positive or negative")
+        if strCommand == "jog":
+            if direction == "":
+                raise ValueError("a jog needs a direction")
+            value = float(strValue)
+            if value < 0:
+                raise ValueError("the duration cannot be negative")
+        elif strCommand == "step":
+            value = int(strValue)
+            if direction != "" and strValue[:1] in ("-","+"):
+                raise ValueError("the steps cannot be signed when a direction is given")
+            if direction == "negative":
+                value = -value
+        elif strCommand == "wait":
+            value = float(strValue)
+            if value < 0:
+                raise ValueError("the duration cannot be negative")
+        elif strCommand == "speed":
+            levels = speed_list_dict_z if stage == 'z' else speed_list_dict
+            lonames = dict((strName.lower(),nLevel) for (strName,nLevel) in levels.items())
+            if strValue.lower() in lonames:
+                value = lonames[strValue.lower()]
+            elif strValue.isdigit() and int(strValue) in levels.values():
+                value = int(strValue)
+            else:
+                raise ValueError("unknown speed {!r}".format(strValue))
+        elif strCommand == "profile":
+            value = strValue.lower()
+            if value not in STEP_AMPLITUDE_PROFILES:
+                raise ValueError("unknown step amplitude profile {!r}".format(strValue))
+        else:
+            value = None
+    except ValueError as e:
+        raise ValueError("Line {}: {}".format(nLine,e))
+    return Line(nLine,strCommand,"" if stage == "all" else stage,direction,value)
+
+# <summary>
+# Yields the Lines of a program file, reading it a line at a time. .json and .jsonl files are JSON Lines, anything
+# else is CSV with a header line.
+# </summary>
+def Read_Program(strPath):
+    with open(strPath,newline="") as f:
+        if os.path.splitext(strPath)[1].lower() in (".json",".jsonl"):
+            for (nLine,strLine) in enumerate(f,1):
+                if strLine.strip() == "" or strLine.lstrip().startswith("#"):
+                    continue
+                try:
+                    fields = json.loads(strLine)
+                except ValueError as e:
+                    raise ValueError("Line {}: {}".format(nLine,e))
+                if not isinstance(fields,dict):
+                    raise ValueError("Line {}: not a JSON object".format(nLine))
+                yield Parse_Line(nLine,fields)
+        else:
+            reader = csv.reader(f)
+            loheader = None
+            for row in reader:
+                if not row or not "".join(row).strip() or row[0].lstrip().startswith("#"):
+                    continue
+                if loheader is None:
+                    loheader = [strName.strip().lower() for strName in row]
+                    if "command" not in loheader:
+                        raise ValueError("Line {}: the header has no command column".format(reader.line_num))
+                    continue
+                yield Parse_Line(reader.line_num,dict(zip(loheader,row)))
+
+############################ Estimating ##############################
+
+# <summary>
+# Returns the estimated duration (seconds) of a line, and the steps it moves (jog at the speed of the stage in speeds,
+# a dict like motion.axis_speeds, or step), or None.
+# </summary>
+def Estimate(line,speeds):
+    if line.strCommand == "jog":
+        return (line.value + 3*COMMAND_TIME,int(STEP_RATES[speeds[line.stage]]*line.value))
+    if line.strCommand == "step":
+        return (abs(line.value)/RELATIVE_STEP_RATE + 4*COMMAND_TIME,line.value)
+    if line.strCommand == "wait":
+        return (line.value,None)
+    if line.strCommand == "stop":
+        # Stop_All_Motion selects and stops every channel of the controller
+        nChannels = 1 if line.stage else len(AGUC8_CHANNELS)
+        return (3*nChannels*COMMAND_TIME,None)
+    if line.strCommand == "profile":
+        return (3*COMMAND_TIME,None)
+    return (0.0,None)
+
+############################ Running ##############################
+
+class BatchRunner:
+    # <summary>
+    # worker: the MotionWorker that owns the controller (already initialized). mover: a StepMover on that worker.
+    # </summary>
+    def __init__(self,worker,mover):
+        self.worker = worker
+        self.mover = mover
+
+    # <summary>
+    # Carries out a line. Returns (bResult, message).
+    # </summary>
+    def Run_Line(self,line):
+        if line.strCommand == "jog":
+            return self._jog(line)
+        if line.strCommand == "step":
+            nMoved = self.mover.Move(line.stage,line.value).result(timeout=STEP_TIMEOUT)
+            return (nMoved == line.value,"moved {} steps".format(nMoved))
+        if line.strCommand == "wait":
+            time.sleep(line.value)
+            return (True,"")
+        if line.strCommand == "stop":
+            return (self.Stop(line.stage),"")
+        if line.strCommand == "profile":
+            # Several commands per stage, more than the motion lane's deadline allows; a stop still cancels it
+            bStatus = self.worker.Submit(lambda:Apply_Profiles(motion.oCmdLib,stage_map,dict({line.stage:line.value})),
+                                         axes=[line.stage],timeout=PROFILE_TIMEOUT).result()
+            return (bStatus,"")
+        motion.axis_speeds[line.stage] = line.value
+        Record("manage_speeds",line.stage,result=line.value,
+               strMessage="Speed in {} has been set to {}.\n".format(line.stage,line.value))
+        return (True,"")
+
+    def _jog(self,line):
+        bStarted = self.worker.Submit(Start_Motion,line.stage,line.direction,motion.axis_speeds[line.stage],
+                                      axes=[line.stage]).result()
+        if not bStarted:
+            return (False,"could not start")
+        motion.axis_status[line.stage] = True
+        motion.dir_status[line.stage] = line.direction
+        time.sleep(line.value)
+        if not self.Stop(line.stage):
+            return (False,"could not stop")
+        return (True,"")
+
+    # <summary>
+    # Stops the stage, or all stages if stage is "". Returns True if it worked.
+    # </summary>
+    def Stop(self,stage=""):
+        lostages = [stage] if stage else list(stage_map)
+        function = (lambda:Stop_Motion(stage)) if stage else Stop_All_Motion
+        bStopped = self.worker.Submit(function,lane=LANE_STOP,axes=lostages).result()
+        if bStopped:
+            for stage in lostages:
+                motion.axis_status[stage] = False
+                motion.dir_status[stage] = False
+        return bStopped
+
+# <summary>
+# Runs (or with runner None, only estimates) a program, writing a line of the report (a csv.writer) per program line.
+# Returns (bResult, estimated seconds, actual seconds).
+# </summary>
+def Run_Program(strPath,runner,report):
+    speeds = dict(motion.axis_speeds)
+    fEstimated = 0.0
+    tStart = time.perf_counter()
+    for line in Read_Program(strPath):
+        (fEstimate,nSteps) = Estimate(line,speeds)
+        if line.strCommand == "speed":
+            speeds[line.stage] = line.value
+        fEstimated += fEstimate
+        strValue = "" if line.value is None else line.value
+        if runner is None:
+            report.writerow([line.nLine,line.strCommand,line.stage,line.direction,strValue,"%.3f" % fEstimate,
+                             "","","dry run","" if nSteps is None else "about {} steps".format(nSteps)])
+            continue
+        tLine = time.perf_counter()
+        try:
+            (bResult,strMessage) = runner.Run_Line(line)
+        except Exception as e:
+            (bResult,strMessage) = (False,repr(e))
+        tDone = time.perf_counter()
+        report.writerow([line.nLine,line.strCommand,line.stage,line.direction,strValue,"%.3f" % fEstimate,
+                         "%.3f" % (tLine - tStart),"%.3f" % (tDone - tLine),"ok" if bResult else "failed",strMessage])
+        if not bResult:
+            Record(line.strCommand,line.stage,line.direction,False,tDone - tLine,
+                   strMessage="{} line {} failed: {}. Stopping.".format(strPath,line.nLine,strMessage))
+            return (False,fEstimated,time.perf_counter() - tStart)
+    return (True,fEstimated,time.perf_counter() - tStart)
+
+# <summary>
+# Opens the simulated controller (see agilis_sim.py) instead of a real one. Runs on the motion I/O thread.
+# </summary>
+def Open_Simulator():
+    from agilis_sim import SimCmdLibAgilis
+    oSim = SimCmdLibAgilis()
+    oSim.Open("SIM")
+    motion.oCmdLib = motion.Wrap_CmdLib(oSim,"SIM")
+    motion.strDeviceKey = "SIM"
+    motion.strControllerId = "SIM"
+    motion.runnable = True
+    return True
+
+# <summary>
+# Closes the device. Runs on the motion I/O thread.
+# </summary>
+def Close_Device():
+    motion.oCmdLib.Close()
+    print(motion.oCmdLib.Pacing_Report())
+    if motion.oDeviceIO is not None:
+        motion.oDeviceIO.Shutdown()
+
+# <summary>
+# Writes report lines prefixed with the program, and flushes the file after each one, so the report is up to date
+# while a long program runs.
+# </summary>
+class ReportWriter:
+    def __init__(self,report,strPath,f):
+        self.report = report
+        self.strPath = strPath
+        self.f = f
+
+    def writerow(self,row):
+        self.report.writerow([self.strPath] + list(row))
+        self.f.flush()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs move programs (CSV or JSON Lines) without the GUI.")
+    parser.add_argument("programs",nargs="+",help="program files, run one after the other")
+    parser.add_argument("--dry-run",action="store_true",help="only check the programs and estimate their duration")
+    parser.add_argument("--report",default="batch_report.csv",help="where to write the timing report (CSV)")
+    parser.add_argument("--simulate",action="store_true",help="use the simulated controller")
+    args = parser.parse_args(argv)
+
+    worker = None
+    runner = None
+    if not args.dry_run:
+        EVENTS.Start()
+        EVENTS.Install_Crash_Handler()
+        worker = MotionWorker(on_hung=lambda:motion.oCmdLib.Invalidate())
+        if not worker.Submit(Open_Simulator if args.simulate else Initializer,lane=LANE_STOP,
+                             timeout=INITIALIZE_TIMEOUT).result():
+            worker.Shutdown()
+            EVENTS.Shutdown()
+            sys.exit("Could not open the controller.")
+        runner = BatchRunner(worker,StepMover(worker))
+
+    bResult = True
+    try:
+        with open(args.report,"w",newline="") as f:
+            report = csv.writer(f)
+            report.writerow(("program",) + REPORT_FIELDS)
+            for strPath in args.programs:
+                writer = ReportWriter(report,strPath,f)
+                try:
+                    (bResult,fEstimated,fElapsed) = Run_Program(strPath,runner,writer)
+                except (OSError,ValueError) as e:
+                    print("{}: {}".format(strPath,e))
+                    bResult = False
+                    break
+                if runner is None:
+                    print("{}: estimated {:.1f} s".format(strPath,fEstimated))
+                else:
+                    print("{}: {:.1f} s (estimated {:.1f} s){}".format(strPath,fElapsed,fEstimated,
+                                                                      "" if bResult else ", FAILED"))
+                if not bResult:
+                    break
+    except KeyboardInterrupt:
+        bResult = False
+    finally:
+        if runner is not None:
+            if not bResult:
+                runner.Stop()
+            runner.mover.Shutdown()
+            worker.Submit(Close_Device,lane=LANE_STOP,timeout=INITIALIZE_TIMEOUT)
+            worker.Shutdown()
+            EVENTS.Shutdown()
+    print("Report written to {}".format(args.report))
+    if not bResult:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
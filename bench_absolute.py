@@ -0,0 +1,129 @@
+######################## Absolute position benchmark ##############################
+
+# Runs the absolute position service (see absolute.py) against the simulated controller, with measurements shortened
+# to MEASURE_DURATION, and checks that:
+#  - nothing is measured until asked for, then every stage asked for is measured, and the positions match the
+#    simulator;
+#  - a small move does not trigger a measurement, only a move beyond the drift tolerance does, and the cached value
+#    plus the steps moved still locate the stage in between;
+#  - when the operator starts moving during a measurement, the measurement is stopped on the controller within
+#    CANCEL_TARGET milliseconds of Cancel, before the jog starts;
+#  - the aborted stage is measured again in the next idle window, while the stage the operator moved a little is not.
+# Run with: python bench_absolute.py
+
+import time
+
+import motion
+from absolute import AbsolutePositionService, DRIFT_PER_STEP
+from agilis_sim import SimCmdLibAgilis, MEASURE_RANGE, TRAVEL_STEPS
+from motion_worker import MotionWorker, LANE_STOP
+from poller import PositionPoller
+from stepmove import StepMover
+
+COMMAND_LATENCY = 0.001 # seconds per command on the simulated controller
+MEASURE_DURATION = 0.5  # seconds per measurement (two minutes on the controller)
+IDLE_WINDOW = 0.3
+TOLERANCE = 20.0        # steps of drift
+CANCEL_TARGET = 20.0
+
+# <summary>
+# Waits until fnCondition() returns True. Returns the time it took (seconds).
+# </summary>
+def Wait_For(fnCondition,fTimeout=10.0):
+    tStart = time.perf_counter()
+    while not fnCondition():
+        assert time.perf_counter() - tStart < fTimeout, "timed out"
+        time.sleep(0.005)
+    return time.perf_counter() - tStart
+
+def Expected(oSim,stage):
+    (nChannel,nAxis) = motion.stage_map[stage]
+    return round(MEASURE_RANGE*(TRAVEL_STEPS//2 + oSim.Step_Count(nChannel,nAxis))/TRAVEL_STEPS)
+
+def Starts(oSim):
+    return sum(1 for (t,strCommand,args) in oSim.loCommandLog if strCommand == "StartMeasurePosition")
+
+def main():
+    oSim = SimCmdLibAgilis(COMMAND_LATENCY,fMeasureDuration=MEASURE_DURATION)
+    oSim.Open("SIM")
+    oCmdLib = motion.Wrap_CmdLib(oSim)
+    worker = MotionWorker()
+    mover = StepMover(worker,lambda:oCmdLib)
+    jogging = set()
+    service = None
+    fnMoving = lambda:list(jogging) + (service.Measuring() if service is not None else [])
+    poller = PositionPoller(worker,fnMoving,lambda:oCmdLib,fIdleInterval=0.1)
+    service = AbsolutePositionService(worker,fnMoving,lambda:poller.snapshot,lambda:oCmdLib,fTolerance=TOLERANCE,
+                                      fIdleWindow=IDLE_WINDOW,fRefreshWindow=60.0)
+
+    # Moves the stage by nSteps, as moving for the poller and the service meanwhile, like the GUI's axis_status
+    def Step(stage,nSteps):
+        jogging.add(stage)
+        mover.Move(stage,nSteps).result()
+        jogging.discard(stage)
+
+    # Nothing is measured until asked for: the scan moves the stage
+    time.sleep(3*IDLE_WINDOW)
+    assert service.nMeasurements == 0 and Starts(oSim) == 0
+    for stage in motion.stage_map:
+        service.Measure(stage)
+    fStartup = Wait_For(lambda:service.nMeasurements == 3)
+    print("3 stages measured in {:.1f} s once asked for".format(fStartup))
+    for stage in motion.stage_map:
+        assert service.Position(stage) == (Expected(oSim,stage),0,0.0), (stage,service.Position(stage))
+
+    # A small move stays within the tolerance: no measurement
+    Step('x',int(TOLERANCE/DRIFT_PER_STEP/4))
+    time.sleep(3*IDLE_WINDOW)
+    (nValue,nMoved,fDrift) = service.Position('x')
+    print("x moved {} steps: drift {:.1f} steps, {} measurements".format(nMoved,fDrift,service.nMeasurements))
+    assert nMoved == TOLERANCE/DRIFT_PER_STEP/4 and fDrift <= TOLERANCE and service.nMeasurements == 3
+
+    # A large one goes beyond: x is measured again once idle
+    Step('x',int(2*TOLERANCE/DRIFT_PER_STEP))
+    Wait_For(lambda:service.nMeasurements == 4)
+    assert service.Position('x') == (Expected(oSim,'x'),0,0.0), service.Position('x')
+    print("x moved beyond the tolerance: measured again, position {}".format(service.Position('x')[0]))
+
+    # The operator starts z while y is being measured
+    Step('y',int(2*TOLERANCE/DRIFT_PER_STEP))
+    Wait_For(lambda:service.Measuring() == ['y'])
+    time.sleep(MEASURE_DURATION/4)
+    nLog = len(oSim.loCommandLog)
+    tCancel = time.perf_counter()
+    jogging.add('z')
+    assert service.Cancel()
+    (nChannel,nAxis) = motion.stage_map['z']
+    worker.Submit(lambda:oCmdLib.SetChannel(nChannel) and oCmdLib.StartJogging(nAxis,2),axes=['z']).result()
+    lonew = [(t,strCommand,args) for (t,strCommand,args) in oSim.loCommandLog[nLog:]]
+    lostops = [t for (t,strCommand,args) in lonew if strCommand == "StopMotion" and args == (motion.stage_map['y'][1],)]
+    assert lostops, lonew
+    fCancel = 1000*(lostops[0] - tCancel)
+    nStop = [strCommand for (t,strCommand,args) in lonew].index("StopMotion")
+    nJog = [strCommand for (t,strCommand,args) in lonew].index("StartJogging")
+    print("Measurement of y stopped {:.2f} ms after Cancel (target {:.0f} ms)".format(fCancel,CANCEL_TARGET))
+    assert fCancel <= CANCEL_TARGET and nStop < nJog
+    Wait_For(lambda:service.Measuring() == [])
+    assert service.nCancelled == 1 and service.Position('y')[2] == float("inf")
+    time.sleep(2*IDLE_WINDOW)
+    assert service.nMeasurements == 4 # z is still moving
+
+    worker.Submit(lambda:oCmdLib.StopMotion(nAxis),lane=LANE_STOP,axes=['z']).result()
+    jogging.discard('z')
+    Wait_For(lambda:service.nMeasurements == 5)
+    assert service.Position('y') == (Expected(oSim,'y'),0,0.0), service.Position('y')
+    Wait_For(lambda:service.Position('z')[1] == oSim.Step_Count(nChannel,nAxis))
+    time.sleep(2*IDLE_WINDOW)
+    (nValue,nMoved,fDrift) = service.Position('z')
+    assert service.nMeasurements == 5 and fDrift <= TOLERANCE
+    print("y measured again in the next idle window; z moved {} steps, drift {:.1f} steps: not measured".format(
+          nMoved,fDrift))
+    print("{} measurements started, {} completed, {} cancelled".format(Starts(oSim),service.nMeasurements,
+          service.nCancelled))
+
+    service.Shutdown()
+    poller.Shutdown()
+    worker.Shutdown()
+
+if __name__ == "__main__":
+    main()
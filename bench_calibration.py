@@ -0,0 +1,119 @@
+######################## Calibration benchmark ##############################
+
+# Characterizes the step rates of x on the simulated controller (see calibration.py), fits a step size from simulated
+# displacement measurements with noise, and checks that:
+#  - the fitted step rates are within RATE_TOLERANCE of the simulator's STEP_RATES;
+#  - the fitted step size is within SIZE_TOLERANCE of the true one;
+#  - the calibration survives a round trip through the on-disk store;
+#  - a conversion takes less than CONVERSION_TARGET microseconds;
+#  - through the method names of Newport's .NET library (see agilis_dotnet.py), the step rates of DOTNET_LEVELS are
+#    characterized within RATE_TOLERANCE too, and the step amplitudes are set on both directions and read back
+#    (Configure_Step_Amplitudes, Current_Amplitudes), so a calibration records them.
+# Run with: python bench_calibration.py
+
+import os
+import random
+import tempfile
+import time
+
+import motion
+from agilis_sim import SimCmdLibAgilis, DotNetSimCmdLib, STEP_RATES
+from amplitude import Configure_Step_Amplitudes, STEP_AMPLITUDE_PROFILES
+from calibration import CalibrationStore, Calibrator, Current_Amplitudes
+from motion_worker import MotionWorker
+
+COMMAND_LATENCY = 0.001 # seconds per command on the simulated controller
+DURATIONS = (0.1,0.2,0.3)
+RATE_TOLERANCE = 0.05
+TRUE_STEP_SIZE = dict({"positive":0.052,"negative":0.047}) # um per step
+SIZE_TOLERANCE = 0.02
+CONVERSION_TARGET = 5.0
+DOTNET_LEVELS = (2,3)
+
+# <summary>
+# Checks the fitted step rates of the calibration against the simulator's.
+# </summary>
+def Check_Rates(calibration):
+    for direction in ("positive","negative"):
+        for (nLevel,fRate) in sorted(calibration.rates[direction].items()):
+            fError = abs(fRate - STEP_RATES[nLevel])/STEP_RATES[nLevel]
+            assert fError <= RATE_TOLERANCE, (direction,nLevel,fRate,STEP_RATES[nLevel])
+
+# <summary>
+# Characterizes the step rates of DOTNET_LEVELS through the .NET method names: the step counters are read with
+# GetStepsAccumulated.
+# </summary>
+def Check_DotNet_Rates():
+    oSim = SimCmdLibAgilis(COMMAND_LATENCY)
+    oSim.Open("SIM")
+    oCmdLib = motion.Wrap_CmdLib(DotNetSimCmdLib(oSim))
+    worker = MotionWorker()
+    calibration = CalibrationStore(os.path.join(tempfile.mkdtemp(),"calibration.json")).Get("SIM","x")
+    Calibrator(worker,lambda:oCmdLib).Characterize_Rates(calibration,DOTNET_LEVELS,DURATIONS)
+    worker.Shutdown()
+    Check_Rates(calibration)
+    print("Step rates of levels {} characterized through the .NET method names".format(DOTNET_LEVELS))
+
+# <summary>
+# Sets step amplitude profiles through the .NET method names, and checks that the simulated controller got them and
+# that they are read back, with a cold cache, as the amplitudes of a calibration.
+# </summary>
+def Check_DotNet_Amplitudes():
+    oSim = SimCmdLibAgilis(COMMAND_LATENCY)
+    oSim.Open("SIM")
+    settings = dict({"x":STEP_AMPLITUDE_PROFILES["fine"],"z":STEP_AMPLITUDE_PROFILES["coarse"]})
+    worker = MotionWorker()
+    assert worker.Submit(Configure_Step_Amplitudes,motion.Wrap_CmdLib(DotNetSimCmdLib(oSim)),motion.stage_map,
+                         settings).result()
+    for (stage,(nPositive,nNegative)) in settings.items():
+        (nChannel,nAxis) = motion.stage_map[stage]
+        assert oSim.amplitudes[(nChannel,nAxis,True)] == nPositive, stage
+        assert oSim.amplitudes[(nChannel,nAxis,False)] == -nNegative, stage
+        amplitudes = worker.Submit(Current_Amplitudes,motion.Wrap_CmdLib(DotNetSimCmdLib(oSim)),motion.stage_map,
+                                   stage).result()
+        assert amplitudes == (nPositive,nNegative), (stage,amplitudes)
+    worker.Shutdown()
+    print("Step amplitudes set and read back through the .NET method names: {}".format(settings))
+
+def main():
+    oSim = SimCmdLibAgilis(COMMAND_LATENCY)
+    oSim.Open("SIM")
+    oCmdLib = motion.Wrap_CmdLib(oSim)
+    worker = MotionWorker()
+    store = CalibrationStore(os.path.join(tempfile.mkdtemp(),"calibration.json"))
+    calibration = store.Get("SIM","x")
+
+    tStart = time.perf_counter()
+    Calibrator(worker,lambda:oCmdLib).Characterize_Rates(calibration,lodurations=DURATIONS)
+    worker.Shutdown()
+    print("Step rates characterized in {:.1f} s".format(time.perf_counter() - tStart))
+    Check_Rates(calibration)
+
+    # The displacements an operator would read off the camera, with 1 um of reading error
+    rng = random.Random(1)
+    for direction in ("positive","negative"):
+        losteps = [200,400,800,1600,3200]
+        lodisplacements = [nSteps*TRUE_STEP_SIZE[direction] + rng.gauss(0,1.0) for nSteps in losteps]
+        calibration.Fit_Step_Size(direction,losteps,lodisplacements)
+        fError = abs(calibration.um_per_step[direction] - TRUE_STEP_SIZE[direction])/TRUE_STEP_SIZE[direction]
+        assert fError <= SIZE_TOLERANCE, (direction,calibration.um_per_step[direction])
+    print(calibration.Report())
+
+    store.Save()
+    reloaded = CalibrationStore(store.strPath).Get("SIM","x")
+    assert reloaded.To_Dict() == calibration.To_Dict()
+
+    nConversions = 100000
+    tStart = time.perf_counter()
+    for i in range(nConversions):
+        reloaded.Steps(12.5)
+    fConversion = 1e6*(time.perf_counter() - tStart)/nConversions
+    print("Conversion: {:.2f} us (target {:.1f} us); 12.5 um = {} steps, {:.2f} s at level 2".format(
+          fConversion,CONVERSION_TARGET,reloaded.Steps(12.5),reloaded.Jog_Time(12.5,2)))
+    assert fConversion <= CONVERSION_TARGET
+
+    Check_DotNet_Rates()
+    Check_DotNet_Amplitudes()
+
+if __name__ == "__main__":
+    main()
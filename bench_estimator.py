@@ -0,0 +1,146 @@
+######################## Position estimator benchmark ##############################
+
+# Drives a PositionEstimator (see estimator.py) with random jogs of three stages, on a virtual clock. The true step
+# rates differ from the nominal ones by up to TRUE_RATE_ERROR and the events are late or early by up to EVENT_JITTER,
+# like those recorded by the GUI; every COUNTER_PERIOD jogs, one stage's step counter is read. Checks that:
+#  - the true positions are within 3 standard deviations of the estimates at least CONSISTENCY_TARGET of the time;
+#  - the counter reads bound the error, while pure dead reckoning lets it grow (a rate error is the same for every
+#    jog, so without reads the errors add up faster than the estimator's per-jog uncertainty);
+#  - an event or an estimate costs less than UPDATE_TARGET microseconds.
+# It then records a few jogs as the GUI does, in an event log (see events.py), and checks that an estimator following
+# the log ends where one given the same jogs directly does, at the calibrated step rates, and that an absolute
+# measurement's step count is taken in.
+# Run with: python bench_estimator.py
+
+import random
+import time
+
+from absolute import Measurement
+from aguc8 import STEP_RATES
+from calibration import AxisCalibration
+from estimator import PositionEstimator, COUNTER_VARIANCE
+from events import EventLog
+
+STAGES = ("x","y","z")
+JOGS = 3000
+TRUE_RATE_ERROR = 0.04  # relative
+EVENT_JITTER = 0.01     # seconds
+COUNTER_PERIOD = 10
+CONSISTENCY_TARGET = 0.95
+UPDATE_TARGET = 50.0
+CALIBRATED_RATE = 1500.0 # steps/s of x at level 3 in the positive direction
+EVENT_JOG = 0.1          # seconds per jog of the event log check
+
+class VirtualClock:
+    def __init__(self):
+        self.t = 1000.0
+
+    def __call__(self):
+        return self.t
+
+# <summary>
+# Runs the jogs through an estimator. Returns (fraction of the estimates within 3 standard deviations, RMS error in
+# steps, microseconds per update).
+# </summary>
+def Run(bCounters,nSeed=1):
+    rng = random.Random(nSeed)
+    clock = VirtualClock()
+    estimator = PositionEstimator(STAGES,speeds=dict(),oEvents=None,fnClock=clock)
+    true_rates = dict(((stage,direction,nLevel),STEP_RATES[nLevel]*(1 + rng.uniform(-TRUE_RATE_ERROR,TRUE_RATE_ERROR)))
+                      for stage in STAGES for direction in ("positive","negative") for nLevel in (1,2,3))
+    positions = dict((stage,0.0) for stage in STAGES)
+    estimator.Measure(STAGES,[0,0,0],COUNTER_VARIANCE)
+
+    (nConsistent,fSquares,fUpdates,nUpdates) = (0,0.0,0.0,0)
+    for nJog in range(JOGS):
+        stage = rng.choice(STAGES)
+        direction = rng.choice(("positive","negative"))
+        nLevel = rng.choice((1,2,3))
+        fDuration = rng.uniform(0.05,1.0)
+        fRate = true_rates[(stage,direction,nLevel)]
+
+        tStart = time.perf_counter()
+        estimator.Set_Speed(stage,nLevel)
+        estimator.Jog_Started(stage,direction,clock.t + rng.gauss(0,EVENT_JITTER/2))
+        fUpdates += time.perf_counter() - tStart
+        clock.t += fDuration
+        positions[stage] += fRate*fDuration if direction == "positive" else -fRate*fDuration
+        tStart = time.perf_counter()
+        estimator.Jog_Stopped(stage,clock.t + rng.gauss(0,EVENT_JITTER/2))
+        fUpdates += time.perf_counter() - tStart
+        nUpdates += 3
+        clock.t += 0.1
+
+        if bCounters and nJog % COUNTER_PERIOD == 0:
+            counted = rng.choice(STAGES)
+            estimator.Measure([counted],[round(positions[counted])],COUNTER_VARIANCE)
+
+        tStart = time.perf_counter()
+        (x,std) = estimator.Estimate()
+        fUpdates += time.perf_counter() - tStart
+        i = STAGES.index(stage)
+        fError = positions[stage] - x[i]
+        nConsistent += abs(fError) <= 3*std[i]
+        fSquares += fError**2
+    return (nConsistent/JOGS,(fSquares/JOGS)**0.5,1e6*fUpdates/nUpdates)
+
+# <summary>
+# Records jogs in an event log the way app.py does, and checks the estimator that follows the log against one given the
+# same jogs directly.
+# </summary>
+def Check_Events():
+    oEvents = EventLog()
+    calibration = AxisCalibration("SIM","x")
+    calibration.rates["positive"][3] = CALIBRATED_RATE
+    followed = PositionEstimator(STAGES,dict({"x":calibration}),speeds=dict(),oEvents=oEvents)
+    direct = PositionEstimator(STAGES,dict({"x":calibration}),speeds=dict(),oEvents=None)
+    for estimator in (followed,direct):
+        estimator.Measure(STAGES,[0,0,0],COUNTER_VARIANCE)
+
+    oEvents.Record("manage_speeds","x",result=3)
+    oEvents.Record("manage_speeds","y",result=2)
+    oEvents.Record("Start_Motion","x","positive",True)
+    time.sleep(EVENT_JOG)
+    oEvents.Record("Stop_Motion","x",result=True)
+    oEvents.Record("StopMotion","",result=False)         # a failed stop of an unmapped axis: ignored
+    oEvents.Record("Start_Motion","y","negative",True)
+    oEvents.Record("Start_Motion","z","positive","expired") # never started: ignored
+    time.sleep(EVENT_JOG)
+    oEvents.Record("emergency_stop",result=True)
+
+    loevents = oEvents.Snapshot()
+    tEnd = loevents[-1][0] + 1.0
+    direct.Set_Speed("x",3)
+    direct.Set_Speed("y",2)
+    direct.Jog_Started("x","positive",loevents[2][0])
+    direct.Jog_Stopped("x",loevents[3][0])
+    direct.Jog_Started("y","negative",loevents[5][0])
+    direct.Jog_Stopped("y",loevents[7][0])
+    (x,std) = followed.Estimate(tEnd)
+    (xDirect,stdDirect) = direct.Estimate(tEnd)
+    print("Event log: {} events taken in, positions {} (direct: {})".format(
+          followed.nEvents,[round(float(f),1) for f in x],[round(float(f),1) for f in xDirect]))
+    assert followed.nEvents == 6, followed.nEvents
+    assert abs(x - xDirect).max() < 1e-6 and abs(std - stdDirect).max() < 1e-6
+    assert abs(x[0] - CALIBRATED_RATE*(loevents[3][0] - loevents[2][0])) < 1e-6
+    assert abs(x[1] + STEP_RATES[2]*(loevents[7][0] - loevents[5][0])) < 1e-6 and x[2] == 0
+
+    # The step count read at the end of an absolute measurement of x
+    followed.Update_Absolute(dict({"x":Measurement(500,100,tEnd)}))
+    followed.Update_Absolute(dict({"x":Measurement(500,100,tEnd)})) # already taken in
+    (x,std) = followed.Estimate(tEnd)
+    assert abs(x[0] - 100) < 1.0 and followed.nMeasurements == 4, (x[0],followed.nMeasurements)
+
+def main():
+    (fConsistent,fRms,fUpdate) = Run(True)
+    (fDeadConsistent,fDeadRms,fDeadUpdate) = Run(False)
+    print("With counter reads: {:.1%} within 3 sigma, RMS error {:.1f} steps".format(fConsistent,fRms))
+    print("Dead reckoning only: {:.1%} within 3 sigma, RMS error {:.1f} steps".format(fDeadConsistent,fDeadRms))
+    print("Update: {:.1f} us (target {:.1f} us)".format(fUpdate,UPDATE_TARGET))
+    assert fConsistent >= CONSISTENCY_TARGET
+    assert fRms < fDeadRms
+    assert fUpdate <= UPDATE_TARGET
+    Check_Events()
+
+if __name__ == "__main__":
+    main()
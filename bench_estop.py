@@ -0,0 +1,52 @@
+######################## Emergency stop latency benchmark ##############################
+
+# Measures how long it takes Emergency_Stop to halt the moving axes against the simulated controller, and asserts
+# that the worst case stays below STOP_LATENCY_TARGET. Run with: python bench_estop.py [--virtual]
+# With --virtual the simulator runs on virtual time, which makes the numbers exact and identical on every run.
+
+import sys
+
+from agilis_sim import SimCmdLibAgilis, VirtualClock
+from estop import Emergency_Stop
+
+STOP_LATENCY_TARGET = 0.050 # seconds
+REPEATS = 20
+
+stage_map = dict({'x':(1,1),'y':(1,2),'z':(3,1)})
+
+# Combinations of moving stages. z and x/y cannot actually move together (see run_motor in app.py), but the
+# x+y+z case is included as the worst case the stop path can be handed.
+scenarios = [['x'],['y'],['x','y'],['z'],['x','y','z']]
+
+# <summary>
+# Starts the given stages on a fresh simulated controller, then returns the time from calling Emergency_Stop
+# until the last stop command for a moving channel reached the controller.
+# </summary>
+def Measure_Stop_Latency(lomoving,fCommandLatency,bVirtual=False):
+    oCmdLib = SimCmdLibAgilis(fCommandLatency,oClock=VirtualClock() if bVirtual else None)
+    axis_status = dict({'x':False,'y':False,'z':False})
+    for axis in lomoving:
+        (nChannel,nAxis) = stage_map[axis]
+        oCmdLib.SetChannel(nChannel)
+        oCmdLib.StartJogging(nAxis,2)
+        axis_status[axis] = True
+
+    fstart = oCmdLib.oClock.now()
+    (bStatus,lochannel) = Emergency_Stop(oCmdLib,stage_map,axis_status)
+    assert bStatus
+    assert not oCmdLib.Is_Moving()
+    return oCmdLib.loCommandLog[-1][0] - fstart
+
+def main(fCommandLatency=0.005,bVirtual=False):
+    fworst = 0.0
+    for lomoving in scenarios:
+        lolatency = sorted(Measure_Stop_Latency(lomoving,fCommandLatency,bVirtual) for i in range(REPEATS))
+        fworst = max(fworst,lolatency[-1])
+        print("moving = {:<12} median = {:6.1f} ms  max = {:6.1f} ms".format('+'.join(lomoving),
+              1000*lolatency[len(lolatency)//2],1000*lolatency[-1]))
+
+    print("Worst-case stop latency: {:.1f} ms (target {:.0f} ms)".format(1000*fworst,1000*STOP_LATENCY_TARGET))
+    assert fworst < STOP_LATENCY_TARGET, "Emergency stop is too slow!"
+
+if __name__ == "__main__":
+    main(bVirtual="--virtual" in sys.argv)
@@ -0,0 +1,175 @@
+######################## Go-to-position benchmark ##############################
+
+# Sends the same go-to requests, interleaved across the three stages as a script would, to the simulated controller
+# twice:
+#  - one after the other, each waiting for the previous one, with StepMover (see stepmove.py): a channel switch
+#    whenever the stage changes channel, and polls every STEP_POLL_INTERVAL;
+#  - all at once to GotoEngine (see goto.py): grouped by channel, the two axes of a channel moving together, and
+#    polls with backoff.
+# Both move each stage by the distance from where it is (tracked in um) to the target, at the step size of that
+# direction. It checks that both end at the targets, that the engine switches channel less, polls less and is faster,
+# and that an absolute go-to (PA) ends at its target too. The engine's requests are then sent again through the method
+# names of Newport's .NET library (see agilis_dotnet.py), and must end at the same step counters. Last, a go-to is
+# stopped on the controller, and the stop cancels the engine's poll of it: the position the engine tracks must still be
+# where the stage stopped. Run with: python bench_goto.py
+
+import time
+
+import motion
+from aguc8 import RELATIVE_STEP_RATE
+from agilis_sim import SimCmdLibAgilis, DotNetSimCmdLib, MEASURE_RANGE, TRAVEL_STEPS
+from calibration import AxisCalibration
+from goto import GotoEngine
+from motion_worker import MotionWorker, LANE_STOP, LANE_MOTION, LANE_POLL
+from stepmove import StepMover
+
+COMMAND_LATENCY = 0.001 # seconds per command on the simulated controller
+CHANNEL_LATENCY = 0.005 # extra seconds per channel switch
+MEASURE_DURATION = 0.2  # seconds the controller takes to find the position of an absolute move
+STEP_SIZE = dict({"positive":0.05,"negative":0.04}) # um per step
+ABSOLUTE_TARGET = 502   # of 1000: 480 steps from the middle of the simulated travel range
+STOP_TARGET = 20.0      # um: a 400 step go-to of x, stopped STOP_AFTER seconds after it starts
+STOP_AFTER = 0.1
+
+# (stage, target in um), in the order a script asks for them
+REQUESTS = [('x',5.0),('z',-2.0),('y',3.0),('z',4.0),('x',-1.0),('y',-2.5),('z',1.0),('x',2.0),('y',6.0),
+            ('z',-3.0),('x',0.5),('y',1.5)]
+
+def Calibrations():
+    calibrations = dict()
+    for stage in motion.stage_map:
+        calibrations[stage] = AxisCalibration("SIM",stage)
+        calibrations[stage].um_per_step.update(STEP_SIZE)
+    return calibrations
+
+def Setup(fMeasureDuration=0.0,bDotNet=False):
+    oSim = SimCmdLibAgilis(COMMAND_LATENCY,CHANNEL_LATENCY,fMeasureDuration=fMeasureDuration)
+    oSim.Open("SIM")
+    return (oSim,motion.Wrap_CmdLib(DotNetSimCmdLib(oSim) if bDotNet else oSim),MotionWorker())
+
+def Count(oSim,strCommand):
+    return sum(1 for (t,strName,args) in oSim.loCommandLog if strName == strCommand)
+
+# <summary>
+# Returns the number of channel switches the simulated controller saw.
+# </summary>
+def Switches(oSim):
+    lochannels = [args[0] for (t,strCommand,args) in oSim.loCommandLog if strCommand == "SetChannel"]
+    return sum(1 for (nPrevious,nChannel) in zip(lochannels,lochannels[1:]) if nChannel != nPrevious)
+
+# <summary>
+# Returns the steps of every request, and the step counters and positions (um) the stages end at.
+# </summary>
+def Plan(calibrations):
+    counters = dict((stage,0) for stage in motion.stage_map)
+    positions = dict((stage,0.0) for stage in motion.stage_map)
+    losteps = []
+    for (stage,fTarget) in REQUESTS:
+        nSteps = calibrations[stage].Steps(fTarget - positions[stage])
+        losteps.append(nSteps)
+        counters[stage] += nSteps
+        positions[stage] += calibrations[stage].Microns(nSteps)
+    return (losteps,counters,positions)
+
+def Counters(oSim):
+    return dict((stage,oSim.Step_Count(*motion.stage_map[stage])) for stage in motion.stage_map)
+
+def Run_Sequential(calibrations):
+    (oSim,oCmdLib,worker) = Setup()
+    mover = StepMover(worker,lambda:oCmdLib)
+    losteps = Plan(calibrations)[0]
+    tStart = time.perf_counter()
+    for ((stage,fTarget),nSteps) in zip(REQUESTS,losteps):
+        assert mover.Move(stage,nSteps).result() == nSteps
+    fElapsed = time.perf_counter() - tStart
+    mover.Shutdown()
+    worker.Shutdown()
+    return (fElapsed,oSim)
+
+def Run_Engine(calibrations,bDotNet=False):
+    (oSim,oCmdLib,worker) = Setup(bDotNet=bDotNet)
+    engine = GotoEngine(worker,lambda:oCmdLib,calibrations=calibrations)
+    tStart = time.perf_counter()
+    lofutures = [engine.Goto(stage,fTarget) for (stage,fTarget) in REQUESTS]
+    loreached = [future.result(timeout=30) for future in lofutures]
+    fElapsed = time.perf_counter() - tStart
+    for ((stage,fTarget),fReached) in zip(REQUESTS,loreached):
+        assert abs(fReached - fTarget) <= max(STEP_SIZE.values())/2 + 1e-9, (stage,fTarget,fReached)
+    positions = Plan(calibrations)[2]
+    for stage in motion.stage_map:
+        assert abs(engine.Microns(stage,Counters(oSim)[stage]) - positions[stage]) < 1e-9, stage
+    engine.Shutdown()
+    worker.Shutdown()
+    return (fElapsed,oSim)
+
+# <summary>
+# Stops a go-to of x on the controller while the motion worker is busy, so that the engine's next poll of x is queued
+# when the stop command is submitted, and is cancelled by it. Returns (step counter x stopped at, position the engine
+# tracks for it).
+# </summary>
+def Run_Stopped(calibrations):
+    (oSim,oCmdLib,worker) = Setup()
+    engine = GotoEngine(worker,lambda:oCmdLib,calibrations=calibrations)
+    (nChannel,nAxis) = motion.stage_map['x']
+    future = engine.Goto('x',STOP_TARGET)
+    while 'x' not in [request.stage for request in engine.moving.values()]:
+        time.sleep(0.001)
+    time.sleep(STOP_AFTER)
+
+    def Stop(fBusy=0.0):
+        bStatus = oCmdLib.SetChannel(nChannel) and oCmdLib.StopMotion(nAxis)
+        time.sleep(fBusy)
+        return bStatus
+
+    # Stops x, then keeps the worker busy until the engine's poll, due when the move should be over, is queued
+    worker.Submit(Stop,abs(calibrations['x'].Steps(STOP_TARGET))/RELATIVE_STEP_RATE,lane=LANE_POLL,timeout=1.0)
+    while not worker.Pending()[LANE_MOTION]:
+        time.sleep(0.001)
+    assert worker.Submit(Stop,lane=LANE_STOP,axes=['x']).result()
+    assert future.exception(timeout=5) is not None, "The stopped go-to succeeded."
+    nCount = oSim.Step_Count(nChannel,nAxis)
+    fTracked = engine.Microns('x',nCount)
+    engine.Shutdown()
+    worker.Shutdown()
+    return (nCount,fTracked)
+
+def main():
+    calibrations = Calibrations()
+    expected = Plan(calibrations)[1]
+
+    (fSequential,oSequential) = Run_Sequential(calibrations)
+    (fEngine,oEngine) = Run_Engine(calibrations)
+    assert Counters(oSequential) == expected, Counters(oSequential)
+    assert Counters(oEngine) == expected, Counters(oEngine)
+    for (strName,fElapsed,oSim) in (("One after the other",fSequential,oSequential),("Go-to engine",fEngine,oEngine)):
+        print("{:<20} {:6.0f} ms, {:2} channel switches, {:3} status polls".format(
+              strName,1000*fElapsed,Switches(oSim),Count(oSim,"GetAxisStatus")))
+    assert Switches(oEngine) < Switches(oSequential)
+    assert Count(oEngine,"GetAxisStatus") < Count(oSequential,"GetAxisStatus")
+    assert fEngine < fSequential
+
+    # Absolute go-to: the controller finds the position first, then steps to the target
+    (oSim,oCmdLib,worker) = Setup(MEASURE_DURATION)
+    engine = GotoEngine(worker,lambda:oCmdLib,calibrations=calibrations)
+    tStart = time.perf_counter()
+    nReached = engine.Goto('z',ABSOLUTE_TARGET,bAbsolute=True).result(timeout=30)
+    fElapsed = time.perf_counter() - tStart
+    nCount = oSim.Step_Count(*motion.stage_map['z'])
+    assert nReached == ABSOLUTE_TARGET, nReached
+    assert (TRAVEL_STEPS//2 + nCount)*MEASURE_RANGE == ABSOLUTE_TARGET*TRAVEL_STEPS, nCount
+    print("Absolute go-to of z to {}/1000 in {:.0f} ms ({:.0f} ms to find the position), {} status polls".format(
+          ABSOLUTE_TARGET,1000*fElapsed,1000*MEASURE_DURATION,Count(oSim,"GetAxisStatus")))
+    engine.Shutdown()
+    worker.Shutdown()
+
+    (fDotNet,oDotNet) = Run_Engine(calibrations,bDotNet=True)
+    assert Counters(oDotNet) == expected, Counters(oDotNet)
+    print("Go-to engine through the .NET method names: {:.0f} ms, same step counters".format(1000*fDotNet))
+
+    (nCount,fTracked) = Run_Stopped(calibrations)
+    assert 0 < nCount < calibrations['x'].Steps(STOP_TARGET), nCount
+    assert abs(fTracked - calibrations['x'].Microns(nCount)) < 1e-9, (nCount,fTracked)
+    print("Go-to of x stopped at step {}: tracked at {:.2f} um".format(nCount,fTracked))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+######################## Import time benchmark ##############################
+
+# Measures how long a fresh interpreter takes to import the motion library (and the GUI module, without starting it),
+# and checks that neither import pulls in the CLR, Tk windows or NumPy. Run with: python bench_import.py
+
+import subprocess
+import sys
+
+IMPORT_TIME_TARGET = 0.100 # seconds, for the motion library
+REPEATS = 10
+
+# Modules that must only be loaded on first use.
+LAZY_MODULES = ["clr", "numpy"]
+
+PROBE = """
+import sys, time
+tStart = time.perf_counter()
+import {module}
+fElapsed = time.perf_counter() - tStart
+print(fElapsed, ",".join(name for name in {lazy!r} if name in sys.modules), "tkinter" in sys.modules)
+"""
+
+# <summary>
+# Imports strModule in REPEATS fresh interpreters. Returns (best import time, lazy modules that were loaded,
+# whether tkinter was loaded).
+# </summary>
+def Measure_Import(strModule):
+    lotimes = []
+    for i in range(REPEATS):
+        strOutput = subprocess.run([sys.executable,"-c",PROBE.format(module=strModule,lazy=LAZY_MODULES)],
+                                   capture_output=True,text=True,check=True).stdout.split()
+        lotimes.append(float(strOutput[0]))
+    strLoaded = strOutput[1] if len(strOutput) == 3 else ""
+    return (min(lotimes),strLoaded,strOutput[-1] == "True")
+
+def main():
+    (fMotion,strLoaded,bTk) = Measure_Import("motion")
+    print("import motion: {:.1f} ms (target {:.0f} ms)".format(1000*fMotion,1000*IMPORT_TIME_TARGET))
+    assert not strLoaded, "import motion loaded {}".format(strLoaded)
+    assert not bTk, "import motion loaded tkinter"
+    assert fMotion < IMPORT_TIME_TARGET, "import motion is too slow!"
+
+    (fApp,strLoaded,bTk) = Measure_Import("app")
+    print("import app:    {:.1f} ms".format(1000*fApp))
+    assert not strLoaded, "import app loaded {}".format(strLoaded)
+
+if __name__ == "__main__":
+    main()
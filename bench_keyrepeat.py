@@ -0,0 +1,176 @@
+######################## Key auto-repeat stress test ##############################
+
+# Replays key event streams through KeyRepeatFilter (see keyrepeat.py) on virtual time, and checks that every held key
+# turns into exactly one start and one stop. For each stream it prints how many events were suppressed, and how many
+# controller transactions run_motor/stop_motor would have sent with and without the filter.
+#
+# Built-in streams model the auto-repeat of X11 (release/press pairs) and Windows (repeated presses), taps, and two
+# keys held at once. Streams recorded from the GUI (run app.py with AGILIS_KEY_RECORDING=<file>) can be replayed too:
+#
+#     python bench_keyrepeat.py [recording.json ...]
+
+import json
+import sys
+import time
+
+from keyrepeat import KeyRepeatFilter, RELEASE_WINDOW
+
+REPEAT_DELAY = 500    # ms before a held key starts repeating
+REPEAT_INTERVAL = 33  # ms between two repeats
+TRANSACTIONS = 2      # SetChannel + StartJogging / StopMotion per start or stop
+STRESS_REPEATS = 200  # the built-in streams are also replayed this many times back to back
+
+# <summary>
+# Stands in for Tk's after/after_cancel on virtual time (ms).
+# </summary>
+class VirtualScheduler:
+    def __init__(self):
+        self.t = 0.0
+        self.timers = dict()
+        self.nNextId = 0
+
+    def after(self,nDelay,function):
+        self.nNextId += 1
+        self.timers[self.nNextId] = (self.t + nDelay,function)
+        return self.nNextId
+
+    def after_cancel(self,nId):
+        self.timers.pop(nId,None)
+
+    def clock(self):
+        return self.t/1000
+
+    # <summary>
+    # Moves time forward to t, running the timers that are due on the way, in order.
+    # </summary>
+    def Advance_To(self,t):
+        while self.timers:
+            (nId,(tDue,function)) = min(self.timers.items(),key=lambda item:item[1][0])
+            if tDue > t:
+                break
+            del self.timers[nId]
+            self.t = tDue
+            function()
+        self.t = max(self.t,t)
+
+# <summary>
+# A key held for fDuration ms, with X11 auto-repeat: release/press pairs at the same time.
+# </summary>
+def X11_Hold(key,tStart,fDuration):
+    loevents = [(tStart,"press",key)]
+    t = tStart + REPEAT_DELAY
+    while t < tStart + fDuration:
+        loevents += [(t,"release",key),(t,"press",key)]
+        t += REPEAT_INTERVAL
+    return loevents + [(tStart + fDuration,"release",key)]
+
+# <summary>
+# A key held for fDuration ms, with Windows auto-repeat: repeated presses, one release.
+# </summary>
+def Windows_Hold(key,tStart,fDuration):
+    loevents = [(tStart,"press",key)]
+    t = tStart + REPEAT_DELAY
+    while t < tStart + fDuration:
+        loevents.append((t,"press",key))
+        t += REPEAT_INTERVAL
+    return loevents + [(tStart + fDuration,"release",key)]
+
+def Taps(key,nTaps,fHold=80,fGap=150):
+    loevents = []
+    for i in range(nTaps):
+        loevents += [(i*(fHold+fGap),"press",key),(i*(fHold+fGap)+fHold,"release",key)]
+    return loevents
+
+# name -> (events, number of holds)
+STREAMS = dict({
+    "x11 hold 2 s":     (X11_Hold(('x','positive'),0,2000),1),
+    "windows hold 2 s": (Windows_Hold(('x','positive'),0,2000),1),
+    "taps":             (Taps(('y','negative'),10),10),
+    "x11 x then y":     (sorted(X11_Hold(('x','positive'),0,3000) + X11_Hold(('y','positive'),1000,1000),
+                                key=lambda event:event[0]),2),
+    "x11 short holds":  (X11_Hold(('x','negative'),0,700) + X11_Hold(('x','negative'),1000,900),2),
+})
+
+# <summary>
+# Counts the transactions run_motor/stop_motor would send for the given (kind, key) calls: a start only if the axis
+# is not already moving, a stop only if it is moving in that direction.
+# </summary>
+def Transactions(localls):
+    requested = dict()
+    nTransactions = 0
+    for (strKind,(axis,direction)) in localls:
+        if strKind == "press" and not requested.get(axis):
+            requested[axis] = direction
+            nTransactions += TRANSACTIONS
+        elif strKind == "release" and requested.get(axis) == direction:
+            requested[axis] = False
+            nTransactions += TRANSACTIONS
+    return nTransactions
+
+# <summary>
+# Replays loevents (time in ms, kind, key) through a new filter. Returns (filter, calls passed on, seconds spent).
+# </summary>
+def Replay(loevents):
+    scheduler = VirtualScheduler()
+    localls = []
+    key_filter = KeyRepeatFilter(scheduler.after,scheduler.after_cancel,
+                                 lambda key:localls.append(("press",key)),lambda key:localls.append(("release",key)),
+                                 fnClock=scheduler.clock)
+    tStart = time.perf_counter()
+    for (t,strKind,key) in loevents:
+        scheduler.Advance_To(t)
+        if strKind == "press":
+            key_filter.Press(key)
+        else:
+            key_filter.Release(key)
+    scheduler.Advance_To(scheduler.t + RELEASE_WINDOW) # lets the last release window expire
+    return (key_filter,localls,time.perf_counter() - tStart)
+
+# <summary>
+# Checks that the calls passed on alternate press/release for every key, and that no key is left held.
+# </summary>
+def Check(key_filter,localls,nHolds=None):
+    state = dict()
+    for (strKind,key) in localls:
+        assert state.get(key,"release") != strKind, "{} passed on twice in a row for {}".format(strKind,key)
+        state[key] = strKind
+    assert not key_filter.held and not key_filter.pending, "keys left held: {}".format(key_filter.held)
+    if nHolds is not None:
+        assert key_filter.nPresses == nHolds, "{} starts for {} holds".format(key_filter.nPresses,nHolds)
+        assert key_filter.nReleases == nHolds, "{} stops for {} holds".format(key_filter.nReleases,nHolds)
+
+def Load_Recording(strPath):
+    with open(strPath) as f:
+        return [(t,strKind,(axis,direction)) for (t,strKind,axis,direction) in json.load(f)]
+
+def Run(strName,loevents,nHolds=None):
+    (key_filter,localls,fElapsed) = Replay(loevents)
+    Check(key_filter,localls,nHolds)
+    stats = key_filter.Stats()
+    print("{:<18} {:6} events {:6} suppressed ({:6.1f}/s)  transactions {:6} -> {:4}  {:5.2f} us/event".format(
+          strName,stats["events"],stats["suppressed"],stats["suppressed_rate"],
+          Transactions([(strKind,key) for (t,strKind,key) in loevents]),Transactions(localls),
+          1e6*fElapsed/max(1,len(loevents))))
+
+def main(lopaths):
+    print("Release window {} ms, auto-repeat after {} ms every {} ms:".format(RELEASE_WINDOW,REPEAT_DELAY,
+                                                                           REPEAT_INTERVAL))
+    for (strName,(loevents,nHolds)) in STREAMS.items():
+        Run(strName,loevents,nHolds)
+
+    # All the built-in streams back to back, many times over
+    lostress = []
+    nHolds = 0
+    tOffset = 0.0
+    for i in range(STRESS_REPEATS):
+        for (loevents,nStreamHolds) in STREAMS.values():
+            lostress += [(tOffset + t,strKind,key) for (t,strKind,key) in loevents]
+            tOffset = lostress[-1][0] + 1000
+            nHolds += nStreamHolds
+    Run("stress",lostress,nHolds)
+
+    for strPath in lopaths:
+        Run(strPath,Load_Recording(strPath))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
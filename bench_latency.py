@@ -0,0 +1,183 @@
+######################## End-to-end latency benchmark ##############################
+
+# Drives the real GUI callbacks of app.py (run_motor, stop_motor, manage_speeds, emergency_stop_button) against the
+# simulated controller, through the whole hot path (motion I/O worker, channel cache, pacing), and measures the time
+# from the callback being called to the command reaching the controller:
+#  - start:     run_motor ('x') -> StartJogging
+#  - stop:      stop_motor ('x') -> StopMotion
+#  - speed:     manage_speeds ('x') on a moving axis, then stop_motor + run_motor, as the operator does to apply the
+#               new speed -> StartJogging at the new speed
+#  - emergency: emergency_stop_button -> StopMotion of the moving axis
+# The callbacks are called directly. If a display is available, they act on the real widgets (build_gui), otherwise on
+# stand-in buttons. The position poller and the absolute position service run in the background, as they do in the
+# GUI.
+#
+# With --dotnet, the simulated controller is driven through the method names of Newport's .NET library (see
+# agilis_dotnet.py), as on the default Windows setup. Either way, the poller must have published positions by the end.
+#
+# Results (p50/p99/max in ms) are printed and written as JSON. With --baseline, they are compared to an earlier run
+# and the benchmark fails if any p99 got worse by more than the tolerance:
+#
+#     python bench_latency.py --output baseline.json
+#     ...
+#     python bench_latency.py --baseline baseline.json
+
+import argparse
+import contextlib
+import io
+import json
+import sys
+import time
+
+import app
+import motion
+from absolute import AbsolutePositionService
+from agilis_sim import SimCmdLibAgilis, DotNetSimCmdLib
+from motion_worker import MotionWorker
+from poller import PositionPoller
+
+COMMAND_LATENCY = 0.002 # seconds per command on the simulated controller
+REPEATS = 100
+TOLERANCE = 0.25        # allowed relative p99 regression against the baseline
+TOLERANCE_MS = 1.0      # plus this much, so that sub-millisecond jitter is not a regression
+
+# <summary>
+# Stands in for a Tk button when no display is available.
+# </summary>
+class StandInButton:
+    def __init__(self):
+        self.options = dict()
+
+    def config(self,**kwargs):
+        self.options.update(kwargs)
+
+def Setup(bDotNet=False):
+    oSim = SimCmdLibAgilis(COMMAND_LATENCY)
+    oSim.Open("SIM")
+    motion.oCmdLib = motion.Wrap_CmdLib(DotNetSimCmdLib(oSim) if bDotNet else oSim)
+    motion.runnable = True
+    app.worker = MotionWorker(on_hung=lambda:motion.oCmdLib.Invalidate())
+    app.poller = PositionPoller(app.worker,app.moving_stages)
+    app.absolute = AbsolutePositionService(app.worker,app.moving_stages,lambda:app.poller.snapshot)
+    try:
+        app.build_gui()
+        strWidgets = "Tk widgets"
+    except Exception:
+        app.mydict = dict(((axis,direction),StandInButton()) for axis in "xyz" for direction in ("positive","negative"))
+        strWidgets = "stand-in buttons (no display)"
+    return (oSim,strWidgets)
+
+# <summary>
+# Runs the worker's callbacks (as the Tk loop would) until condition() is True.
+# </summary>
+def Wait_For(condition,fTimeout=5.0):
+    tDeadline = time.perf_counter() + fTimeout
+    while not condition():
+        app.worker.Run_Callbacks()
+        if time.perf_counter() > tDeadline:
+            raise TimeoutError("The GUI state did not update in time.")
+        time.sleep(0.0002)
+
+# <summary>
+# Returns the arrival time of the first command in the log, from index nStart on, that matches strCommand and args.
+# </summary>
+def Arrival(oSim,nStart,strCommand,args,fTimeout=5.0):
+    tDeadline = time.perf_counter() + fTimeout
+    while time.perf_counter() < tDeadline:
+        for (tArrival,strLogged,logged_args) in oSim.loCommandLog[nStart:]:
+            if strLogged == strCommand and logged_args == args:
+                return tArrival
+        time.sleep(0.0002)
+    raise TimeoutError("{}{} did not reach the controller.".format(strCommand,args))
+
+def Measure(oSim):
+    latencies = dict({"start":[], "stop":[], "speed":[], "emergency":[]})
+    speeds = [2,3]
+    for i in range(REPEATS):
+        nSpeed = speeds[i % 2]
+        app.manage_speeds('x',nSpeed)
+
+        nStart = len(oSim.loCommandLog)
+        tStart = time.perf_counter()
+        app.run_motor('x','positive')
+        latencies["start"].append(Arrival(oSim,nStart,"StartJogging",(1,nSpeed)) - tStart)
+        Wait_For(lambda:motion.axis_status['x'])
+
+        nStart = len(oSim.loCommandLog)
+        tStart = time.perf_counter()
+        app.manage_speeds('x',speeds[(i+1) % 2])
+        app.stop_motor('x','positive')
+        app.run_motor('x','positive')
+        latencies["speed"].append(Arrival(oSim,nStart,"StartJogging",(1,speeds[(i+1) % 2])) - tStart)
+        Wait_For(lambda:motion.axis_status['x'])
+
+        nStart = len(oSim.loCommandLog)
+        tStart = time.perf_counter()
+        if i % 2 == 0:
+            app.stop_motor('x','positive')
+            latencies["stop"].append(Arrival(oSim,nStart,"StopMotion",(1,)) - tStart)
+        else:
+            app.emergency_stop_button()
+            latencies["emergency"].append(Arrival(oSim,nStart,"StopMotion",(1,)) - tStart)
+        Wait_For(lambda:not motion.axis_status['x'] and not app.requested_status['x'])
+        # Let the idle channel sweep of an emergency stop finish before the next round
+        Wait_For(lambda:not any(app.worker.Pending().values()) and app.worker.running is None)
+
+    results = dict()
+    for (strPath,lolatency) in latencies.items():
+        lolatency = sorted(lolatency)
+        results[strPath] = dict({"p50":1000*lolatency[len(lolatency)//2],
+                                 "p99":1000*lolatency[int(0.99*(len(lolatency)-1))],
+                                 "max":1000*lolatency[-1], "n":len(lolatency)})
+    return results
+
+# <summary>
+# Returns the list of paths whose p99 regressed against the baseline.
+# </summary>
+def Compare(results,baseline):
+    loregressions = []
+    for (strPath,result) in results.items():
+        if strPath not in baseline:
+            continue
+        fLimit = baseline[strPath]["p99"]*(1+TOLERANCE) + TOLERANCE_MS
+        strVerdict = "ok"
+        if result["p99"] > fLimit:
+            strVerdict = "REGRESSION"
+            loregressions.append(strPath)
+        print("  {:<10} p99 = {:6.2f} ms, baseline {:6.2f} ms (limit {:6.2f} ms) {}".format(
+              strPath,result["p99"],baseline[strPath]["p99"],fLimit,strVerdict))
+    return loregressions
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end latency benchmark of the GUI motion callbacks.")
+    parser.add_argument("--output",default="bench_latency.json",help="where to write the results (JSON)")
+    parser.add_argument("--baseline",help="results of an earlier run to compare against")
+    parser.add_argument("--dotnet",action="store_true",help="use the method names of the .NET library")
+    args = parser.parse_args()
+
+    (oSim,strWidgets) = Setup(args.dotnet)
+    with contextlib.redirect_stdout(io.StringIO()): # the callbacks print on every event
+        results = Measure(oSim)
+    assert 'x' in app.poller.snapshot, "the poller published no position"
+    app.absolute.Shutdown()
+    app.poller.Shutdown()
+    app.worker.Shutdown()
+
+    print("Keypress-to-controller latency ({} rounds, {:.0f} ms per command, {}{}):".format(
+          REPEATS,1000*COMMAND_LATENCY,strWidgets,", .NET method names" if args.dotnet else ""))
+    for (strPath,result) in results.items():
+        print("  {:<10} p50 = {:6.2f} ms  p99 = {:6.2f} ms  max = {:6.2f} ms".format(
+              strPath,result["p50"],result["p99"],result["max"]))
+    with open(args.output,"w") as f:
+        json.dump(dict({"command_latency":COMMAND_LATENCY,"results":results}),f,indent=2)
+    print("Results written to {}".format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        print("Compared to {}:".format(args.baseline))
+        if Compare(results,baseline):
+            sys.exit("Latency regression!")
+
+if __name__ == "__main__":
+    main()
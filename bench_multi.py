@@ -0,0 +1,51 @@
+######################## Multi-controller scaling benchmark ##############################
+
+# Drives 1, 2 and 3 simulated controllers through one MotionEngine and measures the commands per second that reach
+# the controllers. Each controller has its own I/O thread, so the rate should scale linearly with the number of
+# controllers. Run with: python bench_multi.py
+
+import time
+
+import motion
+from agilis_sim import SimCmdLibAgilis
+from controllers import Controller, MotionEngine
+
+COMMAND_LATENCY = 0.002 # seconds per command on each simulated controller
+JOGS = 400              # jog commands per controller
+SCALING_TARGET = 0.8    # minimum fraction of perfectly linear scaling
+
+# <summary>
+# Returns the number of controller commands per second achieved with nControllers controllers.
+# </summary>
+def Measure_Rate(nControllers):
+    engine = MotionEngine()
+    losims = []
+    for i in range(nControllers):
+        oSim = SimCmdLibAgilis(COMMAND_LATENCY)
+        losims.append(oSim)
+        engine.Add_Controller(Controller("C{}".format(i),motion.Wrap_CmdLib(oSim)))
+        engine.Map_Stage("stage{}".format(i),"C{}".format(i),1,1)
+
+    tStart = time.perf_counter()
+    lofutures = []
+    # Alternating speeds, so that the channel/jog cache cannot skip any of the jog commands. (Stops are not used
+    # here: a stop cancels the jog commands still queued for its stage.)
+    for j in range(JOGS):
+        for i in range(nControllers):
+            lofutures.append(engine.Start_Motion("stage{}".format(i),'positive',2+j%2,timeout=60.0))
+    for future in lofutures:
+        assert future.result()
+    fElapsed = time.perf_counter() - tStart
+    engine.Close()
+    return sum(len(oSim.loCommandLog) for oSim in losims) / fElapsed
+
+def main():
+    fSingle = Measure_Rate(1)
+    print("1 controller:  {:7.0f} commands/s".format(fSingle))
+    for nControllers in (2,3):
+        fRate = Measure_Rate(nControllers)
+        print("{} controllers: {:7.0f} commands/s ({:.2f}x)".format(nControllers,fRate,fRate/fSingle))
+        assert fRate > SCALING_TARGET*nControllers*fSingle, "Commands per second do not scale with controllers!"
+
+if __name__ == "__main__":
+    main()
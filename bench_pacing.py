@@ -0,0 +1,84 @@
+######################## Command pacing benchmark ##############################
+
+# Sends a burst of jog commands (alternating speeds, so that the cache sends every one) to a simulated controller that
+# needs READY_TIME after a jog command before it takes the next one. Like the AG-UC8, it does not say so in its answer
+# to the command: a jog that comes too early is not carried out, and only the error code (TE) tells. The burst is sent
+# twice, through the cache and PacedCmdLib (see pacing.py):
+#  - without error queries: nothing tells the pacing that the controller is struggling, and most jogs are lost;
+#  - with the error queries of Wrap_CmdLib: the pacing learns the gap the controller needs, and it checks that fewer
+#    than REFUSED_TARGET of the jogs of the second half of the burst are refused.
+# Run with: python bench_pacing.py
+
+import time
+
+import motion
+from agilis_cache import CachedCmdLib
+from agilis_sim import SimCmdLibAgilis
+from pacing import PacedCmdLib
+
+COMMAND_LATENCY = 0.001 # seconds per command on the simulated controller
+READY_TIME = 0.005      # seconds the simulated controller needs after a jog command
+COMMANDS = 200
+REFUSED_TARGET = 0.2
+
+# <summary>
+# A simulated controller that refuses a jog command sent less than fReadyTime after the previous one, and reports it
+# only through its error code.
+# </summary>
+class BusySimCmdLib(SimCmdLibAgilis):
+    def __init__(self,fCommandLatency,fReadyTime):
+        super().__init__(fCommandLatency)
+        self.fReadyTime = fReadyTime
+        self.tReady = 0.0
+        self.nError = 0
+        self.lorefused = [] # True for every jog command that was refused, in order
+
+    def StartJogging(self,nAxis,nJogSpeed):
+        if self.oClock.now() + self.fCommandLatency < self.tReady:
+            self._command("StartJogging",nAxis,nJogSpeed)
+            self.nError = -6 # not allowed in current state
+            self.lorefused.append(True)
+            return True
+        bStatus = super().StartJogging(nAxis,nJogSpeed)
+        self.tReady = self.oClock.now() + self.fReadyTime
+        self.lorefused.append(False)
+        return bStatus
+
+    def GetErrorCode(self):
+        self._command("GetErrorCode")
+        (nError,self.nError) = (self.nError,0)
+        return (True,nError)
+
+# <summary>
+# Sends the burst through oCmdLib. Returns (seconds taken, fraction of the jogs of the second half that were refused).
+# </summary>
+def Burst(oSim,oCmdLib):
+    (nChannel,nAxis) = motion.stage_map['x']
+    assert oCmdLib.SetChannel(nChannel)
+    tStart = time.perf_counter()
+    for i in range(COMMANDS):
+        oCmdLib.StartJogging(nAxis,2 if i % 2 == 0 else 3)
+    fElapsed = time.perf_counter() - tStart
+    lohalf = oSim.lorefused[COMMANDS//2:]
+    return (fElapsed,sum(lohalf)/len(lohalf))
+
+def main():
+    oSim = BusySimCmdLib(COMMAND_LATENCY,READY_TIME)
+    oSim.Open("SIM")
+    oPaced = PacedCmdLib(oSim,lochecked=())
+    (fUnchecked,fUncheckedRefused) = Burst(oSim,CachedCmdLib(oPaced))
+    print("Without error queries: {:5.0f} ms, {:3.0f}% of the jogs refused; {}".format(
+          1000*fUnchecked,100*fUncheckedRefused,oPaced.Pacing_Report()))
+
+    oSim = BusySimCmdLib(COMMAND_LATENCY,READY_TIME)
+    oSim.Open("SIM")
+    oCmdLib = motion.Wrap_CmdLib(oSim)
+    (fChecked,fCheckedRefused) = Burst(oSim,oCmdLib)
+    print("With error queries:    {:5.0f} ms, {:3.0f}% of the jogs refused; {}".format(
+          1000*fChecked,100*fCheckedRefused,oCmdLib.Pacing_Report()))
+    assert oCmdLib.Pacing_Stats()["error_queries"] == COMMANDS
+    assert fCheckedRefused < REFUSED_TARGET, "The pacing did not learn the gap the controller needs!"
+    assert fCheckedRefused < fUncheckedRefused
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+######################## Channel switch planner benchmark ##############################
+
+# Carries out the same move program on the simulated controller twice, with StepMover (see stepmove.py):
+#  - as written: one move after the other, in program order;
+#  - planned (see planner.py): reordered and batched to switch channels as rarely as the constraints allow.
+# It checks that the plan keeps the constraints, that both runs end at the same positions, that the planned run
+# switches channel as often as the plan estimated, and that it is faster. Last, it runs a plan whose first batch
+# fails, and checks that the batches after it are cancelled without reaching the controller.
+# Run with: python bench_planner.py
+
+import time
+from concurrent.futures import wait
+
+import motion
+from aguc8 import MAX_RELATIVE_STEPS
+from agilis_sim import SimCmdLibAgilis
+from motion_worker import MotionWorker
+from planner import BARRIER, Plan, Execute_Plan, Switch_Cost
+from stepmove import StepMover
+
+COMMAND_LATENCY = 0.001 # seconds per command on the simulated controller
+CHANNEL_LATENCY = 0.005 # extra seconds per channel switch
+
+# Focus (z) and position (x, y) moves interleaved, as a program typed in by hand would be. Move 3 (y) must follow move
+# 2 (z), and nothing crosses the barrier.
+PROGRAM = [('x',20),('z',-30),('z',10),('y',15),('x',-10),('z',5),('y',-20),BARRIER,
+           ('z',15),('x',30),('z',-5),('y',40),('x',-25),('z',10),('y',10)]
+CONSTRAINTS = [(2,3)]
+STEPS = [item[1] for item in PROGRAM if item != BARRIER]
+
+def Setup():
+    oSim = SimCmdLibAgilis(COMMAND_LATENCY,CHANNEL_LATENCY)
+    oSim.Open("SIM")
+    oCmdLib = motion.Wrap_CmdLib(oSim)
+    worker = MotionWorker()
+    return (oSim,oCmdLib,worker,StepMover(worker,lambda:oCmdLib))
+
+# <summary>
+# Returns the number of channel switches the simulated controller saw.
+# </summary>
+def Switches(oSim):
+    lochannels = [args[0] for (t,strCommand,args) in oSim.loCommandLog if strCommand == "SetChannel"]
+    return sum(1 for (nPrevious,nChannel) in zip(lochannels,lochannels[1:]) if nChannel != nPrevious)
+
+def Positions(oSim):
+    return dict((stage,oSim.Step_Count(nChannel,nAxis)) for (stage,(nChannel,nAxis)) in motion.stage_map.items())
+
+# <summary>
+# Checks that the plan keeps the order of the moves of each stage, the barrier and the constraints.
+# </summary>
+def Check_Order(plan):
+    nPosition = dict()
+    for (nBatch,batch) in enumerate(plan.lobatches):
+        for (i,stage,nSteps) in batch:
+            nPosition[i] = nBatch
+    lomoves = [i for (i,item) in enumerate(PROGRAM) if item != BARRIER]
+    nBarrier = PROGRAM.index(BARRIER)
+    for i in lomoves:
+        for j in lomoves:
+            if i < j and (PROGRAM[i][0] == PROGRAM[j][0] and nPosition[i] > nPosition[j] or
+                          i < nBarrier < j and nPosition[i] >= nPosition[j]):
+                raise AssertionError("Moves {} and {} are out of order".format(i,j))
+    for (i,j) in CONSTRAINTS:
+        assert nPosition[i] < nPosition[j], (i,j)
+
+def As_Written():
+    (oSim,oCmdLib,worker,mover) = Setup()
+    tStart = time.perf_counter()
+    lofutures = [mover.Move(*item) for item in PROGRAM if item != BARRIER]
+    lomoved = [future.result(timeout=10) for future in lofutures]
+    fElapsed = time.perf_counter() - tStart
+    assert lomoved == STEPS, lomoved
+    mover.Shutdown()
+    worker.Shutdown()
+    return (oSim,fElapsed)
+
+def Planned():
+    (oSim,oCmdLib,worker,mover) = Setup()
+    tStart = time.perf_counter()
+    plan = Plan(PROGRAM,CONSTRAINTS,oCmdLib.nChannel,fSwitchCost=Switch_Cost(oCmdLib))
+    print(plan.Report())
+    Check_Order(plan)
+    lomoved = [future.result(timeout=10) for future in Execute_Plan(mover,plan)]
+    fElapsed = time.perf_counter() - tStart
+    assert lomoved == STEPS, lomoved
+    mover.Shutdown()
+    worker.Shutdown()
+    return (oSim,plan,fElapsed)
+
+# <summary>
+# Runs a plan whose first batch (x, y) has a move the controller refuses, then a batch on z. Returns the Futures of
+# the moves and the simulated controller.
+# </summary>
+def Failed_Batch():
+    (oSim,oCmdLib,worker,mover) = Setup()
+    plan = Plan([('x',MAX_RELATIVE_STEPS + 1),('y',10),('z',10)],nCurrent=1)
+    assert plan.lochannels == [1,3], plan.lochannels
+    lofutures = Execute_Plan(mover,plan)
+    assert not wait(lofutures,timeout=10).not_done
+    mover.Shutdown()
+    worker.Shutdown()
+    return (lofutures,oSim)
+
+def main():
+    (oSim,fWritten) = As_Written()
+    (oPlannedSim,plan,fPlanned) = Planned()
+    assert Positions(oSim) == Positions(oPlannedSim)
+
+    print("As written: {:6.1f} ms, {} channel switches".format(1000*fWritten,Switches(oSim)))
+    print("Planned:    {:6.1f} ms, {} channel switches".format(1000*fPlanned,Switches(oPlannedSim)))
+    assert Switches(oPlannedSim) == plan.nSwitchesAfter, "The plan switched channel more often than estimated!"
+    assert Switches(oPlannedSim) < Switches(oSim)
+    assert fPlanned < fWritten, "The planned program is not faster!"
+
+    (lofutures,oSim) = Failed_Batch()
+    assert lofutures[0].exception() is not None
+    assert lofutures[2].cancelled(), "A batch ran after a failed one!"
+    assert not [args for (t,strCommand,args) in oSim.loCommandLog if strCommand == "SetChannel" and args == (3,)]
+    print("Failed batch: the batch after it was cancelled before it reached the controller")
+
+if __name__ == "__main__":
+    main()
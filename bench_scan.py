@@ -0,0 +1,72 @@
+######################## Raster scan benchmark ##############################
+
+# Scans a grid on the simulated controller, serpentine and raster, with a site callback standing in for a camera
+# trigger. Checks that every site is visited once, in order, at the right position, and that serpentine (no flyback)
+# is at least as fast as raster. Then scans it serpentine with a z offset (focus) at every site, and checks that every
+# site's z move comes after its x/y moves. Prints the throughput and jitter of each. Run with: python bench_scan.py
+
+import motion
+from agilis_sim import SimCmdLibAgilis
+from motion_worker import MotionWorker
+from scan import Grid, Site_Moves, Lookahead, Run_Scan
+from stepmove import StepMover
+
+COMMAND_LATENCY = 0.001 # seconds per command on the simulated controller
+COLUMNS = 8
+ROWS = 6
+COLUMN_STEP = 10        # steps between two sites of a row
+ROW_STEP = 15           # steps between two rows
+DWELL = 0.002           # seconds at each site before the callback
+FOCUS_STEP = 5          # z steps between the focus of two neighbouring sites
+
+# <summary>
+# Returns (index in the command log, channel) of every relative move the simulated controller saw.
+# </summary>
+def Move_Channels(oSim):
+    (nChannel,lomoves) = (None,[])
+    for (nIndex,(t,strCommand,args)) in enumerate(oSim.loCommandLog):
+        if strCommand == "SetChannel":
+            nChannel = args[0]
+        elif strCommand == "RelativeMove":
+            lomoves.append((nIndex,nChannel))
+    return lomoves
+
+def Scan(bSerpentine,z=None):
+    oSim = SimCmdLibAgilis(COMMAND_LATENCY)
+    oSim.Open("SIM")
+    oCmdLib = motion.Wrap_CmdLib(oSim)
+    worker = MotionWorker()
+    mover = StepMover(worker,lambda:oCmdLib)
+
+    lovisited = []
+    lonlogged = [0] # length of the command log at every site
+    def on_site(site):
+        # The stages must be at the site when the "camera" is triggered
+        assert (oSim.Step_Count(1,1),oSim.Step_Count(1,2),oSim.Step_Count(3,1)) == site.offset, site
+        lovisited.append((site.nRow,site.nColumn))
+        lonlogged.append(len(oSim.loCommandLog))
+
+    grid = Grid(COLUMNS,ROWS,COLUMN_STEP,ROW_STEP,bSerpentine,z)
+    stats = Run_Scan(mover,Lookahead(Site_Moves(grid)),DWELL,on_site)
+    mover.Shutdown()
+    worker.Shutdown()
+
+    assert len(lovisited) == COLUMNS*ROWS
+    assert sorted(lovisited) == [(nRow,nColumn) for nRow in range(ROWS) for nColumn in range(COLUMNS)]
+    lomoves = Move_Channels(oSim)
+    for (nStart,nEnd) in zip(lonlogged,lonlogged[1:]):
+        lochannels = [nChannel for (nIndex,nChannel) in lomoves if nStart <= nIndex < nEnd]
+        assert lochannels == sorted(lochannels), "A site's z move came before its x/y moves!"
+    print("{:<10} {}".format(("serpentine" if bSerpentine else "raster") + (" z" if z is not None else ""),
+                             stats.Report()))
+    return stats.Summary()
+
+def main():
+    serpentine = Scan(True)
+    raster = Scan(False)
+    assert serpentine["sites_per_minute"] >= raster["sites_per_minute"], "Serpentine scans should not be slower!"
+    # A focus offset that changes at every site
+    Scan(True,[[FOCUS_STEP*((nRow + nColumn) % 2) for nColumn in range(COLUMNS)] for nRow in range(ROWS)])
+
+if __name__ == "__main__":
+    main()
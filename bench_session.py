@@ -0,0 +1,96 @@
+######################## Session replay benchmark ##############################
+
+# Records an operator session (taps of the arrow keys, a long hold, idle pauses and a speed change) with the session
+# recorder (see session.py), on a virtual clock, then replays it on the simulated controller twice:
+#  - in real time, every tap as it was recorded;
+#  - compressed: idle gaps shortened and taps merged.
+# It checks that both replays end at the same positions (within the jitter of a jog's duration), and that the
+# compressed replay is at least SPEEDUP_TARGET times faster. Run with: python bench_session.py
+
+import os
+import tempfile
+
+import motion
+from agilis_sim import SimCmdLibAgilis, STEP_RATES
+from motion_worker import MotionWorker
+from session import SessionRecorder, Read_Sessions, Session_Jogs, Merge_Jogs, Schedule, Replay, REPLAY_IDLE_GAP
+
+COMMAND_LATENCY = 0.002 # seconds per command on the simulated controller
+SPEEDUP_TARGET = 2.0
+TOLERANCE = 0.02        # seconds of jog duration a replay may be off by, per jog
+
+class VirtualClock:
+    def __init__(self):
+        self.t = 1000.0
+
+    def __call__(self):
+        return self.t
+
+# <summary>
+# Records the session to strPath. Returns the number of jogs in it.
+# </summary>
+def Record_Session(strPath):
+    clock = VirtualClock()
+    recorder = SessionRecorder(clock)
+    recorder.Open(strPath)
+    nJogs = 0
+
+    def jog(axis,direction,nSpeed,fHold,fPause):
+        nonlocal nJogs
+        recorder.Start(axis,direction,nSpeed)
+        clock.t += fHold
+        recorder.Stop(axis,direction)
+        clock.t += fPause
+        nJogs += 1
+
+    recorder.Speed('x',2)
+    for i in range(6):                # tapping x forwards
+        jog('x','positive',2,0.08,0.25)
+    clock.t += 1.5                    # looking at the sample
+    for i in range(4):                # tapping y backwards
+        jog('y','negative',2,0.06,0.3)
+    clock.t += 2.0
+    for i in range(3):                # focusing
+        jog('z','positive',1,0.1,0.4)
+    recorder.Speed('x',3)
+    jog('x','negative',3,0.3,0.5)     # a long hold
+    recorder.Close()
+    return nJogs
+
+def Replay_Session(loschedule):
+    oSim = SimCmdLibAgilis(COMMAND_LATENCY)
+    oSim.Open("SIM")
+    motion.oCmdLib = motion.Wrap_CmdLib(oSim)
+    motion.runnable = True
+    worker = MotionWorker()
+    (bResult,fElapsed) = Replay(loschedule,worker)
+    worker.Shutdown()
+    assert bResult, "The replay failed!"
+    return (dict((axis,oSim.Step_Count(nChannel,nAxis)) for (axis,(nChannel,nAxis)) in motion.stage_map.items()),
+            fElapsed)
+
+def main():
+    strPath = os.path.join(tempfile.mkdtemp(),"session.bin")
+    nJogs = Record_Session(strPath)
+    print("Recorded {} jogs, {} bytes".format(nJogs,os.path.getsize(strPath)))
+    [(tBegan,loevents)] = list(Read_Sessions(strPath))
+    lojogs = Session_Jogs(loevents)
+    assert len(lojogs) == nJogs, lojogs
+
+    lomerged = Merge_Jogs(lojogs,motion.stage_map)
+    (realtime,fRealtime) = Replay_Session(Schedule(lojogs))
+    (compressed,fCompressed) = Replay_Session(Schedule(lomerged,REPLAY_IDLE_GAP))
+    print("Real time:  {:5.2f} s, {} jogs, positions {}".format(fRealtime,len(lojogs),realtime))
+    print("Compressed: {:5.2f} s, {} jogs, positions {}".format(fCompressed,len(lomerged),compressed))
+
+    for axis in motion.stage_map:
+        nJogsOfAxis = sum(1 for jog in lojogs if jog.axis == axis)
+        nRate = max([STEP_RATES[jog.nSpeed] for jog in lojogs if jog.axis == axis] or [0])
+        nTolerance = int(nRate*TOLERANCE*nJogsOfAxis) + 1
+        assert abs(realtime[axis] - compressed[axis]) <= nTolerance, (axis,realtime[axis],compressed[axis])
+    fSpeedup = fRealtime/fCompressed
+    print("Speed-up: {:.1f}x (target {:.1f}x)".format(fSpeedup,SPEEDUP_TARGET))
+    assert fSpeedup >= SPEEDUP_TARGET, "The compressed replay is too slow!"
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+######################## Relative step move benchmark ##############################
+
+# Carries out the same list of relative moves on the simulated controller twice, through the motion worker:
+#  - one by one: select the channel, start the move, poll until the axis is ready, then the next move;
+#  - with StepMover (see stepmove.py): grouped by channel, both axes of a channel at the same time, and the next move
+#    of an axis started in the same turn that sees the previous one finish.
+# It checks that every move arrived with the right step count, and that StepMover is at least SPEEDUP_TARGET times
+# faster. StepMover is then run once more through the method names of Newport's .NET library (see agilis_dotnet.py),
+# and must end at the same positions. Run with: python bench_steps.py
+
+import time
+
+import motion
+from agilis_sim import SimCmdLibAgilis, DotNetSimCmdLib
+from motion_worker import MotionWorker
+from stepmove import StepMover, STEP_POLL_INTERVAL
+
+COMMAND_LATENCY = 0.001 # seconds per command on the simulated controller
+SPEEDUP_TARGET = 1.4
+
+# x and y share channel 1, z is on channel 3: interleaved on purpose, as a list typed in by hand would be. Mostly x/y
+# moves, as when stepping across a sample.
+MOVES = [('x',20),('z',-30),('y',15),('x',-10),('y',-20),('x',30),('y',40),('z',15),('y',10),('x',-25)]
+
+def Setup(bDotNet=False):
+    oSim = SimCmdLibAgilis(COMMAND_LATENCY)
+    oSim.Open("SIM")
+    oCmdLib = motion.Wrap_CmdLib(DotNetSimCmdLib(oSim) if bDotNet else oSim)
+    return (oSim,oCmdLib,MotionWorker())
+
+def One_By_One(lomoves):
+    (oSim,oCmdLib,worker) = Setup()
+    tStart = time.perf_counter()
+    for (stage,nSteps) in lomoves:
+        (nChannel,nAxis) = motion.stage_map[stage]
+        assert worker.Submit(lambda:oCmdLib.SetChannel(nChannel) and oCmdLib.RelativeMove(nAxis,nSteps)).result()
+        while worker.Submit(oCmdLib.GetAxisStatus,nAxis).result()[1] != 0:
+            time.sleep(STEP_POLL_INTERVAL)
+    fElapsed = time.perf_counter() - tStart
+    worker.Shutdown()
+    return (oSim,fElapsed)
+
+def Pipelined(lomoves,bDotNet=False):
+    (oSim,oCmdLib,worker) = Setup(bDotNet)
+    mover = StepMover(worker,lambda:oCmdLib)
+    tStart = time.perf_counter()
+    lofutures = mover.Move_List(lomoves)
+    lomoved = [future.result(timeout=10) for future in lofutures]
+    fElapsed = time.perf_counter() - tStart
+    assert lomoved == [nSteps for (stage,nSteps) in lomoves], lomoved
+    print("StepMover: {} moves in {} channel groups, {} worker turns".format(mover.nMoves,mover.nChannelGroups,
+                                                                          mover.nTurns))
+    mover.Shutdown()
+    worker.Shutdown()
+    return (oSim,fElapsed)
+
+# <summary>
+# Returns the final step counter of every stage.
+# </summary>
+def Positions(oSim):
+    return dict((stage,oSim.Step_Count(nChannel,nAxis)) for (stage,(nChannel,nAxis)) in motion.stage_map.items())
+
+def main():
+    (oSim,fSerial) = One_By_One(MOVES)
+    (oPipelinedSim,fPipelined) = Pipelined(MOVES)
+    assert Positions(oSim) == Positions(oPipelinedSim)
+
+    print("One by one: {:6.1f} ms, {} commands".format(1000*fSerial,len(oSim.loCommandLog)))
+    print("StepMover:  {:6.1f} ms, {} commands".format(1000*fPipelined,len(oPipelinedSim.loCommandLog)))
+    fSpeedup = fSerial/fPipelined
+    print("Speed-up: {:.2f}x (target {:.1f}x)".format(fSpeedup,SPEEDUP_TARGET))
+    assert fSpeedup >= SPEEDUP_TARGET, "Pipelined step moves are too slow!"
+
+    (oDotNetSim,fDotNet) = Pipelined(MOVES,bDotNet=True)
+    assert Positions(oDotNetSim) == Positions(oSim)
+    print("StepMover through the .NET method names: {:6.1f} ms, same positions".format(1000*fDotNet))
+
+if __name__ == "__main__":
+    main()
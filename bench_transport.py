@@ -0,0 +1,89 @@
+######################## Serial transport latency benchmark ##############################
+
+# Measures the per-command latency of the pure-Python serial transport (agilis_serial.py) against the pty-backed
+# simulated controller, and, where pythonnet and a controller are available, of the .NET CmdLibAgilis path on the
+# real device. On the real device, only commands that do not move anything are timed, unless --move is given: the
+# jog is then timed too, which moves axis 1 of channel 1 about REPEATS times. Run with: python bench_transport.py
+# [--move]
+
+import sys
+import time
+
+from agilis_serial import AgilisSerial
+from agilis_sim import PtyAgilisController
+
+REPEATS = 500
+
+# <summary>
+# Returns the latencies (seconds) of REPEATS calls of each command on oCmdLib, as a dict. The jog is only timed if
+# bMove.
+# </summary>
+def Measure(oCmdLib,bQueries=True,bMove=True):
+    commands = dict({"SetChannel":lambda:oCmdLib.SetChannel(1)})
+    if bMove:
+        commands["StartJogging"] = lambda:oCmdLib.StartJogging(1,2)
+    commands["StopMotion"] = lambda:oCmdLib.StopMotion(1)
+    if bQueries:
+        commands["GetErrorCode"] = oCmdLib.GetErrorCode
+    latencies = dict()
+    for (strCommand,command) in commands.items():
+        lolatency = []
+        for i in range(REPEATS):
+            tStart = time.perf_counter()
+            result = command()
+            lolatency.append(time.perf_counter() - tStart)
+            assert result is True or (isinstance(result,tuple) and result[0]), strCommand
+        latencies[strCommand] = sorted(lolatency)
+    return latencies
+
+def Report(strTitle,latencies):
+    print(strTitle)
+    for (strCommand,lolatency) in latencies.items():
+        print("  {:<14} p50 = {:7.1f} us  p99 = {:7.1f} us  max = {:7.1f} us".format(strCommand,
+              1e6*lolatency[len(lolatency)//2],1e6*lolatency[int(0.99*len(lolatency))],1e6*lolatency[-1]))
+
+def Measure_Serial():
+    oController = PtyAgilisController()
+    oCmdLib = AgilisSerial()
+    try:
+        assert oCmdLib.Open(oController.strDeviceKey) == 0
+        assert oCmdLib.SetRemoteMode()
+        Report("Pure-Python serial transport (pty simulator):",Measure(oCmdLib))
+        assert oCmdLib.GetErrorCode() == (True,0)
+    finally:
+        oCmdLib.Close()
+        oController.Close()
+
+# <summary>
+# The .NET path needs pythonnet, the DLLs and a connected controller. Commands are sent to the first device found;
+# the stage only moves if bMove.
+# </summary>
+def Measure_DotNet(bMove=False):
+    try:
+        import clr
+        clr.AddReference("CmdLibAgilis")
+        clr.AddReference("VCPIOLib")
+        from Newport.Motion.CmdLibAgilis import CmdLibAgilis
+        from Newport.VCPIOLib import VCPIOLib
+    except Exception as e:
+        print(".NET CmdLibAgilis path skipped ({})".format(e))
+        return
+    oDeviceIO = VCPIOLib(False)
+    oCmdLib = CmdLibAgilis(oDeviceIO)
+    oDeviceIO.DiscoverDevices()
+    lokeys = list(oDeviceIO.GetDeviceKeys())
+    if not lokeys or oCmdLib.Open(str(lokeys[0])) != 0:
+        print(".NET CmdLibAgilis path skipped (no controller found)")
+        oDeviceIO.Shutdown()
+        return
+    try:
+        oCmdLib.SetRemoteMode()
+        Report(".NET CmdLibAgilis (device {}):".format(lokeys[0]),Measure(oCmdLib,bQueries=False,bMove=bMove))
+    finally:
+        oCmdLib.StopMotion(1)
+        oCmdLib.Close()
+        oDeviceIO.Shutdown()
+
+if __name__ == "__main__":
+    Measure_Serial()
+    Measure_DotNet(bMove="--move" in sys.argv)
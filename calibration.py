@@ -0,0 +1,378 @@
+######################## Stage calibration ##############################
+
+# The stages are piezo stick-slip actuators: a step is not a fixed distance, it depends on the direction, the load
+# and the step amplitude, and the speed levels of speed_list_dict (1-4) are step rates, not velocities. An
+# AxisCalibration holds, per stage and direction:
+#  - the step size (um per step), fitted with least squares from displacements the user measured (e.g. on the
+#    microscope camera) after moving known numbers of steps: displacement = um_per_step x steps;
+#  - the step rate (steps per second) of every speed level, fitted from the step counters after jogs of several
+#    durations: steps = rate x duration + offset, where the offset absorbs the time the controller takes to start and
+#    stop. The counters are read with GetStepCount: TP over the serial transport, GetStepsAccumulated over the .NET
+#    library (see agilis_dotnet.py).
+# Conversions (Steps, Microns, Jog_Time) are a couple of dict lookups and a multiplication.
+# The step size only holds for the step amplitudes (SU, see amplitude.py) it was measured at, so a calibration records
+# them, and a stage switched between profiles (e.g. coarse and fine) has one calibration per profile. Find picks the
+# one for the amplitudes the stage is set to now.
+#
+# The calibrations are kept in a JSON file (CALIBRATION_PATH), one per controller and stage, so a stage is
+# characterized once, not every time the program starts. A controller is known by its device key (Controller_Key),
+# not by its identity (see discovery.py): every AG-UC8 answers VE with the same firmware string, so the identity
+# cannot tell two controllers apart. The device key names the port the controller is on (on Linux,
+# /dev/serial/by-id names carry the USB serial number); the simulated controller's is "SIM", so simulated runs never
+# mix with real ones.
+# Run with: python calibration.py x --rates [--simulate]          (step rates, from the step counters)
+#           python calibration.py x --steps 100 200 400 [--simulate] (step size, asks for the displacements)
+#
+# NumPy is only imported when a calibration is fitted, so importing the motion library stays cheap.
+
+import argparse
+import json
+import os
+import time
+
+# Where the calibrations are kept. Can be changed with the environment variable AGILIS_CALIBRATION.
+CALIBRATION_PATH = os.environ.get ("AGILIS_CALIBRATION",
+                                   os.path.join (os.path.expanduser ("~"), ".micropositioners", "calibration.json"))
+
+CALIBRATION_LEVELS = (1,2,3,4)          # speed levels characterized by default
+CALIBRATION_DURATIONS = (0.2,0.5,1.0)   # seconds of the jogs of a step rate characterization
+CALIBRATION_POLL_INTERVAL = 0.01        # seconds between two polls of a stopping axis
+
+DIRECTIONS = ("positive","negative")
+
+# <summary>
+# Least squares fit of y = a*x. Returns (a, rms residual).
+# </summary>
+def Fit_Proportional(lox,loy):
+    import numpy as np
+    x = np.asarray(lox,dtype=float)
+    y = np.asarray(loy,dtype=float)
+    (solution,residuals,nRank,singular) = np.linalg.lstsq(x[:,None],y,rcond=None)
+    return (float(solution[0]),float(np.sqrt(np.mean((y - solution[0]*x)**2))))
+
+# <summary>
+# Least squares fit of y = a*x + b. Returns (a, b, rms residual). With a single distinct x, fits y = a*x instead.
+# </summary>
+def Fit_Linear(lox,loy):
+    import numpy as np
+    x = np.asarray(lox,dtype=float)
+    y = np.asarray(loy,dtype=float)
+    if len(np.unique(x)) < 2:
+        (a,fResidual) = Fit_Proportional(x,y)
+        return (a,0.0,fResidual)
+    A = np.stack([x,np.ones_like(x)],axis=1)
+    (solution,residuals,nRank,singular) = np.linalg.lstsq(A,y,rcond=None)
+    return (float(solution[0]),float(solution[1]),float(np.sqrt(np.mean((y - A @ solution)**2))))
+
+class AxisCalibration:
+    # <summary>
+    # amplitudes: the step amplitudes (positive, negative), signed like the SU command, the stage was calibrated at;
+    # None if they are not known.
+    # </summary>
+    def __init__(self,strController="",stage="",amplitudes=None):
+        self.strController = strController
+        self.stage = stage
+        self.amplitudes = None if amplitudes is None else tuple(amplitudes)
+        self.um_per_step = dict((direction,None) for direction in DIRECTIONS)
+        self.rates = dict((direction,dict()) for direction in DIRECTIONS)  # direction -> level -> steps/s
+        self.residuals = dict()   # "<quantity> <direction>" -> rms residual of the fit
+        self.fCalibrated = None   # time of the last fit (time.time())
+
+    # <summary>
+    # Fits the step size of a direction from the steps moved and the displacements measured (um), both as lists.
+    # </summary>
+    def Fit_Step_Size(self,direction,losteps,lodisplacements):
+        (fSize,fResidual) = Fit_Proportional([abs(nSteps) for nSteps in losteps],
+                                             [abs(fMicrons) for fMicrons in lodisplacements])
+        if fSize <= 0:
+            raise ValueError("The measured displacements do not fit a positive step size.")
+        self.um_per_step[direction] = fSize
+        self.residuals["um_per_step " + direction] = fResidual
+        self.fCalibrated = time.time()
+
+    # <summary>
+    # Fits the step rates of a direction from measurements: a dict mapping speed levels to lists of (duration,
+    # steps counted).
+    # </summary>
+    def Fit_Step_Rates(self,direction,measurements):
+        for (nLevel,lomeasured) in measurements.items():
+            (fRate,fOffset,fResidual) = Fit_Linear([fDuration for (fDuration,nSteps) in lomeasured],
+                                                   [abs(nSteps) for (fDuration,nSteps) in lomeasured])
+            self.rates[direction][int(nLevel)] = fRate
+            self.residuals["rate {} {}".format(nLevel,direction)] = fResidual
+        self.fCalibrated = time.time()
+
+    # <summary>
+    # Returns the number of steps (signed) that moves the stage by fMicrons (negative = backwards).
+    # Raises ValueError if the step size of that direction has not been calibrated.
+    # </summary>
+    def Steps(self,fMicrons):
+        direction = "positive" if fMicrons >= 0 else "negative"
+        fSize = self.um_per_step[direction]
+        if fSize is None:
+            raise ValueError("The {} step size of {} is not calibrated.".format(direction,self.stage))
+        return int(round(fMicrons/fSize))
+
+    # <summary>
+    # Returns the distance (um, signed) nSteps steps move the stage.
+    # </summary>
+    def Microns(self,nSteps):
+        direction = "positive" if nSteps >= 0 else "negative"
+        fSize = self.um_per_step[direction]
+        if fSize is None:
+            raise ValueError("The {} step size of {} is not calibrated.".format(direction,self.stage))
+        return nSteps*fSize
+
+    # <summary>
+    # Returns the steps per second of the stage at speed level nLevel in the direction, or None if not calibrated.
+    # </summary>
+    def Rate(self,direction,nLevel):
+        return self.rates[direction].get(nLevel)
+
+    # <summary>
+    # Returns how long (seconds) to jog at speed level nLevel to move the stage by fMicrons.
+    # </summary>
+    def Jog_Time(self,fMicrons,nLevel):
+        direction = "positive" if fMicrons >= 0 else "negative"
+        fRate = self.rates[direction].get(nLevel)
+        if not fRate:
+            raise ValueError("The {} step rate of {} at level {} is not calibrated.".format(direction,self.stage,
+                                                                                            nLevel))
+        return abs(self.Steps(fMicrons))/fRate
+
+    def To_Dict(self):
+        return dict({"um_per_step":self.um_per_step,
+                     "rates":dict((direction,dict((str(nLevel),fRate) for (nLevel,fRate) in rates.items()))
+                                  for (direction,rates) in self.rates.items()),
+                     "residuals":self.residuals,"calibrated":self.fCalibrated})
+
+    @classmethod
+    def From_Dict(cls,strController,stage,amplitudes,saved):
+        calibration = cls(strController,stage,amplitudes)
+        calibration.um_per_step.update(saved.get("um_per_step",dict()))
+        for (direction,rates) in saved.get("rates",dict()).items():
+            calibration.rates[direction] = dict((int(nLevel),fRate) for (nLevel,fRate) in rates.items())
+        calibration.residuals = dict(saved.get("residuals",dict()))
+        calibration.fCalibrated = saved.get("calibrated")
+        return calibration
+
+    def Report(self):
+        lolines = ["Calibration of {} ({}, step amplitudes {}):".format(
+                   self.stage,self.strController or "unidentified controller",
+                   "unknown" if self.amplitudes is None else "{:+d}/{:+d}".format(*self.amplitudes))]
+        for direction in DIRECTIONS:
+            fSize = self.um_per_step[direction]
+            lolines.append("  {:<8} {} um/step, steps/s: {}".format(
+                           direction,"?" if fSize is None else "{:.4f}".format(fSize),
+                           ", ".join("{}: {:.1f}".format(nLevel,fRate)
+                                     for (nLevel,fRate) in sorted(self.rates[direction].items())) or "?"))
+        return "\n".join(lolines)
+
+# <summary>
+# Returns the key the calibrations of the connected controller are kept under: its device key, see the top of this
+# file.
+# </summary>
+def Controller_Key():
+    import motion
+    return motion.strDeviceKey
+
+# <summary>
+# Returns the key of a calibration in the JSON file: "<controller>/<stage>", followed by "@<positive>,<negative>" if
+# the step amplitudes are known.
+# </summary>
+def Store_Key(strController,stage,amplitudes):
+    strKey = "{}/{}".format(strController,stage)
+    return strKey if amplitudes is None else "{}@{:+d},{:+d}".format(strKey,*amplitudes)
+
+class CalibrationStore:
+    # <summary>
+    # The calibrations saved in strPath (CALIBRATION_PATH by default). A missing or unreadable file is an empty store.
+    # </summary>
+    def __init__(self,strPath=None):
+        self.strPath = strPath or CALIBRATION_PATH
+        self.calibrations = dict() # maps (controller, stage, amplitudes) to AxisCalibration
+        try:
+            with open(self.strPath) as f:
+                saved = json.load(f)
+        except (OSError,ValueError):
+            saved = dict()
+        for (strKey,entry) in (saved if isinstance(saved,dict) else dict()).items():
+            (strController,_,strStage) = strKey.rpartition("/")
+            (stage,_,strAmplitudes) = strStage.partition("@")
+            amplitudes = tuple(int(strAmplitude) for strAmplitude in strAmplitudes.split(",")) if strAmplitudes \
+                         else None
+            self.calibrations[(strController,stage,amplitudes)] = AxisCalibration.From_Dict(strController,stage,
+                                                                                            amplitudes,entry)
+
+    # <summary>
+    # Returns the calibration of the stage on the controller (see Controller_Key) at the step amplitudes (positive,
+    # negative), a new one if there is none yet.
+    # </summary>
+    def Get(self,strController,stage,amplitudes=None):
+        key = (strController,stage,None if amplitudes is None else tuple(amplitudes))
+        if key not in self.calibrations:
+            self.calibrations[key] = AxisCalibration(*key)
+        return self.calibrations[key]
+
+    # <summary>
+    # Returns the calibration to use for the stage on the controller while it is set to the step amplitudes (positive,
+    # negative), or None: the one made at those amplitudes, else one made without knowing them. If amplitudes is None
+    # (not known), only a calibration made without knowing them, or the stage's only calibration, will do.
+    # </summary>
+    def Find(self,strController,stage,amplitudes=None):
+        if amplitudes is not None and (strController,stage,tuple(amplitudes)) in self.calibrations:
+            return self.calibrations[(strController,stage,tuple(amplitudes))]
+        if (strController,stage,None) in self.calibrations:
+            return self.calibrations[(strController,stage,None)]
+        locandidates = [calibration for ((strKeyController,keyStage,keyAmplitudes),calibration)
+                        in self.calibrations.items() if (strKeyController,keyStage) == (strController,stage)]
+        if amplitudes is None and len(locandidates) == 1:
+            return locandidates[0]
+        return None
+
+    def Save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.strPath)),exist_ok=True)
+        strTemporary = self.strPath + ".tmp"
+        with open(strTemporary,"w") as f:
+            json.dump(dict((Store_Key(*key),calibration.To_Dict()) for (key,calibration) in self.calibrations.items()),
+                      f,indent=2)
+        os.replace(strTemporary,self.strPath)
+
+############################ Characterization ##############################
+
+# The following run on the motion worker.
+
+def Start_Jog(oCmdLib,nChannel,nAxis,nJogSpeed):
+    if not oCmdLib.SetChannel(nChannel):
+        return (False,0,0.0)
+    (bStatus,nCount) = oCmdLib.GetStepCount(nAxis)
+    if not bStatus or not oCmdLib.StartJogging(nAxis,nJogSpeed):
+        return (False,0,0.0)
+    return (True,nCount,time.perf_counter())
+
+def Stop_Jog(oCmdLib,nChannel,nAxis):
+    bStatus = oCmdLib.SetChannel(nChannel) and oCmdLib.StopMotion(nAxis)
+    return (bStatus,time.perf_counter())
+
+# <summary>
+# Returns (bStatus, step counter), the step counter being None while the axis is still moving.
+# </summary>
+def Read_When_Ready(oCmdLib,nChannel,nAxis):
+    if not oCmdLib.SetChannel(nChannel):
+        return (False,None)
+    (bStatus,nState) = oCmdLib.GetAxisStatus(nAxis)
+    if not bStatus or nState != 0:
+        return (bStatus,None)
+    return oCmdLib.GetStepCount(nAxis)
+
+# <summary>
+# Returns the step amplitudes (positive, negative) the stage is set to, or None if the controller did not answer (see
+# amplitude.Step_Amplitudes). Both transports have the SU command (see agilis_dotnet.py), so any exception is a real
+# failure and is raised.
+# </summary>
+def Current_Amplitudes(oCmdLib,stage_map,stage):
+    from amplitude import Step_Amplitudes
+    (bStatus,nPositive,nNegative) = Step_Amplitudes(oCmdLib,stage_map,stage)
+    return (nPositive,nNegative) if bStatus else None
+
+class Calibrator:
+    # <summary>
+    # worker: the MotionWorker that owns the controller. fnCmdLib and stage_map: see stepmove.StepMover.
+    # </summary>
+    def __init__(self,worker,fnCmdLib=None,stage_map=None):
+        import motion
+        self.worker = worker
+        self.fnCmdLib = (lambda:motion.oCmdLib) if fnCmdLib is None else fnCmdLib
+        self.stage_map = motion.stage_map if stage_map is None else stage_map
+
+    def _submit(self,function,stage,*args,**kwargs):
+        (nChannel,nAxis) = self.stage_map[stage]
+        (bStatus,*result) = self.worker.Submit(function,self.fnCmdLib(),nChannel,nAxis,*args,axes=[stage],
+                                               **kwargs).result()
+        if not bStatus:
+            raise RuntimeError("The controller did not carry out a calibration command on {}.".format(stage))
+        return result
+
+    # <summary>
+    # Jogs the stage at speed level nLevel in the direction for about fDuration seconds. Returns (the time between the
+    # start and stop commands, steps counted).
+    # </summary>
+    def Measure_Jog(self,stage,direction,nLevel,fDuration):
+        from motion_worker import LANE_STOP
+        (nStart,tStart) = self._submit(Start_Jog,stage,nLevel if direction == "positive" else -nLevel)
+        try:
+            time.sleep(fDuration)
+        finally:
+            (tStop,) = self._submit(Stop_Jog,stage,lane=LANE_STOP)
+        while True:
+            (nCount,) = self._submit(Read_When_Ready,stage)
+            if nCount is not None:
+                return (tStop - tStart,nCount - nStart)
+            time.sleep(CALIBRATION_POLL_INTERVAL)
+
+    # <summary>
+    # Jogs the stage for every level and duration, alternating directions so that it ends up about where it started,
+    # and fits the step rates of both directions into calibration. Returns the measurements, as direction -> level ->
+    # list of (duration, steps).
+    # </summary>
+    def Characterize_Rates(self,calibration,lolevels=CALIBRATION_LEVELS,lodurations=CALIBRATION_DURATIONS):
+        measurements = dict((direction,dict()) for direction in DIRECTIONS)
+        for nLevel in lolevels:
+            for fDuration in lodurations:
+                for direction in DIRECTIONS:
+                    measurements[direction].setdefault(nLevel,[]).append(
+                        self.Measure_Jog(calibration.stage,direction,nLevel,fDuration))
+        for direction in DIRECTIONS:
+            calibration.Fit_Step_Rates(direction,measurements[direction])
+        return measurements
+
+def main(argv=None):
+    import motion
+    from motion_worker import MotionWorker, LANE_STOP
+    from batch import Open_Simulator, Close_Device, INITIALIZE_TIMEOUT
+    from stepmove import StepMover
+
+    parser = argparse.ArgumentParser(description="Calibrates the step size and step rates of a stage.")
+    parser.add_argument("stage",choices=sorted(motion.stage_map))
+    parser.add_argument("--rates",action="store_true",help="characterize the step rates from the step counters")
+    parser.add_argument("--steps",type=int,nargs="+",help="step counts to move for the step size; the displacements "
+                                                          "are asked for")
+    parser.add_argument("--levels",type=int,nargs="+",default=list(CALIBRATION_LEVELS))
+    parser.add_argument("--simulate",action="store_true",help="use the simulated controller")
+    args = parser.parse_args(argv)
+
+    worker = MotionWorker(on_hung=lambda:motion.oCmdLib.Invalidate())
+    if not worker.Submit(Open_Simulator if args.simulate else motion.Initializer,lane=LANE_STOP,
+                         timeout=INITIALIZE_TIMEOUT).result():
+        worker.Shutdown()
+        raise SystemExit("Could not open the controller.")
+    store = CalibrationStore()
+    amplitudes = worker.Submit(Current_Amplitudes,motion.oCmdLib,motion.stage_map,args.stage).result()
+    if amplitudes is None:
+        worker.Submit(Close_Device,lane=LANE_STOP,timeout=INITIALIZE_TIMEOUT)
+        worker.Shutdown()
+        raise SystemExit("Could not read the step amplitudes of {}.".format(args.stage))
+    calibration = store.Get(Controller_Key(),args.stage,amplitudes)
+    try:
+        if args.rates:
+            Calibrator(worker).Characterize_Rates(calibration,args.levels)
+        if args.steps:
+            mover = StepMover(worker)
+            for direction in DIRECTIONS:
+                (losteps,lodisplacements) = ([],[])
+                for nSteps in args.steps:
+                    nMoved = mover.Move(args.stage,nSteps if direction == "positive" else -nSteps).result()
+                    lodisplacements.append(float(input("Moved {} steps {}. Displacement (um): ".format(
+                                                       abs(nMoved),direction))))
+                    losteps.append(nMoved)
+                calibration.Fit_Step_Size(direction,losteps,lodisplacements)
+            mover.Shutdown()
+    finally:
+        worker.Submit(Close_Device,lane=LANE_STOP,timeout=INITIALIZE_TIMEOUT)
+        worker.Shutdown()
+    store.Save()
+    print(calibration.Report())
+    print("Saved to {}".format(store.strPath))
+
+if __name__ == "__main__":
+    main()
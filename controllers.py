@@ -0,0 +1,174 @@
+######################## Multi-controller engine ##############################
+
+# motion.py drives a single AG-UC8 through module globals. On a rig with several controllers, MotionEngine drives all
+# of them from one process:
+#  - each Controller owns its controller library object and its own MotionWorker (I/O thread), so commands for stages
+#    on different controllers are sent in parallel rather than one after the other;
+#  - the engine's stage_map maps each stage to (controller name, channel, axis).
+# The one-active-channel restriction only applies within a controller: stages on different controllers can all move
+# at the same time.
+#
+#     engine = MotionEngine ()
+#     for oController in Connect_Controllers () :
+#         engine.Add_Controller (oController)
+#     engine.Map_Stage ('x', 'A', 1, 1)
+#     engine.Map_Stage ('z', 'B', 1, 1)
+#     engine.Start_Motion ('x', 'positive', 2)
+#     engine.Start_Motion ('z', 'negative', 1)   # does not stop x: it is on another controller
+#     ...
+#     engine.Stop_All_Motion ()
+
+import string
+
+import motion
+from discovery import Probe_All_Devices, Concurrent_Probes
+from metrics import REGISTRY, Register_Worker
+from estop import Emergency_Stop, Stop_Channel, AGUC8_CHANNELS
+from motion_worker import MotionWorker, LANE_STOP
+
+class Controller:
+    # <summary>
+    # One AG-UC8 motor controller. oCmdLib is its (wrapped, see motion.Wrap_CmdLib) controller library object, which
+    # from now on is only used from the controller's own worker thread.
+    # </summary>
+    def __init__(self,strName,oCmdLib,strDeviceKey="",strIdentity=""):
+        self.strName = strName
+        self.oCmdLib = oCmdLib
+        self.strDeviceKey = strDeviceKey
+        self.strIdentity = strIdentity
+        self.worker = MotionWorker(strName="motion-io-"+strName,on_hung=self._on_hung)
+        Register_Worker(self.worker)
+
+    # If a command hangs and is abandoned, the channel/jog cache can no longer be trusted.
+    def _on_hung(self):
+        if hasattr(self.oCmdLib,"Invalidate"):
+            self.oCmdLib.Invalidate()
+
+    # <summary>
+    # Queues function(oCmdLib, *args) on the controller's worker thread and returns its Future. The keyword arguments
+    # are those of MotionWorker.Submit.
+    # </summary>
+    def Submit(self,function,*args,**kwargs):
+        return self.worker.Submit(function,self.oCmdLib,*args,**kwargs)
+
+    # <summary>
+    # Closes the device once the queued commands have been sent, and stops the worker thread.
+    # </summary>
+    def Close(self):
+        self.worker.Submit(self.oCmdLib.Close,lane=LANE_STOP,timeout=60.0)
+        self.worker.Shutdown()
+        REGISTRY.Remove_Gauges((("worker",self.worker.strName),))
+
+# <summary>
+# Runs on a controller's worker thread: starts jogging nAxis of nChannel at nJogSpeed. Returns True on success.
+# </summary>
+def Jog(oCmdLib,nChannel,nAxis,nJogSpeed):
+    return bool(oCmdLib.SetChannel(nChannel) and oCmdLib.StartJogging(nAxis,nJogSpeed))
+
+# <summary>
+# Runs on a controller's worker thread: stops nAxis of nChannel. Returns True on success.
+# </summary>
+def Stop(oCmdLib,nChannel,nAxis):
+    return bool(oCmdLib.SetChannel(nChannel) and oCmdLib.StopMotion(nAxis))
+
+# <summary>
+# Runs on a controller's worker thread: stops the moving channels first, then sweeps the idle ones (see estop.py).
+# Returns True if everything was stopped successfully.
+# </summary>
+def Stop_Controller(oCmdLib,stage_map,axis_status):
+    (bStatus,lochannel) = Emergency_Stop(oCmdLib,stage_map,axis_status)
+    for nChannel in lochannel:
+        if not Stop_Channel(oCmdLib,nChannel,stage_map):
+            bStatus = False
+    return bStatus
+
+class MotionEngine:
+    def __init__(self):
+        self.controllers = dict() # maps controller names to Controller objects
+        self.stage_map = dict()   # maps stage names to (controller name, channel, axis)
+        self.axis_status = dict() # maps stage names to True while they are (asked to be) moving
+
+    def Add_Controller(self,oController):
+        self.controllers[oController.strName] = oController
+
+    def Map_Stage(self,stage,strController,nChannel,nAxis):
+        if strController not in self.controllers:
+            raise KeyError("Unknown controller {}".format(strController))
+        if nChannel not in AGUC8_CHANNELS:
+            raise ValueError("Channel must be one of {}".format(AGUC8_CHANNELS))
+        self.stage_map[stage] = (strController,nChannel,nAxis)
+        self.axis_status[stage] = False
+
+    # <summary>
+    # Returns the stages of strController as a motion.stage_map style dict: stage -> (channel, axis).
+    # </summary>
+    def Controller_Stages(self,strController):
+        return dict((stage,(nChannel,nAxis)) for (stage,(strName,nChannel,nAxis)) in self.stage_map.items()
+                    if strName == strController)
+
+    # <summary>
+    # Starts motion of a stage in the given direction ("positive"/"negative") at the given speed (1-4). Returns the
+    # Future of the command, which runs on the stage's controller. Starting a stage on another channel of the same
+    # controller stops the stages on the previous channel, and axis_status is updated accordingly.
+    # timeout: see MotionWorker.Submit.
+    # </summary>
+    def Start_Motion(self,stage,direction,speed,callback=None,timeout=None):
+        (strController,nChannel,nAxis) = self.stage_map[stage]
+        for (other,(strName,nOtherChannel,nOtherAxis)) in self.stage_map.items():
+            if strName == strController and nOtherChannel != nChannel:
+                self.axis_status[other] = False
+        self.axis_status[stage] = True
+        nJogSpeed = speed if direction == 'positive' else -1*speed
+        return self.controllers[strController].Submit(Jog,nChannel,nAxis,nJogSpeed,callback=callback,axes=[stage],
+                                                      timeout=timeout)
+
+    # <summary>
+    # Stops motion of a stage. Returns the Future of the stop command.
+    # </summary>
+    def Stop_Motion(self,stage,callback=None):
+        (strController,nChannel,nAxis) = self.stage_map[stage]
+        self.axis_status[stage] = False
+        return self.controllers[strController].Submit(Stop,nChannel,nAxis,callback=callback,
+                                                      lane=LANE_STOP,axes=[stage])
+
+    # <summary>
+    # Stops all motion on every controller. The controllers are stopped in parallel, each one moving channels first.
+    # Returns a dict mapping controller names to the Futures of their stop commands.
+    # </summary>
+    def Stop_All_Motion(self):
+        lofutures = dict()
+        for (strController,oController) in self.controllers.items():
+            stages = self.Controller_Stages(strController)
+            moving = dict((stage,self.axis_status[stage]) for stage in stages)
+            lofutures[strController] = oController.Submit(Stop_Controller,stages,moving,lane=LANE_STOP,axes=stages)
+        for stage in self.axis_status:
+            self.axis_status[stage] = False
+        return lofutures
+
+    def Close(self):
+        for oController in self.controllers.values():
+            oController.Close()
+
+# <summary>
+# Discovers and opens every AG-UC8 that is connected, puts each one in remote mode, and returns them as Controller
+# objects named "A", "B", ... in device key order. Only devices that answer the firmware version query as an AG-UC8
+# are kept (see discovery.Identify): other USB serial devices are left alone.
+# </summary>
+def Connect_Controllers():
+    (VCPIOLib,CmdLibAgilis) = motion.Load_Transport()
+    oDeviceIO = VCPIOLib(True)
+    oDeviceIO.DiscoverDevices()
+    lokeys = [str(oDeviceKey) for oDeviceKey in oDeviceIO.GetDeviceKeys()]
+
+    locontrollers = []
+    for (strDeviceKey,strIdentity,oRawCmdLib) in Probe_All_Devices(lokeys,lambda:CmdLibAgilis(oDeviceIO),
+                                                                   bConcurrent=Concurrent_Probes(CmdLibAgilis)):
+        strName = string.ascii_uppercase[len(locontrollers)]
+        oCmdLib = motion.Wrap_CmdLib(oRawCmdLib,strName)
+        if not oCmdLib.SetRemoteMode():
+            print("Could not put the controller at {} into Remote Mode.\n".format(strDeviceKey))
+            oCmdLib.Close()
+            continue
+        print("Controller {}: {} ({})".format(strName,strDeviceKey,strIdentity))
+        locontrollers.append(Controller(strName,oCmdLib,strDeviceKey,strIdentity))
+    return locontrollers
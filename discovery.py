@@ -0,0 +1,149 @@
+######################## Device cache and probing ##############################
+
+# Device discovery is the slowest part of starting up: every virtual COM port is discovered, then each one is opened in
+# turn until one works (and other USB devices, e.g. cameras, may show up as candidates too). To make start-up and
+# reconnects fast:
+#  - the device key and identity of the last controller that was opened successfully are saved to a small JSON file,
+#    and Initializer tries that device first, before any discovery;
+#  - on a miss, the discovered devices are probed concurrently, each probe with its own controller object, and the
+#    first device that answers as an AG-UC8 wins. The .NET library's controller objects all share the VCPIOLib they
+#    are created with, so with it the devices are probed one after the other instead (see Concurrent_Probes).
+# A device only counts as a controller once it has answered the firmware version query (VE) as an AG-UC8.
+
+import json
+import os
+import time
+
+from agilis_dotnet import Adapt_CmdLib
+
+# Where the last device is remembered. Can be changed with the environment variable AGILIS_DEVICE_CACHE.
+DEVICE_CACHE_PATH = os.environ.get ("AGILIS_DEVICE_CACHE",
+                                    os.path.join (os.path.expanduser ("~"), ".micropositioners", "device.json"))
+
+# How long (seconds) to wait for the probes of the discovered devices.
+PROBE_TIMEOUT = 2.0
+
+# <summary>
+# Returns the saved device as a dict with keys "device_key", "identity" and "transport", or an empty dict.
+# </summary>
+def Load_Device_Cache(strPath=None):
+    try:
+        with open(strPath or DEVICE_CACHE_PATH) as f:
+            cache = json.load(f)
+    except (OSError,ValueError):
+        return dict()
+    return cache if isinstance(cache,dict) else dict()
+
+# <summary>
+# Saves the device that was just opened successfully. Failing to save is not an error, only a slower next start.
+# </summary>
+def Save_Device_Cache(strDeviceKey,strIdentity,strTransport,strPath=None):
+    strPath = strPath or DEVICE_CACHE_PATH
+    try:
+        os.makedirs(os.path.dirname(strPath),exist_ok=True)
+        with open(strPath,"w") as f:
+            json.dump(dict({"device_key":strDeviceKey,"identity":strIdentity,"transport":strTransport,
+                            "saved":time.time()}),f)
+    except OSError as e:
+        print("Could not save the device cache to {}: {}".format(strPath,e))
+
+# <summary>
+# Asks an opened controller who it is, with GetVersion (GetFirmwareVersion in the .NET library, see agilis_dotnet.py).
+# Returns (bStatus, identity): bStatus is False unless the device answered as an AG-UC8. A controller library that
+# cannot be asked is not trusted either: (False, "").
+# </summary>
+def Identify(oCmdLib):
+    oCmdLib = Adapt_CmdLib(oCmdLib)
+    if not hasattr(oCmdLib,"GetVersion"):
+        return (False,"")
+    (bStatus,strIdentity) = oCmdLib.GetVersion()
+    return (bool(bStatus) and "AG-UC8" in strIdentity,strIdentity)
+
+# <summary>
+# Returns True if controller objects of the class CmdLibAgilis can be probed at the same time. The serial transport's
+# each open their own port (see agilis_serial.py); the .NET library's go through the one VCPIOLib they are created
+# with, which is not known to be safe to use from several threads.
+# </summary>
+def Concurrent_Probes(CmdLibAgilis):
+    return getattr(CmdLibAgilis,"bConcurrentProbes",False)
+
+# <summary>
+# Opens strDeviceKey on oCmdLib and identifies it. Returns the identity, or None (with the device closed) if it could
+# not be opened or is not an AG-UC8.
+# </summary>
+def Probe(oCmdLib,strDeviceKey):
+    if oCmdLib.Open(strDeviceKey) != 0:
+        return None
+    (bStatus,strIdentity) = Identify(oCmdLib)
+    if not bStatus:
+        oCmdLib.Close()
+        return None
+    return strIdentity
+
+# <summary>
+# Probes all the device keys at the same time (one after the other unless bConcurrent), each with a new controller
+# object from fnNewCmdLib. Returns (device key, identity, controller object) of the first AG-UC8 to answer, or
+# ("", "", None) if none answered within fTimeout seconds (per device, when one after the other). The other controller
+# objects are closed, and the probes not started yet are cancelled.
+# </summary>
+def Probe_Devices(lokeys,fnNewCmdLib,fTimeout=PROBE_TIMEOUT,bConcurrent=True):
+    if not lokeys:
+        return ("","",None)
+    # Imported here rather than at the top, so importing the motion library stays cheap.
+    from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeout
+
+    def probe(strDeviceKey):
+        oCmdLib = fnNewCmdLib()
+        return (strDeviceKey,Probe(oCmdLib,strDeviceKey),oCmdLib)
+
+    # Every other device that was opened successfully is closed again, whenever its probe completes.
+    def close_loser(future):
+        if not future.cancelled() and future.exception() is None:
+            (strDeviceKey,strIdentity,oCmdLib) = future.result()
+            if strIdentity is not None and oCmdLib is not winner[2]:
+                oCmdLib.Close()
+
+    executor = ThreadPoolExecutor(max_workers=len(lokeys) if bConcurrent else 1,thread_name_prefix="agilis-probe")
+    lofutures = [executor.submit(probe,strDeviceKey) for strDeviceKey in lokeys]
+    winner = ("","",None)
+    try:
+        for future in as_completed(lofutures,timeout=fTimeout if bConcurrent else fTimeout*len(lokeys)):
+            if future.exception() is None and future.result()[1] is not None:
+                winner = future.result()
+                break
+    except FuturesTimeout:
+        pass
+    for future in lofutures:
+        future.cancel()
+        future.add_done_callback(close_loser)
+    executor.shutdown(wait=False)
+    return winner
+
+# <summary>
+# Probes all the device keys like Probe_Devices, but keeps every AG-UC8 that answers within fTimeout seconds (per
+# device, when one after the other). Returns a list of (device key, identity, controller object), in the order of
+# lokeys.
+# </summary>
+def Probe_All_Devices(lokeys,fnNewCmdLib,fTimeout=PROBE_TIMEOUT,bConcurrent=True):
+    if not lokeys:
+        return []
+    from concurrent.futures import ThreadPoolExecutor, wait
+
+    def probe(strDeviceKey):
+        oCmdLib = fnNewCmdLib()
+        return (strDeviceKey,Probe(oCmdLib,strDeviceKey),oCmdLib)
+
+    # A device that answers after the timeout is closed again when its probe completes.
+    def close_late(future):
+        if not future.cancelled() and future.exception() is None and future.result()[1] is not None:
+            future.result()[2].Close()
+
+    executor = ThreadPoolExecutor(max_workers=len(lokeys) if bConcurrent else 1,thread_name_prefix="agilis-probe")
+    lofutures = [executor.submit(probe,strDeviceKey) for strDeviceKey in lokeys]
+    (done,not_done) = wait(lofutures,timeout=fTimeout if bConcurrent else fTimeout*len(lokeys))
+    for future in not_done:
+        future.cancel()
+        future.add_done_callback(close_late)
+    executor.shutdown(wait=False)
+    return [future.result() for future in lofutures
+            if future in done and future.exception() is None and future.result()[1] is not None]
@@ -0,0 +1,221 @@
+######################## Position estimator ##############################
+
+# The stages have no encoders: all the GUI knows is whether an axis is moving (axis_status, dir_status). The
+# PositionEstimator keeps an estimate of every stage's position (in steps) with its uncertainty, from what is known
+# anyway, without querying the controller:
+#  - jogs: the motion events (see events.py) say when a stage started and stopped jogging, in which direction and at
+#    which speed level; in between, it moves at the step rate of that level (the stage's calibration, see
+#    calibration.py, or the AG-UC8's nominal STEP_RATES). A wrong rate is wrong for the whole jog, so the standard
+#    deviation grows in proportion to the distance jogged (RATE_UNCERTAINTY), plus the timing of the events
+#    (TIMING_UNCERTAINTY);
+#  - step counter reads (e.g. the poller's snapshot, see poller.py) and absolute measurements are Kalman updates:
+#    the estimate moves towards the measurement by the gain P / (P + R), and its variance shrinks accordingly. An
+#    absolute measurement (see absolute.py) is on the controller's 0-1000 scale of the travel range, which has no known
+#    step equivalent: what it brings is the step counter read with it, once the scan is over (Update_Absolute).
+# The state of all stages is held in NumPy arrays, so predicting and updating is a few vector operations whatever the
+# number of stages. The events are read from the event log's ring buffer (EventLog.Since) only when an estimate is
+# asked for, so the motion path does not pay anything for it.
+
+import threading
+import time
+
+import motion
+from aguc8 import STEP_RATES
+from events import EVENTS
+
+RATE_UNCERTAINTY = 0.05             # relative error of the nominal step rates
+CALIBRATED_RATE_UNCERTAINTY = 0.01  # relative error of calibrated step rates
+TIMING_UNCERTAINTY = 0.01  # seconds: when a jog really started or stopped, around its event
+COUNTER_VARIANCE = 0.25    # variance (steps^2) of a step counter read (TP)
+INITIAL_VARIANCE = 1e12    # variance of a stage that was never measured
+UNKNOWN_STD = 1e5          # estimates less certain than this (standard deviation, steps) are unknown
+
+DIRECTIONS = dict({"positive":0, "negative":1})
+
+class PositionEstimator:
+    # <summary>
+    # lostages: the stages (stage_map's by default). calibrations: a dict mapping stages to their AxisCalibration, for
+    # the step rates. speeds: the speed levels the stages are set to now (motion.axis_speeds by default). oEvents: the
+    # EventLog to follow. fnClock: the clock of the events (time.time).
+    # </summary>
+    def __init__(self,lostages=None,calibrations=None,speeds=None,oEvents=EVENTS,fnClock=time.time):
+        import numpy as np
+        self.np = np
+        self.lostages = list(motion.stage_map) if lostages is None else list(lostages)
+        self.index = dict((stage,i) for (i,stage) in enumerate(self.lostages))
+        nStages = len(self.lostages)
+        self.fnClock = fnClock
+        self.x = np.zeros(nStages)                        # position (steps)
+        self.P = np.full(nStages,INITIAL_VARIANCE)        # variance of the position (steps^2)
+        self.v = np.zeros(nStages)                        # velocity (steps/s), 0 when idle
+        self.d = np.zeros(nStages)                        # distance (steps) jogged since the jog started
+        self.t = np.full(nStages,fnClock())               # time the state refers to
+        # rates[stage, direction, level]: steps per second
+        self.rates = np.tile(np.array([STEP_RATES[nLevel] for nLevel in range(5)],dtype=float),(nStages,2,1))
+        self.rate_uncertainty = np.full(nStages,RATE_UNCERTAINTY)
+        self.lock = threading.Lock()
+        self.Set_Calibrations(calibrations or dict())
+        speeds = motion.axis_speeds if speeds is None else speeds
+        self.levels = np.array([speeds.get(stage,1) for stage in self.lostages],dtype=int)
+        self.oEvents = oEvents
+        self.nCursor = 0 if oEvents is None else oEvents.nWritten
+        self.counter_times = dict() # maps stages to the time of the last step counter read used
+        self.absolute_times = dict() # maps stages to the time of the last absolute measurement used
+        # statistics
+        self.nEvents = 0
+        self.nMeasurements = 0
+
+    # <summary>
+    # Integrates the jogs of the stages of calibrations (a dict mapping stages to their AxisCalibration) at their
+    # calibrated step rates from now on. The levels a calibration has no rate for keep the nominal STEP_RATES.
+    # </summary>
+    def Set_Calibrations(self,calibrations):
+        with self.lock:
+            for (stage,calibration) in calibrations.items():
+                if stage not in self.index:
+                    continue
+                for (direction,d) in DIRECTIONS.items():
+                    for (nLevel,fRate) in calibration.rates[direction].items():
+                        self.rates[self.index[stage],d,nLevel] = fRate
+                if any(calibration.rates.values()):
+                    self.rate_uncertainty[self.index[stage]] = CALIBRATED_RATE_UNCERTAINTY
+
+    # <summary>
+    # Moves the state of every stage forward to time t.
+    # </summary>
+    def _predict(self,t):
+        np = self.np
+        (x,P,d) = self._predicted(t)
+        (self.x,self.P,self.d) = (x,P,d)
+        np.maximum(self.t,t,out=self.t)
+
+    # <summary>
+    # Returns the position, variance and jogged distance of every stage at time t.
+    # </summary>
+    def _predicted(self,t):
+        np = self.np
+        dt = np.maximum(t - self.t,0.0)
+        d = self.d + np.abs(self.v)*dt
+        return (self.x + self.v*dt,self.P + (self.rate_uncertainty**2)*(d**2 - self.d**2),d)
+
+    def _started(self,stage,direction,t):
+        i = self.index[stage]
+        self._predict(t)
+        fRate = self.rates[i,DIRECTIONS[direction],self.levels[i]]
+        self.v[i] = fRate if direction == "positive" else -fRate
+        self.d[i] = 0.0
+        self.P[i] += (fRate*TIMING_UNCERTAINTY)**2
+
+    def _stopped(self,lostages,t):
+        self._predict(t)
+        for stage in lostages:
+            i = self.index[stage]
+            self.P[i] += (self.v[i]*TIMING_UNCERTAINTY)**2
+            self.v[i] = 0.0
+
+    # <summary>
+    # Takes in the motion events recorded since the last call: jogs confirmed started (Start_Motion) or stopped
+    # (Stop_Motion, emergency_stop, Stop_All_Motion), and speed changes (manage_speeds).
+    # </summary>
+    def _sync(self):
+        if self.oEvents is None:
+            return
+        (loevents,self.nCursor) = self.oEvents.Since(self.nCursor)
+        for (t,axis,direction,strCommand,result,fDuration,strMessage) in loevents:
+            if axis and axis not in self.index:
+                continue
+            if strCommand == "Start_Motion" and result is True:
+                self._started(axis,direction,t)
+            elif strCommand == "Stop_Motion" and result is True:
+                self._stopped([axis],t)
+            elif strCommand in ("emergency_stop","Stop_All_Motion") and result is True:
+                self._stopped(self.lostages,t)
+            elif strCommand == "manage_speeds" and type(result) is int:
+                self.levels[self.index[axis]] = result
+            else:
+                continue
+            self.nEvents += 1
+
+    # <summary>
+    # Jog events given directly rather than through the event log: the stage started jogging in the direction at its
+    # current speed level, at time t (now by default).
+    # </summary>
+    def Jog_Started(self,stage,direction,t=None):
+        with self.lock:
+            self._started(stage,direction,self.fnClock() if t is None else t)
+
+    def Jog_Stopped(self,stage,t=None):
+        with self.lock:
+            self._stopped([stage],self.fnClock() if t is None else t)
+
+    def Set_Speed(self,stage,nLevel):
+        with self.lock:
+            self.levels[self.index[stage]] = nLevel
+
+    # <summary>
+    # Kalman update with measurements of the positions of stages: lostages and lovalues (steps) are lists, fVariance
+    # the variance of the measurements (steps^2), taken at time t (now by default; or a list, one time per measurement).
+    # </summary>
+    def Measure(self,lostages,lovalues,fVariance,t=None):
+        np = self.np
+        with self.lock:
+            self._sync()
+            t = np.asarray(self.fnClock() if t is None else t,dtype=float)
+            self._predict(t.max())
+            indices = np.array([self.index[stage] for stage in lostages],dtype=int)
+            # A measurement older than the state is carried forward at the stage's current velocity
+            values = np.asarray(lovalues,dtype=float) + self.v[indices]*np.maximum(self.t[indices] - t,0.0)
+            gain = self.P[indices]/(self.P[indices] + fVariance)
+            self.x[indices] += gain*(values - self.x[indices])
+            self.P[indices] *= 1.0 - gain
+            self.nMeasurements += len(indices)
+
+    # <summary>
+    # Updates the estimate with the step counters of a PositionPoller snapshot (stage -> (steps, time.monotonic() of
+    # the read)). Reads that were already used are skipped.
+    # </summary>
+    def Update_Counters(self,snapshot):
+        fOffset = self.fnClock() - time.monotonic()
+        lonew = [(stage,nSteps,tRead) for (stage,(nSteps,tRead)) in snapshot.items()
+                 if stage in self.index and self.counter_times.get(stage) != tRead]
+        if not lonew:
+            return
+        for (stage,nSteps,tRead) in lonew:
+            self.counter_times[stage] = tRead
+        self.Measure([stage for (stage,nSteps,tRead) in lonew],[nSteps for (stage,nSteps,tRead) in lonew],
+                     COUNTER_VARIANCE,[tRead + fOffset for (stage,nSteps,tRead) in lonew])
+
+    # <summary>
+    # Updates the estimate with the absolute measurements of an AbsolutePositionService (stage -> Measurement, see
+    # absolute.py): the step counter read at the end of each scan. Measurements that were already used are skipped.
+    # </summary>
+    def Update_Absolute(self,measurements):
+        lonew = [(stage,measurement) for (stage,measurement) in measurements.items()
+                 if stage in self.index and self.absolute_times.get(stage) != measurement.time]
+        if not lonew:
+            return
+        for (stage,measurement) in lonew:
+            self.absolute_times[stage] = measurement.time
+        self.Measure([stage for (stage,measurement) in lonew],[measurement.steps for (stage,measurement) in lonew],
+                     COUNTER_VARIANCE,[measurement.time for (stage,measurement) in lonew])
+
+    # <summary>
+    # Returns the estimated positions and their standard deviations of all stages (NumPy arrays, in the order of
+    # lostages) at time t (now by default), without changing the state.
+    # </summary>
+    def Estimate(self,t=None):
+        np = self.np
+        with self.lock:
+            self._sync()
+            (x,P,d) = self._predicted(self.fnClock() if t is None else t)
+            return (x,np.sqrt(P))
+
+    # <summary>
+    # Returns (estimated position in steps, standard deviation) of the stage, or (None, None) if it is unknown.
+    # </summary>
+    def Position(self,stage):
+        (x,std) = self.Estimate()
+        i = self.index[stage]
+        if std[i] > UNKNOWN_STD:
+            return (None,None)
+        return (float(x[i]),float(std[i]))
@@ -0,0 +1,66 @@
+######################## Emergency stop ##############################
+
+# The AG-UC8 motor controller has 4 channels each with 2 axes, but it can only address one channel at a time.
+# Sweeping every channel and axis (as Stop_All_Motion used to do) costs 8 channel selections and 8 stop commands,
+# and the axes that are actually moving may be the last ones reached. The helpers below stop the axes we know are
+# moving first (from axis_status and stage_map), and hand back the channels that still need a precautionary sweep.
+
+from events import Record
+
+AGUC8_CHANNELS = [1,2,3,4]
+AGUC8_AXES     = [1,2]
+
+# <summary>
+# Returns the name of the stage on nAxis of nChannel according to stage_map, or "" if there is none.
+# </summary>
+def Stage_Name(stage_map,nChannel,nAxis):
+    for (stage,(nStageChannel,nStageAxis)) in (stage_map or dict()).items():
+        if (nStageChannel,nStageAxis) == (nChannel,nAxis):
+            return stage
+    return ""
+
+# <summary>
+# Stops both axes of the specified channel. Stopping an axis that is not moving is harmless, so we always stop
+# both: this way an axis that moved without the program knowing (e.g. a failed start) is caught as well.
+# stage_map is only used to name the stages in the events of failures.
+# Returns True if the channel was selected and both stop commands succeeded, False otherwise.
+# </summary>
+def Stop_Channel(oCmdLib,nChannel,stage_map=None):
+    if not oCmdLib.SetChannel (nChannel):
+        Record("SetChannel",result=False,
+               strMessage="ERROR! Could not set channel {} while stopping motion!\n".format(nChannel))
+        return False
+
+    bStatus = True
+    for nAxis in AGUC8_AXES:
+        if not oCmdLib.StopMotion (nAxis):
+            Record("StopMotion",Stage_Name(stage_map,nChannel,nAxis),result=False,
+                   strMessage="ERROR! Could not stop axis {} on channel {}!\n".format(nAxis,nChannel))
+            bStatus = False
+    return bStatus
+
+# <summary>
+# Returns the channels that have at least one moving stage according to axis_status, in stage_map order.
+# </summary>
+def Active_Channels(stage_map,axis_status):
+    lochannel = []
+    for axis in stage_map:
+        (nChannel,nAxis) = stage_map[axis]
+        if axis_status.get(axis) and nChannel not in lochannel:
+            lochannel.append(nChannel)
+    return lochannel
+
+# <summary>
+# Halts every channel with a moving stage, without any pacing delay between commands.
+# Returns (bStatus, lochannel): bStatus is True if all moving channels were stopped successfully, and lochannel is
+# the list of remaining (idle) channels that should still be swept with Stop_Channel once the moving ones are safe.
+# </summary>
+def Emergency_Stop(oCmdLib,stage_map,axis_status):
+    loactive = Active_Channels(stage_map,axis_status)
+    bStatus = True
+    for nChannel in loactive:
+        if not Stop_Channel(oCmdLib,nChannel,stage_map):
+            bStatus = False
+
+    lochannel = [nChannel for nChannel in AGUC8_CHANNELS if nChannel not in loactive]
+    return (bStatus,lochannel)
@@ -0,0 +1,207 @@
+######################## Motion event log ##############################
+
+# The motion callbacks used to print() on every key event. print() blocks until the console has taken the text, and a
+# slow console (the Windows console, a pipe nobody reads fast enough) puts that wait on the motion path. Instead, the
+# callbacks Record structured events into a preallocated ring buffer, which costs a lock and a few list stores:
+#     (time, axis, direction, command, result, duration, message)
+# A background thread (started with EventLog.Start) writes the events to a rotating log file as JSON lines, and
+# prints their messages to the console, so the operator still sees them.
+# If the flusher falls behind by more than the capacity of the buffer, the oldest events are overwritten (and counted
+# in nDropped). Dump writes the events still in the buffer, newest last; Install_Crash_Handler does so when the
+# program dies of an unhandled exception.
+
+import json
+import os
+import sys
+import threading
+import time
+
+# Where the event log is written. Can be changed with the environment variable AGILIS_EVENT_LOG.
+EVENT_LOG_PATH = os.environ.get ("AGILIS_EVENT_LOG",
+                                 os.path.join (os.path.expanduser ("~"), ".micropositioners", "events.log"))
+
+EVENT_CAPACITY      = 4096    # events kept in the ring buffer
+EVENT_LOG_MAX_BYTES = 1 << 20 # size at which the log file is rotated
+EVENT_LOG_BACKUPS   = 3       # rotated files kept: events.log.1 ... events.log.3
+FLUSH_PERIOD        = 0.2     # seconds between two flushes
+
+FIELDS = ("time","axis","direction","command","result","duration","message")
+
+class EventLog:
+    def __init__(self,nCapacity=EVENT_CAPACITY):
+        self.nCapacity = nCapacity
+        # One preallocated list per field, indexed by event number modulo nCapacity
+        self.times      = [0.0]*nCapacity
+        self.axes       = [""]*nCapacity
+        self.directions = [""]*nCapacity
+        self.commands   = [""]*nCapacity
+        self.results    = [None]*nCapacity
+        self.durations  = [0.0]*nCapacity
+        self.messages   = [""]*nCapacity
+        self.nWritten = 0 # events recorded so far
+        self.nFlushed = 0 # events handed to the flusher so far
+        self.nDropped = 0 # events overwritten before they were flushed
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.strPath = None
+        self.bEcho = False
+        self.stop = None
+        self.thread = None
+
+    # <summary>
+    # Records an event. duration is in seconds (e.g. from submitting a command to its completion), message is the
+    # text for the console.
+    # </summary>
+    def Record(self,strCommand,axis="",direction="",result=None,fDuration=0.0,strMessage=""):
+        tNow = time.time()
+        with self.lock:
+            i = self.nWritten % self.nCapacity
+            self.times[i] = tNow
+            self.axes[i] = axis
+            self.directions[i] = direction or ""
+            self.commands[i] = strCommand
+            self.results[i] = result
+            self.durations[i] = fDuration
+            self.messages[i] = strMessage
+            self.nWritten += 1
+
+    def _event(self,i):
+        i %= self.nCapacity
+        return (self.times[i],self.axes[i],self.directions[i],self.commands[i],self.results[i],self.durations[i],
+                self.messages[i])
+
+    # <summary>
+    # Returns the events recorded since the last call, oldest first (at most nCapacity of them).
+    # </summary>
+    def Drain(self):
+        with self.lock:
+            nStart = max(self.nFlushed,self.nWritten - self.nCapacity)
+            self.nDropped += nStart - self.nFlushed
+            loevents = [self._event(i) for i in range(nStart,self.nWritten)]
+            self.nFlushed = self.nWritten
+        return loevents
+
+    # <summary>
+    # Returns (the events recorded from event number nCursor on, oldest first; the cursor to pass next time), without
+    # taking them from the flusher, so any number of readers can follow the events. Events already overwritten are
+    # skipped.
+    # </summary>
+    def Since(self,nCursor):
+        with self.lock:
+            return ([self._event(i) for i in range(max(nCursor,self.nWritten - self.nCapacity),self.nWritten)],
+                    self.nWritten)
+
+    # <summary>
+    # Returns the events still in the buffer, flushed or not, oldest first.
+    # </summary>
+    def Snapshot(self):
+        with self.lock:
+            return [self._event(i) for i in range(max(0,self.nWritten - self.nCapacity),self.nWritten)]
+
+    # <summary>
+    # Starts the background flusher: events are appended to strPath (rotated at nMaxBytes, nBackups files kept) and,
+    # if bEcho, their messages are printed.
+    # </summary>
+    def Start(self,strPath=None,bEcho=True,fPeriod=FLUSH_PERIOD,nMaxBytes=EVENT_LOG_MAX_BYTES,
+              nBackups=EVENT_LOG_BACKUPS):
+        self.strPath = strPath or EVENT_LOG_PATH
+        self.bEcho = bEcho
+        self.nMaxBytes = nMaxBytes
+        self.nBackups = nBackups
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.strPath)),exist_ok=True)
+        except OSError as e:
+            print("Could not create the event log folder: {}".format(e))
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run,args=(fPeriod,),name="agilis-events",daemon=True)
+        self.thread.start()
+
+    def _run(self,fPeriod):
+        while not self.stop.wait(fPeriod):
+            self.Flush()
+        self.Flush()
+
+    # <summary>
+    # Writes the pending events to the log file (and the console). Called by the flusher; can also be called
+    # directly, e.g. before exiting.
+    # </summary>
+    def Flush(self):
+        with self.flush_lock:
+            loevents = self.Drain()
+            if not loevents:
+                return
+            if self.bEcho:
+                for event in loevents:
+                    if event[6]:
+                        print(event[6])
+            if self.strPath is None:
+                return
+            try:
+                self._rotate()
+                with open(self.strPath,"a") as f:
+                    for event in loevents:
+                        f.write(json.dumps(dict(zip(FIELDS,event)),default=str) + "\n")
+            except OSError as e:
+                print("Could not write the event log {}: {}".format(self.strPath,e))
+
+    def _rotate(self):
+        try:
+            if os.path.getsize(self.strPath) < self.nMaxBytes:
+                return
+        except OSError:
+            return
+        for n in range(self.nBackups-1,0,-1):
+            if os.path.exists("{}.{}".format(self.strPath,n)):
+                os.replace("{}.{}".format(self.strPath,n),"{}.{}".format(self.strPath,n+1))
+        os.replace(self.strPath,self.strPath + ".1")
+
+    # <summary>
+    # Stops the background flusher, after a last flush.
+    # </summary>
+    def Shutdown(self):
+        if self.thread is not None:
+            self.stop.set()
+            self.thread.join()
+            self.thread = None
+
+    # <summary>
+    # Writes every event still in the buffer to strPath as JSON lines (<log file>.crash by default). Returns the path.
+    # </summary>
+    def Dump(self,strPath=None):
+        strPath = strPath or (self.strPath or EVENT_LOG_PATH) + ".crash"
+        with open(strPath,"w") as f:
+            for event in self.Snapshot():
+                f.write(json.dumps(dict(zip(FIELDS,event)),default=str) + "\n")
+        return strPath
+
+    # <summary>
+    # Flushes and dumps the buffer when an unhandled exception reaches the top of the main thread or of another
+    # thread. The previous hooks still run afterwards.
+    # </summary>
+    def Install_Crash_Handler(self):
+        previous_hook = sys.excepthook
+        previous_thread_hook = threading.excepthook
+
+        def excepthook(*args):
+            self.On_Crash()
+            previous_hook(*args)
+
+        def thread_excepthook(args):
+            self.On_Crash()
+            previous_thread_hook(args)
+
+        sys.excepthook = excepthook
+        threading.excepthook = thread_excepthook
+
+    def On_Crash(self):
+        try:
+            self.Flush()
+            print("Motion events dumped to {}".format(self.Dump()))
+        except Exception as e:
+            print("Could not dump the motion events: {}".format(e))
+
+# The event log of the motion library and the GUI.
+EVENTS = EventLog()
+
+def Record(strCommand,axis="",direction="",result=None,fDuration=0.0,strMessage=""):
+    EVENTS.Record(strCommand,axis,direction,result,fDuration,strMessage)
@@ -0,0 +1,355 @@
+######################## Go-to-position engine ##############################
+
+# app.py can only jog a stage until its key is released. GotoEngine moves stages to target positions, and returns a
+# Future per request that completes with the position reached (asyncio code can await it with asyncio.wrap_future):
+#  - Goto(stage, fMicrons): the target is in micrometres from the stage's origin, its step counter's zero (set by
+#    the controller at power-up). Steps forwards and backwards are not the same size (see calibration.py), so the step
+#    counter alone does not say where a stage is: the engine tracks the position of every stage in micrometres, with
+#    the step counter it was at. Each move adds the steps it made times the step size of its direction. Before the
+#    first move of a stage, it is taken to have gone straight from the origin to its step counter. The step counter is
+#    read just before each move, so the steps made since (e.g. jogs) are added too, at the step size of their net
+#    direction. The relative move (PR) is the distance to the target divided by the step size of that direction;
+#  - Goto(stage, nTarget, bAbsolute=True): the target is on the controller's absolute scale (0 to 1000 of the travel
+#    range) and is reached with an absolute move (PA), which makes the controller find the position first (slow, see
+#    absolute.py);
+#  - the end of a move is detected by polling the axis status (TS) with backoff: the first poll comes when the move
+#    should be over (from the AG-UC8's nominal RELATIVE_STEP_RATE, see aguc8.py), then the interval doubles from
+#    GOTO_POLL_MIN up to GOTO_POLL_MAX, so a long move costs a few queries rather than one every few milliseconds;
+#  - requests for the same channel are sequenced with minimal gaps: every turn on the motion worker polls the moving
+#    axes that are due and starts the next request of every axis that is ready, so an axis that finishes is given its
+#    next target in the same turn, and the two axes of a channel move at the same time;
+#  - another channel is only selected once the current one has nothing left to do, moving or queued, and then the
+#    channel of the oldest request is served: requests are grouped by channel however they arrive. So that a busy
+#    channel does not hold up the others for ever, no new request is started on it once another channel has waited
+#    for GOTO_CHANNEL_HOLD seconds.
+# A move that ends short of its target (e.g. because of a stop) fails its Future with RuntimeError and cancels the
+# stage's requests queued after it. Turns are ordinary motion commands, so stops overtake them, and a stop of a stage
+# cancels the turn queued for it, and with it the stage's requests.
+
+import threading
+import time
+from concurrent.futures import CancelledError, Future
+
+import motion
+from aguc8 import RELATIVE_STEP_RATE
+from calibration import CalibrationStore, Controller_Key, Current_Amplitudes
+
+GOTO_POLL_MIN = 0.005     # seconds: first interval between polls of a move that should be over
+GOTO_POLL_MAX = 0.5       # seconds: the longest interval the polls back off to
+GOTO_CHANNEL_HOLD = 2.0   # seconds another channel may wait before no new request is started on the current one
+GOTO_COMMAND_TIMEOUT = 1.0 # seconds a turn may wait on the motion worker before it is stale
+
+class GotoRequest:
+    __slots__ = ("stage","nChannel","nAxis","target","bAbsolute","future","tQueued","nStart","nSteps","tDue",
+                 "fPoll","fStart","calibration")
+
+    def __init__(self,stage,nChannel,nAxis,target,bAbsolute,future):
+        self.stage = stage
+        self.nChannel = nChannel
+        self.nAxis = nAxis
+        self.target = target
+        self.bAbsolute = bAbsolute
+        self.future = future
+        self.tQueued = time.monotonic()
+        self.nStart = 0      # step counter when the move was started
+        self.nSteps = 0      # steps of the relative move (0 for an absolute move)
+        self.tDue = 0.0      # time.monotonic() of the next poll
+        self.fPoll = 0.0     # interval before the poll after that
+        self.fStart = 0.0    # position (um) when the move was started
+        self.calibration = None # the AxisCalibration of the move
+
+# <summary>
+# Runs on the motion worker: one turn of a channel. Selects nChannel, polls the status of the axes of poll (axis ->
+# step counter the move in progress should end at, None if not known), and starts the request of every axis of starts
+# (axis -> GotoRequest) that is (now) ready, unless its last move ended short, or the request was cancelled.
+# fnSteps(request, step counter) returns the steps of a relative move; if it raises ValueError, the request fails with
+# it.
+# Returns (bStatus, done, started): done maps the polled axes that are ready to their step counter, started maps the
+# axes that were started to their step counter before the move. bStatus is False if a command failed.
+# </summary>
+def Goto_Turn(oCmdLib,nChannel,poll,starts,fnSteps):
+    done = dict()
+    started = dict()
+    if not oCmdLib.SetChannel(nChannel):
+        return (False,done,started)
+    for nAxis in poll:
+        (bStatus,nState) = oCmdLib.GetAxisStatus(nAxis)
+        if bStatus and nState == 0:
+            (bStatus,done[nAxis]) = oCmdLib.GetStepCount(nAxis)
+        if not bStatus:
+            done.pop(nAxis,None)
+            return (False,done,started)
+    for (nAxis,request) in starts.items():
+        if nAxis in poll and (nAxis not in done or poll[nAxis] not in (None,done[nAxis])):
+            continue # still moving, or stopped on the way
+        if nAxis in done:
+            nCount = done[nAxis]
+        else:
+            (bStatus,nCount) = oCmdLib.GetStepCount(nAxis)
+            if not bStatus:
+                return (False,done,started)
+        if not request.future.set_running_or_notify_cancel():
+            continue
+        if request.bAbsolute:
+            bStatus = oCmdLib.AbsoluteMove(nAxis,request.target)
+        else:
+            try:
+                request.nSteps = fnSteps(request,nCount)
+            except ValueError as e: # not calibrated at the step amplitudes the stage is set to
+                request.future.set_exception(e)
+                continue
+            bStatus = request.nSteps == 0 or oCmdLib.RelativeMove(nAxis,request.nSteps)
+        if not bStatus:
+            return (False,done,started)
+        started[nAxis] = nCount
+    return (True,done,started)
+
+class GotoEngine:
+    # <summary>
+    # worker: the MotionWorker that owns the controller. fnCmdLib and stage_map: see stepmove.StepMover.
+    # calibrations: a dict mapping stages to their AxisCalibration; by default, they are read from the CalibrationStore
+    # for the connected controller. Either way, a relative move uses the calibration made at the step amplitudes the
+    # stage is set to when the move starts (see calibration.py).
+    # </summary>
+    def __init__(self,worker,fnCmdLib=None,stage_map=None,calibrations=None,fChannelHold=GOTO_CHANNEL_HOLD):
+        self.worker = worker
+        self.fnCmdLib = (lambda:motion.oCmdLib) if fnCmdLib is None else fnCmdLib
+        self.stage_map = motion.stage_map if stage_map is None else stage_map
+        self.calibrations = dict() if calibrations is None else dict(calibrations)
+        self.store = None         # the CalibrationStore, read when first needed unless calibrations were given
+        self.positions = dict()   # maps stages to (position in um, step counter at that position)
+        self.bLoadCalibrations = calibrations is None
+        self.fChannelHold = fChannelHold
+        self.queued = []          # requests not started yet, oldest first
+        self.moving = dict()      # maps axes to the request in progress (all on channel nChannel)
+        self.nChannel = None      # the channel being served
+        self.condition = threading.Condition()
+        self.bShutdown = False
+        # statistics
+        self.nRequests = 0
+        self.nTurns = 0
+        self.nPolls = 0
+        self.nSwitches = 0
+        self.thread = threading.Thread(target=self._run,name="goto",daemon=True)
+        self.thread.start()
+
+    # <summary>
+    # Returns the calibration of the stage at the step amplitudes (positive, negative; None if not known), or raises
+    # ValueError if its step sizes are not calibrated at those amplitudes.
+    # </summary>
+    def _calibration(self,stage,amplitudes=None):
+        if self.bLoadCalibrations:
+            if self.store is None:
+                self.store = CalibrationStore()
+            calibration = self.store.Find(Controller_Key(),stage,amplitudes)
+        else:
+            calibration = self.calibrations.get(stage)
+            if calibration is not None and None not in (amplitudes,calibration.amplitudes) and \
+               calibration.amplitudes != tuple(amplitudes):
+                calibration = None
+        if calibration is None or None in calibration.um_per_step.values():
+            raise ValueError("The step size of {} is not calibrated{} (see calibration.py).".format(
+                             stage,"" if amplitudes is None else " at step amplitudes {:+d}/{:+d}".format(*amplitudes)))
+        return calibration
+
+    # <summary>
+    # Returns the step amplitudes (positive, negative) of the stage if the controller cache knows them, else None.
+    # Sends nothing.
+    # </summary>
+    def _cached_amplitudes(self,stage):
+        (nChannel,nAxis) = self.stage_map[stage]
+        oCmdLib = self.fnCmdLib()
+        if not hasattr(oCmdLib,"Cached_Step_Amplitude"):
+            return None
+        loamplitudes = [oCmdLib.Cached_Step_Amplitude(nChannel,nAxis,bPositive) for bPositive in (True,False)]
+        return None if None in loamplitudes else tuple(loamplitudes)
+
+    # <summary>
+    # Returns the position (um) of the stage with step counter nCount: its tracked position plus the steps since, at
+    # the step size of their direction.
+    # </summary>
+    def Microns(self,stage,nCount):
+        return self._position(stage,nCount,self._calibration(stage,self._cached_amplitudes(stage)))
+
+    def _position(self,stage,nCount,calibration):
+        (fPosition,nReference) = self.positions.get(stage,(0.0,0))
+        return fPosition + calibration.Microns(nCount - nReference)
+
+    # Runs on the motion worker (from Goto_Turn): the steps from step counter nCount to the request's target.
+    def _steps(self,request,nCount):
+        request.calibration = self._calibration(request.stage,
+                                                Current_Amplitudes(self.fnCmdLib(),self.stage_map,request.stage))
+        request.fStart = self._position(request.stage,nCount,request.calibration)
+        return request.calibration.Steps(request.target - request.fStart)
+
+    # <summary>
+    # Moves the stage to target: micrometres from its origin, or if bAbsolute, a position from 0 to 1000 of its travel
+    # range. Returns the Future of the request, see the top of this file. If callback is given, it is called with the
+    # Future by the worker's Run_Callbacks (i.e. on the Tk thread). Raises ValueError if the stage is not calibrated.
+    # </summary>
+    def Goto(self,stage,target,bAbsolute=False,callback=None):
+        (nChannel,nAxis) = self.stage_map[stage]
+        if bAbsolute:
+            if not 0 <= target <= 1000:
+                raise ValueError("Absolute target {} of {} is not between 0 and 1000.".format(target,stage))
+            target = int(target)
+        else:
+            self._calibration(stage,self._cached_amplitudes(stage))
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(lambda future:self.worker.callbacks.put((callback,future)))
+        with self.condition:
+            self.queued.append(GotoRequest(stage,nChannel,nAxis,target,bAbsolute,future))
+            self.nRequests += 1
+            self.condition.notify_all()
+        return future
+
+    # <summary>
+    # Returns True if a request for another channel than the current one has waited too long. Called with the
+    # condition held.
+    # </summary>
+    def _starving(self,tNow):
+        return any(request.nChannel != self.nChannel and tNow - request.tQueued > self.fChannelHold
+                   for request in self.queued)
+
+    # <summary>
+    # Returns the channel to serve: the current one while it has requests moving, or queued (unless another channel
+    # has waited too long), else that of the oldest request. Called with the condition held.
+    # </summary>
+    def _channel(self,tNow):
+        if self.moving:
+            return self.nChannel
+        if not self._starving(tNow) and any(request.nChannel == self.nChannel for request in self.queued):
+            return self.nChannel
+        return self.queued[0].nChannel
+
+    # <summary>
+    # Returns the requests to start on the channel: the oldest request of every axis that is not moving (or is due to
+    # be polled, as it may be ready), unless another channel has waited too long. Called with the condition held.
+    # </summary>
+    def _starts(self,nChannel,tNow):
+        if self.moving and self._starving(tNow):
+            return dict()
+        starts = dict()
+        for request in self.queued:
+            if request.nChannel == nChannel and request.nAxis not in starts and \
+               (request.nAxis not in self.moving or self.moving[request.nAxis].tDue <= tNow):
+                starts[request.nAxis] = request
+        return starts
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.queued = [request for request in self.queued if not request.future.done()]
+                while not self.queued and not self.moving and not self.bShutdown:
+                    self.condition.wait()
+                if self.bShutdown and not self.queued and not self.moving:
+                    return
+                tNow = time.monotonic()
+                nChannel = self._channel(tNow)
+                poll = dict((nAxis,None if request.bAbsolute else request.nStart + request.nSteps)
+                            for (nAxis,request) in self.moving.items() if request.tDue <= tNow)
+                starts = self._starts(nChannel,tNow)
+                if not poll and not [nAxis for nAxis in starts if nAxis not in self.moving]:
+                    # Nothing to do before the next poll, unless a request arrives
+                    self.condition.wait(min(request.tDue for request in self.moving.values()) - tNow
+                                        if self.moving else None)
+                    continue
+            self._turn(nChannel,poll,starts)
+
+    # <summary>
+    # Runs one turn on the motion worker and takes in its results.
+    # </summary>
+    def _turn(self,nChannel,poll,starts):
+        lostages = sorted(set([request.stage for request in starts.values()] +
+                              [self.moving[nAxis].stage for nAxis in poll]),key=str)
+        future = self.worker.Submit(Goto_Turn,self.fnCmdLib(),nChannel,poll,starts,self._steps,axes=lostages,
+                                    timeout=GOTO_COMMAND_TIMEOUT)
+        try:
+            (bStatus,done,started) = future.result()
+        except BaseException as e: # cancelled by a stop, stale, hung or failed
+            self._fail(e,lostages)
+            return
+        tNow = time.monotonic()
+        with self.condition:
+            self.nTurns += 1
+            self.nPolls += len(poll)
+            if nChannel != self.nChannel:
+                self.nSwitches += self.nChannel is not None
+                self.nChannel = nChannel
+            for nAxis in poll:
+                request = self.moving[nAxis]
+                if nAxis in done:
+                    del self.moving[nAxis]
+                    self._finish(request,done[nAxis])
+                else:
+                    request.tDue = tNow + request.fPoll
+                    request.fPoll = min(2*request.fPoll,GOTO_POLL_MAX)
+            for (nAxis,nCount) in started.items():
+                request = starts[nAxis]
+                self.queued.remove(request)
+                request.nStart = nCount
+                if not request.bAbsolute:
+                    # Where the move ends, unless it is cut short (see _finish)
+                    self.positions[request.stage] = (request.fStart + request.calibration.Microns(request.nSteps),
+                                                     nCount + request.nSteps)
+                if not request.bAbsolute and request.nSteps == 0:
+                    request.future.set_result(request.fStart)
+                    continue
+                # The first poll when the move should be over; an absolute move's scan takes an unknown time
+                request.tDue = tNow + (abs(request.nSteps)/RELATIVE_STEP_RATE if not request.bAbsolute else 0.0)
+                request.fPoll = GOTO_POLL_MIN
+                self.moving[nAxis] = request
+        if not bStatus:
+            self._fail(RuntimeError("A go-to move on channel {} failed.".format(nChannel)),lostages)
+
+    # <summary>
+    # Completes the request whose axis is ready with step counter nCount. Called with the condition held.
+    # </summary>
+    def _finish(self,request,nCount):
+        if request.bAbsolute:
+            request.future.set_result(request.target)
+            return
+        fReached = request.fStart + request.calibration.Microns(nCount - request.nStart)
+        if nCount - request.nStart != request.nSteps:
+            # The move was cut short: whatever stopped the stage also stops its queued requests
+            self.positions[request.stage] = (fReached,nCount)
+            request.future.set_exception(RuntimeError("{} stopped {} steps short of its target.".format(
+                                         request.stage,request.nSteps - (nCount - request.nStart))))
+            for queued in [queued for queued in self.queued if queued.stage == request.stage]:
+                self.queued.remove(queued)
+                queued.future.cancel()
+            return
+        request.future.set_result(fReached)
+
+    # <summary>
+    # A turn of lostages did not go through. If it was cancelled (a stop of some of them overtook it), the requests of
+    # those stages are cancelled. Otherwise the state of the channel is unknown: the requests in progress on it and
+    # those queued for lostages fail with the exception. A relative move in progress may have ended anywhere, so the
+    # position of its stage goes back to where the move started: the next step counter read adds the steps it made.
+    # </summary>
+    def _fail(self,e,lostages):
+        bCancelled = isinstance(e,CancelledError)
+        with self.condition:
+            lofailed = [request for request in self.queued if request.stage in lostages]
+            self.queued = [request for request in self.queued if request.stage not in lostages]
+            for (nAxis,request) in list(self.moving.items()):
+                if request.stage in lostages or not bCancelled:
+                    lofailed.append(self.moving.pop(nAxis))
+                    if not request.bAbsolute:
+                        self.positions[request.stage] = (request.fStart,request.nStart)
+            if not bCancelled:
+                self.nChannel = None
+        for request in lofailed:
+            # A request whose move was started cannot be cancelled any more: it fails with the exception instead
+            if not request.future.done() and not (bCancelled and request.future.cancel()):
+                request.future.set_exception(e)
+
+    # <summary>
+    # Stops the engine thread once the requests queued have been carried out.
+    # </summary>
+    def Shutdown(self):
+        with self.condition:
+            self.bShutdown = True
+            self.condition.notify_all()
+        self.thread.join()
@@ -0,0 +1,108 @@
+######################## Key auto-repeat filter ##############################
+
+# Holding an arrow key makes the operating system repeat it. On X11 every repeat arrives as a release immediately
+# followed by a press, on Windows as extra presses without releases. Bound directly to run_motor/stop_motor, a held key
+# therefore stops and restarts the stage dozens of times per second: a storm of SetChannel/StartJogging/StopMotion
+# transactions, and stuttering motion.
+#
+# KeyRepeatFilter sits between the key bindings and the motion callbacks and turns a held key into exactly one press
+# and one release:
+#  - a press of a key that is already held is a repeat, and is suppressed;
+#  - a release is not passed on at once: it is confirmed after a short window (nWindow ms, scheduled with Tk's after).
+#    If the key is pressed again within the window, the release and the press were an auto-repeat pair and both are
+#    suppressed; otherwise the release is passed on when the window expires.
+# The cost is that a real release reaches stop_motor nWindow ms late. X11 delivers both halves of a repeat pair
+# together, so the window only has to cover the event loop's latency.
+
+import time
+
+RELEASE_WINDOW = 30 # ms
+
+class KeyRepeatFilter:
+    # <summary>
+    # fnAfter(ms, function) schedules function and returns an id, fnCancel(id) cancels it: root.after and
+    # root.after_cancel, or stand-ins when replaying recorded events.
+    # on_press(key) / on_release(key) are called once per held key. Keys can be anything hashable.
+    # fnClock: where event times come from (only used for the statistics and recordings).
+    # </summary>
+    def __init__(self,fnAfter,fnCancel,on_press,on_release,nWindow=RELEASE_WINDOW,fnClock=time.perf_counter):
+        self.fnAfter = fnAfter
+        self.fnCancel = fnCancel
+        self.on_press = on_press
+        self.on_release = on_release
+        self.nWindow = nWindow
+        self.fnClock = fnClock
+        self.held = set()         # keys that are down, as far as the motion callbacks know
+        self.pending = dict()     # maps keys whose release is waiting to be confirmed to the id of the timer
+        self.lorecording = None   # if a list, every raw event is appended to it as (time, "press"/"release", key)
+        # statistics
+        self.tFirst = None
+        self.nEvents = 0          # raw key events
+        self.nSuppressed = 0      # raw key events that were not passed on
+        self.nPresses = 0         # presses passed on
+        self.nReleases = 0        # releases passed on
+
+    def _event(self,strKind,key):
+        tNow = self.fnClock()
+        if self.tFirst is None:
+            self.tFirst = tNow
+        self.nEvents += 1
+        if self.lorecording is not None:
+            self.lorecording.append((tNow,strKind,key))
+
+    def Press(self,key):
+        self._event("press",key)
+        if key in self.pending:
+            # Pressed again within the window: the release was half of an auto-repeat pair
+            self.fnCancel(self.pending.pop(key))
+            self.nSuppressed += 2
+        elif key in self.held:
+            self.nSuppressed += 1
+        else:
+            self.held.add(key)
+            self.nPresses += 1
+            self.on_press(key)
+
+    def Release(self,key):
+        self._event("release",key)
+        if key not in self.held:
+            self.nSuppressed += 1
+            return
+        if key in self.pending:
+            self.fnCancel(self.pending.pop(key))
+            self.nSuppressed += 1
+        self.pending[key] = self.fnAfter(self.nWindow,lambda:self._confirm(key))
+
+    def _confirm(self,key):
+        if self.pending.pop(key,None) is None:
+            return
+        self.held.discard(key)
+        self.nReleases += 1
+        self.on_release(key)
+
+    # <summary>
+    # Releases every held key at once, whether its release is waiting for the window or has not arrived at all. Used
+    # when the window loses focus: the release of a held key would then go to another window.
+    # </summary>
+    def Release_All(self):
+        for key in list(self.pending):
+            self.fnCancel(self.pending.pop(key))
+        for key in list(self.held):
+            self.held.discard(key)
+            self.nReleases += 1
+            self.on_release(key)
+
+    # <summary>
+    # Returns the filter statistics as a dict: raw events, suppressed events, presses and releases passed on, and the
+    # suppressed event rate (per second, since the first event).
+    # </summary>
+    def Stats(self):
+        fElapsed = self.fnClock() - self.tFirst if self.tFirst is not None else 0.0
+        return dict({"events":self.nEvents, "suppressed":self.nSuppressed, "presses":self.nPresses,
+                     "releases":self.nReleases, "suppressed_rate":self.nSuppressed/fElapsed if fElapsed > 0 else 0.0})
+
+    def Report(self):
+        stats = self.Stats()
+        return ("Keys: {} events, {} suppressed as auto-repeat ({:.1f}/s), "
+                "{} presses and {} releases passed on").format(
+                stats["events"],stats["suppressed"],stats["suppressed_rate"],stats["presses"],stats["releases"])
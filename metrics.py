@@ -0,0 +1,264 @@
+######################## Command metrics ##############################
+
+# Pacing_Report and the cache Report print a summary once, at shutdown. To see how the controller link behaves while
+# the rig is running, InstrumentedCmdLib wraps a CmdLibAgilis object and records, per controller and per command:
+#  - a latency histogram (fixed buckets, so recording is a bisect and two additions);
+#  - the number of failed commands;
+#  - the number of channel switches (SetChannel to a channel other than the current one).
+# Gauges (e.g. the queue depths of a MotionWorker, see Register_Worker) are read when the metrics are rendered, so they
+# cost nothing in between.
+#
+# The metrics are rendered in the Prometheus text format, and can be exposed in two ways, both off the motion path:
+#  - Start_Http_Server serves them on http://127.0.0.1:<port>/metrics from a daemon thread;
+#  - Start_Textfile_Writer rewrites a file periodically (e.g. for the node_exporter textfile collector).
+# app.py starts them when AGILIS_METRICS_PORT / AGILIS_METRICS_FILE are set.
+
+import bisect
+import os
+import threading
+import time
+
+from pacing import Command_Failed
+
+# Upper bounds (seconds) of the latency histogram buckets. The AG-UC8 answers in about a millisecond, a hung command
+# takes up to the motion lane timeout.
+LATENCY_BUCKETS = (0.0005,0.001,0.002,0.005,0.01,0.02,0.05,0.1,0.25,0.5,1.0,2.5)
+
+# Where the metrics are exposed by app.py, see above. Not exposed if not set.
+METRICS_PORT = os.environ.get("AGILIS_METRICS_PORT","")
+METRICS_FILE = os.environ.get("AGILIS_METRICS_FILE","")
+
+# How often (seconds) the metrics file is rewritten.
+TEXTFILE_PERIOD = 5.0
+
+class Histogram:
+    __slots__ = ("counts","fSum","nCount")
+
+    def __init__(self):
+        self.counts = [0]*(len(LATENCY_BUCKETS)+1) # the last bucket is +Inf
+        self.fSum = 0.0
+        self.nCount = 0
+
+    def Observe(self,fValue):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS,fValue)] += 1
+        self.fSum += fValue
+        self.nCount += 1
+
+    # <summary>
+    # Returns the value below which the fraction fQuantile of the observations fall, to the upper bound of its bucket.
+    # </summary>
+    def Quantile(self,fQuantile):
+        nRank = fQuantile*self.nCount
+        nCumulative = 0
+        for (i,nBucket) in enumerate(self.counts):
+            nCumulative += nBucket
+            if nCumulative >= nRank and nCumulative:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float("inf")
+        return 0.0
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # histograms and counters map (name, labels) to their value, labels being a tuple of (label, value) pairs
+        self.histograms = dict()
+        self.counters = dict()
+        # gauges map (name, labels) to a function returning the current value
+        self.gauges = dict()
+        self.help = dict()
+
+    def Describe(self,strName,strHelp):
+        self.help[strName] = strHelp
+
+    # <summary>
+    # Returns the histogram (name, labels), creating it if needed. Callers may keep it and Observe it under self.lock.
+    # </summary>
+    def Histogram(self,strName,labels):
+        with self.lock:
+            return self.histograms.setdefault((strName,labels),Histogram())
+
+    def Increment(self,strName,labels,nAmount=1):
+        with self.lock:
+            self.counters[(strName,labels)] = self.counters.get((strName,labels),0) + nAmount
+
+    def Add_Gauge(self,strName,labels,function):
+        with self.lock:
+            self.gauges[(strName,labels)] = function
+
+    def Remove_Gauges(self,labels):
+        with self.lock:
+            for key in [key for key in self.gauges if set(labels) <= set(key[1])]:
+                del self.gauges[key]
+
+    # <summary>
+    # Returns all the metrics in the Prometheus text exposition format.
+    # </summary>
+    def Render(self):
+        with self.lock:
+            histograms = [(key,list(o.counts),o.fSum,o.nCount) for (key,o) in self.histograms.items()]
+            counters = list(self.counters.items())
+            gauges = list(self.gauges.items())
+        lolines = []
+        described = set()
+
+        def header(strName,strType):
+            if strName not in described:
+                described.add(strName)
+                if strName in self.help:
+                    lolines.append("# HELP {} {}".format(strName,self.help[strName]))
+                lolines.append("# TYPE {} {}".format(strName,strType))
+
+        for ((strName,labels),counts,fSum,nCount) in sorted(histograms):
+            header(strName,"histogram")
+            nCumulative = 0
+            for (fBound,nBucket) in zip(list(LATENCY_BUCKETS)+["+Inf"],counts):
+                nCumulative += nBucket
+                lolines.append("{}_bucket{} {}".format(strName,Format_Labels(labels+(("le",str(fBound)),)),
+                                                       nCumulative))
+            lolines.append("{}_sum{} {}".format(strName,Format_Labels(labels),fSum))
+            lolines.append("{}_count{} {}".format(strName,Format_Labels(labels),nCount))
+        for ((strName,labels),nValue) in sorted(counters):
+            header(strName,"counter")
+            lolines.append("{}{} {}".format(strName,Format_Labels(labels),nValue))
+        for ((strName,labels),function) in sorted(gauges,key=lambda item:item[0]):
+            header(strName,"gauge")
+            try:
+                value = function()
+            except Exception:
+                value = float("nan")
+            lolines.append("{}{} {}".format(strName,Format_Labels(labels),value))
+        return "\n".join(lolines) + "\n"
+
+    # <summary>
+    # Writes Render() to strPath, replacing the file in one step so readers never see half of it.
+    # </summary>
+    def Write_Textfile(self,strPath):
+        strTemporary = strPath + ".tmp"
+        with open(strTemporary,"w") as f:
+            f.write(self.Render())
+        os.replace(strTemporary,strPath)
+
+def Format_Labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(strLabel,str(value).replace("\\","\\\\").replace('"','\\"'))
+                          for (strLabel,value) in labels) + "}"
+
+# The registry the motion library records into.
+REGISTRY = Registry()
+REGISTRY.Describe("agilis_command_duration_seconds","Time spent inside each controller library call.")
+REGISTRY.Describe("agilis_command_errors_total","Controller library calls that failed or raised.")
+REGISTRY.Describe("agilis_channel_switches_total","SetChannel calls that selected a different channel.")
+REGISTRY.Describe("agilis_queue_depth","Commands waiting in a motion worker lane.")
+REGISTRY.Describe("agilis_worker_dropped_commands","Motion worker commands cancelled, expired or abandoned.")
+
+class InstrumentedCmdLib:
+    # <summary>
+    # strController: value of the "controller" label, to tell several controllers apart.
+    # </summary>
+    def __init__(self,oCmdLib,strController="",oRegistry=None):
+        self.oCmdLib = oCmdLib
+        self.oRegistry = REGISTRY if oRegistry is None else oRegistry
+        self.labels = (("controller",strController),)
+        self.nChannel = None
+        self.instrumented = dict() # instrumented versions of the wrapped methods, created on first use
+
+    # Every method of the wrapped object is timed.
+    def __getattr__(self,strName):
+        attribute = getattr(self.oCmdLib,strName)
+        if not callable(attribute):
+            return attribute
+        if strName not in self.instrumented:
+            oHistogram = self.oRegistry.Histogram("agilis_command_duration_seconds",
+                                                  self.labels+(("command",strName),))
+            self.instrumented[strName] = lambda *args:self._call(strName,attribute,oHistogram,args)
+        return self.instrumented[strName]
+
+    def _call(self,strCommand,function,oHistogram,args):
+        tStart = time.perf_counter()
+        bFailed = True
+        try:
+            result = function(*args)
+            bFailed = Command_Failed(strCommand,result)
+            return result
+        finally:
+            fElapsed = time.perf_counter() - tStart
+            with self.oRegistry.lock:
+                oHistogram.Observe(fElapsed)
+            if bFailed:
+                self.oRegistry.Increment("agilis_command_errors_total",self.labels+(("command",strCommand),))
+            if strCommand == "SetChannel":
+                self._switched(args[0],bFailed)
+            elif strCommand in ("Open","Close"):
+                self.nChannel = None
+
+    def _switched(self,nChannel,bFailed):
+        if bFailed:
+            self.nChannel = None
+            return
+        if self.nChannel is not None and nChannel != self.nChannel:
+            self.oRegistry.Increment("agilis_channel_switches_total",self.labels)
+        self.nChannel = nChannel
+
+# <summary>
+# Exposes the queue depth of every lane of a MotionWorker, and its dropped command counts, as gauges.
+# </summary>
+def Register_Worker(worker,oRegistry=None):
+    oRegistry = REGISTRY if oRegistry is None else oRegistry
+    labels = (("worker",worker.strName),)
+    for lane in worker.timeouts:
+        oRegistry.Add_Gauge("agilis_queue_depth",labels+(("lane",str(lane)),),
+                            lambda lane=lane:worker.Pending().get(lane,0))
+    for strReason in ("cancelled","expired","abandoned"):
+        strAttribute = "n" + strReason.capitalize()
+        oRegistry.Add_Gauge("agilis_worker_dropped_commands",labels+(("reason",strReason),),
+                            lambda strAttribute=strAttribute:getattr(worker,strAttribute))
+
+# <summary>
+# Serves the metrics on http://<strHost>:<nPort>/metrics from a daemon thread. Returns the server (call its shutdown()
+# method to stop it).
+# </summary>
+def Start_Http_Server(nPort,strHost="127.0.0.1",oRegistry=None):
+    # Imported here rather than at the top, so importing the motion library stays cheap.
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    oRegistry = REGISTRY if oRegistry is None else oRegistry
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/","/metrics"):
+                self.send_error(404)
+                return
+            bBody = oRegistry.Render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type","text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length",str(len(bBody)))
+            self.end_headers()
+            self.wfile.write(bBody)
+
+        def log_message(self,format,*args):
+            pass
+
+    server = ThreadingHTTPServer((strHost,nPort),Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever,name="agilis-metrics",daemon=True).start()
+    return server
+
+# <summary>
+# Rewrites strPath with the metrics every fPeriod seconds from a daemon thread. Returns an Event: set it to stop (the
+# file is written one last time).
+# </summary>
+def Start_Textfile_Writer(strPath,fPeriod=TEXTFILE_PERIOD,oRegistry=None):
+    oRegistry = REGISTRY if oRegistry is None else oRegistry
+    stop = threading.Event()
+
+    def run():
+        while True:
+            bStopping = stop.wait(fPeriod)
+            try:
+                oRegistry.Write_Textfile(strPath)
+            except OSError as e:
+                print("Could not write the metrics to {}: {}".format(strPath,e))
+            if bStopping:
+                return
+
+    threading.Thread(target=run,name="agilis-metrics-file",daemon=True).start()
+    return stop
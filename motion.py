@@ -0,0 +1,327 @@
+######################## Motion control library ##############################
+
+# The motion layer of the motor control program: device discovery and the helpers that start and stop the stages of
+# the AG-UC8 motor controller. It can be used on its own, e.g. from scripts:
+#
+#     import motion
+#     if motion.Initializer():
+#         motion.Start_Motion('x','positive',motion.axis_speeds['x'])
+#         ...
+#         motion.Stop_All_Motion()
+#
+# Importing this module is cheap and has no side effects. The controller library (the .NET CLR and Newport DLLs, or
+# the serial transport) is only loaded by Initializer, see Load_Transport. The GUI is in app.py.
+
+import sys
+import os
+import time
+
+from discovery import Load_Device_Cache, Save_Device_Cache, Probe, Probe_Devices, Concurrent_Probes
+from estop import Emergency_Stop, Stop_Channel
+from agilis_cache import CachedCmdLib
+from agilis_dotnet import Adapt_CmdLib
+from pacing import PacedCmdLib
+from metrics import InstrumentedCmdLib
+from events import Record
+
+# Initialize the DLL folder path to where the DLLs are located
+strPathDllFolder = os.path.dirname (os.path.abspath (__file__))
+
+########################### Global variables ###############################
+
+# Defined below are several "speed_list" variables. speed_list contains the text that will appear in the
+# drop-down menu from which a speed is selected. The actual speed settings that the motor controller accepts
+# are integers 1 to 4. They are mapped to their corresponding "level" of speed in speed_list_dict.
+# speed_list_z and speed_list_dict_z do a similar thing, but only with the two lowest speeds. This is because
+# having a high speed for the vertical motorized stage risks damaging the sample or microscope objective lens.
+######### TODO: Change z options back to only very slow and slow for above reason!!!
+speed_list = ["Very slow", "Slow", "Fast", "Very fast"]
+speed_list_dict = ({"Very slow":1,"Slow":2,"Fast":3,"Very fast":4})
+speed_list_z = ["Very slow", "Slow", "Fast", "Very fast"]
+speed_list_dict_z = ({"Very slow":1,"Slow":2,"Fast":3,"Very fast":4})
+
+# stage map: Maps the motorized stages' names to values the code can work with. tuples are (channel, axis). The motor controller 
+# can only send commands to one channel at a time, but it can send commands to multiple axes on the same channel. 
+# For this reason we wish to have x and y linear stages on the same channel so that we can control them simultaneously using 
+# arrow keys. 
+stage_map   = dict({'x':(1,1),'y':(1,2),'z':(3,1)})
+
+#axis_speeds is initialized to slow, slow, very slow for x,y,z. Lowest -> highest: 1,2,3,4.  
+init_x = "Slow"
+init_y = "Slow"
+init_z = "Very slow"
+axis_speeds = dict({'x':speed_list_dict[init_x],'y':speed_list_dict[init_y],'z':speed_list_dict[init_z]})
+
+# next two global variables track which axes and directions are active/running.
+# dir_status will contain "positive"/"negative" 
+axis_status = dict({'x':False,'y':False,'z':False})
+dir_status  = dict({'x':False,'y':False,'z':False})
+
+# runnable: A global variable which is True if the computer successfully connected to the AGU-C8 motor controller,
+# False otherwise. 
+runnable = False # arbitrary value that is neither true nor false. When runnable has this value, we know that Initializer()
+                 # has not been called yet. ???
+
+# The controller library classes, loaded by Load_Transport, and the objects Initializer creates from them.
+VCPIOLib = None
+CmdLibAgilis = None
+oDeviceIO = None
+oCmdLib = None
+strDeviceKey = ""
+strDeviceKeyList = []
+
+# strControllerId: the identity the controller answered with (empty if the controller library cannot be asked).
+# fTimeToReady: how long the last call to Initializer took, in seconds.
+strControllerId = ""
+fTimeToReady = None
+
+#jogspeed       = 0
+#measuredposition = 0
+#positivestepamplitude = 0
+
+########################### Helpers ########################################
+
+# <summary>
+# Loads the controller library the first time it is needed. The .NET libraries only run on Windows. Everywhere else,
+# or when the environment variable AGILIS_TRANSPORT is set to "serial", the pure-Python serial transport
+# (agilis_serial.py) is used instead. It provides the same classes. The .NET library names some of its methods
+# differently: Wrap_CmdLib adapts them to the serial transport's (see agilis_dotnet.py), so the rest of the program
+# does not need to know which one it is talking to. The one exception is the absolute position measurement, which
+# only works over serial.
+# Returns (VCPIOLib, CmdLibAgilis).
+# </summary>
+def Load_Transport():
+    global VCPIOLib, CmdLibAgilis
+    if CmdLibAgilis is None:
+        if sys.platform == "win32" and os.environ.get ("AGILIS_TRANSPORT", "dotnet") == "dotnet":
+            # Import the .NET Common Language Runtime (CLR) to allow interaction with .NET
+            import clr
+
+            # Add the DLL folder path to the system search path (before adding references)
+            if strPathDllFolder not in sys.path:
+                sys.path.append (strPathDllFolder)
+
+            # Add a reference to each .NET assembly required
+            clr.AddReference ("CmdLibAgilis")
+            clr.AddReference ("VCPIOLib")
+
+            # Import a class from a namespace
+            from Newport.Motion.CmdLibAgilis import CmdLibAgilis
+            from Newport.VCPIOLib import VCPIOLib
+        else:
+            from agilis_serial import SerialDeviceIO as VCPIOLib, AgilisSerial as CmdLibAgilis
+            print ("Using the serial transport.\n")
+    return (VCPIOLib,CmdLibAgilis)
+
+# <summary>
+# Wraps a controller library object the way the rest of the program expects it: a .NET object is given the serial
+# transport's method names (see agilis_dotnet.py), the cache skips channel selections and jog commands the controller
+# has already received (see agilis_cache.py), and the commands that do get sent are paced to what the controller can
+# handle (see pacing.py). Every command that reaches the controller is timed and counted (see metrics.py), under the
+# label strController.
+# </summary>
+def Wrap_CmdLib (oRawCmdLib, strController = "") :
+    return CachedCmdLib (PacedCmdLib (InstrumentedCmdLib (Adapt_CmdLib (oRawCmdLib), strController)))
+
+# <summary>
+# This method opens the first valid device in the list of discovered devices. The devices are probed concurrently
+# where the transport allows it (see discovery.py), and the first one that answers as an AG-UC8 becomes oCmdLib.
+# </summary>
+def OpenFirstValidDevice () :
+    global oCmdLib, strControllerId
+    lokeys = [str (oDeviceKey) for oDeviceKey in strDeviceKeyList]
+    (strDeviceKey,strIdentity,oRawCmdLib) = Probe_Devices (lokeys, lambda:CmdLibAgilis (oDeviceIO),
+                                                           bConcurrent = Concurrent_Probes (CmdLibAgilis))
+
+    # If a device was opened
+    if (oRawCmdLib is not None) :
+        oCmdLib = Wrap_CmdLib (oRawCmdLib)
+        strControllerId = strIdentity
+        return strDeviceKey
+
+    # No device was opened
+    return ""
+
+# <summary>
+# This method opens the device that was opened successfully last time, if it is still there and still the same
+# controller. This skips device discovery altogether.
+# </summary>
+def OpenCachedDevice () :
+    global strControllerId
+    cache = Load_Device_Cache ()
+    strDeviceKey = cache.get ("device_key", "")
+    if (strDeviceKey == "" or cache.get ("transport") != CmdLibAgilis.__name__) :
+        return ""
+
+    strIdentity = Probe (oCmdLib, strDeviceKey)
+    if (strIdentity is None or strIdentity != cache.get ("identity", "")) :
+        print ("The last used device %s is not available, discovering devices.\n" % strDeviceKey)
+        oCmdLib.Close ()
+        return ""
+
+    strControllerId = strIdentity
+    return strDeviceKey
+
+# <summary>
+# This function gets the jog speed of the specified axis.
+# </summary>
+# def GetJogSpeed():
+#     global jogspeed
+#     bStatus,jogspeed = oCmdLib.GetJogMode(nAxis,jogspeed)
+    
+#     if (bStatus):
+#         return True
+    
+#     print ("ERROR! Could not get the jog speed.\n")
+#     return False
+
+# <summary>
+# This function sets the jog speed of the specified axis. axis is the name of its stage, for the event of a failure.
+# </summary>
+def SetJogSpeed(nAxis,targetjogspeed,axis=""):
+    bStatus = oCmdLib.StartJogging(nAxis,targetjogspeed)
+    
+    if (bStatus):
+        return True
+    
+    Record ("StartJogging", axis, result = False,
+            strMessage = "ERROR! Could not set the jog mode of axis {} on channel {}!\n".format(
+                nAxis, getattr(oCmdLib, "nChannel", "?")))
+    return False
+
+# <summary>
+# This function stops motion along the specified axis. axis is the name of its stage, for the event of a failure.
+# </summary>
+def StopTheJogging(nAxis,axis=""):
+    bStatus = oCmdLib.StopMotion(nAxis)
+    if (bStatus):
+        return True
+    
+    Record ("StopMotion", axis, result = False,
+            strMessage = "ERROR! Could not stop jogging axis {} on channel {}!\n".format(
+                nAxis, getattr(oCmdLib, "nChannel", "?")))
+    return False
+
+############################ Open device, start communication ##############################
+
+# <summary>
+# Initializer: When called, checks if any valid devices are connected and opens the first one. IF MULTIPLE DEVICES CONNECTED
+# THIS MAY HAVE TO BE CHANGED! (e.g. if camera is also connected-> test this out!???)
+# Returns TRUE if a valid device was found, FALSE otherwise.
+# </summary>
+def Initializer():
+    global stage_map, strDeviceKey, strDeviceKeyList, oCmdLib, oDeviceIO, runnable, fTimeToReady
+    tStart = time.perf_counter ()
+    print ("Waiting for device discovery...\n")
+    
+    runnable = False # ???
+
+    Load_Transport ()
+
+    # Call the Virtual COM Port I/O Library constructor with 
+    # true passed in so that logging is turned on for this sample
+    oDeviceIO = VCPIOLib (True)
+    oCmdLib = Wrap_CmdLib (CmdLibAgilis (oDeviceIO))
+
+    # Try the device that worked last time first
+    strDeviceKey = OpenCachedDevice ()
+    strDeviceKeyList = [strDeviceKey] if strDeviceKey != "" else []
+
+    if (strDeviceKey == "") :
+        # Discover the devices that are available for communication
+        oDeviceIO.DiscoverDevices ()
+
+        # Get the list of discovered devices
+        strDeviceKeyList = oDeviceIO.GetDeviceKeys ()
+
+        # If no devices were discovered
+        if (not strDeviceKeyList) : ## (not strDeviceKeyList) = True if empty!
+            print ("No devices discovered.\n")
+        else :
+            # Open the first valid device in the list of discovered devices
+            strDeviceKey = OpenFirstValidDevice ()
+            #print ("Device Key = %s" % strDeviceKey)
+
+            if (strDeviceKey == "") :
+                print ("Could not open the device.\n")
+
+    # If the device was opened
+    if (strDeviceKey != "") :
+        # Set the controller to Remote Mode
+        if (oCmdLib.SetRemoteMode ()) :
+            Save_Device_Cache (strDeviceKey, strControllerId, CmdLibAgilis.__name__)
+            runnable = True
+        else :
+            print ("Could not put the controller into Remote Mode.\n")
+
+    # fTimeToReady: seconds from calling Initializer until the controller was ready for commands (or gave up)
+    fTimeToReady = time.perf_counter () - tStart
+    print ("Time to ready: %.1f ms\n" % (1000 * fTimeToReady))
+
+    return runnable
+
+############################# Helpers to start and stop motion #########################
+
+# <summary>
+# Starts motion along input axis in input direction at input speed
+# Returns True if motion started successfully, False otherwise.
+# </summary>
+def Start_Motion(axis,direction,speed):
+    global stage_map, strDeviceKey, strDeviceKeyList, oCmdLib, oDeviceIO, runnable
+    runnable2 = False
+    if runnable: # We need to have called Initializer() before we can set channel and send commands
+        (nChannel,nAxis) = stage_map[axis]
+        if direction=='positive':
+            targetjogspeed = speed
+        else:
+            targetjogspeed = -1*speed
+
+        if (oCmdLib.SetChannel (nChannel)):
+            SetJogSpeed(nAxis,targetjogspeed,axis)
+
+            runnable2 = True
+        else:
+            Record ("SetChannel", axis, direction, False,
+                    strMessage = "Could not set the current channel in Start_Motion.\n")
+
+    else:
+        Record ("Start_Motion", axis, direction, False, strMessage = "Initialization failed.\n")
+    return runnable2
+
+# <summary>
+# Stops motion along input axis.
+# Returns True if motion stopped successfully,
+# False otherwise.
+# </summary>
+def Stop_Motion(axis):
+    global stage_map, strDeviceKey, strDeviceKeyList, oCmdLib, oDeviceIO
+    (nChannel,nAxis) = stage_map[axis]
+    runnable3 = False
+    #print("STOP_MOTION: nChannel = ",nChannel)
+    if (oCmdLib.SetChannel (nChannel)):
+        if StopTheJogging(nAxis,axis):
+            runnable3 = True
+    else:
+        Record ("SetChannel", axis, result = False,
+                strMessage = "ERROR! Command to end motion failed! THIS SHOULD NEVER BE PRINTED!!")
+    return runnable3
+# <summary>
+# Stops motion along ALL axes on the AG-UC8 motor controller.
+# The channels with a moving stage (according to axis_status) are stopped first, without any delay, so the stages
+# come to rest within a few command round trips. The remaining channels are then swept as a precaution. The gap the
+# controller needs between commands is taken care of by PacedCmdLib (see pacing.py).
+# Returns True if all motion stopped successfully, False
+# otherwise.
+# </summary>
+def Stop_All_Motion():
+    global stage_map, strDeviceKey, strDeviceKeyList, oCmdLib, oDeviceIO, axis_status
+    (runnable4,lochannel) = Emergency_Stop(oCmdLib,stage_map,axis_status)
+    for nChannel in lochannel:
+        if not Stop_Channel(oCmdLib,nChannel,stage_map):
+            runnable4 = False
+    if runnable4 == True:
+        Record ("Stop_All_Motion", result = True, strMessage = "All motion has been stopped.")
+    else:
+        Record ("Stop_All_Motion", result = False,
+                strMessage = 'ERROR! Command to end all motion failed! THIS SHOULD NEVER BE PRINTED!!.')
+    return runnable4
@@ -0,0 +1,190 @@
+######################## Motion I/O worker ##############################
+
+# Every call into the controller library goes over the serial link and can block, sometimes for a long time. If those
+# calls are made from Tk callbacks, the whole GUI freezes with them. MotionWorker runs them one at a time on a single
+# background thread that owns the controller objects: callbacks Submit a command and get a Future back.
+#
+# Tk widgets may only be touched from the Tk thread, so a command can also be given a callback. Callbacks are not run
+# by the worker: they are collected, and Run_Callbacks (called periodically from the Tk thread, e.g. with root.after)
+# runs them there with the finished Future.
+#
+# Commands are queued in priority lanes. Stop commands (LANE_STOP) always run before pending motion commands
+# (LANE_MOTION), which run before background queries (LANE_POLL, e.g. the position poller), and a stop cancels the
+# motion and poll commands still queued for the axes it stops. Each command carries a
+# deadline (submission time + the timeout of its lane, unless given explicitly):
+#  - a motion or poll command whose deadline has passed before it could start is stale, and is cancelled instead of
+#    run;
+#  - stop commands are never dropped;
+#  - if a stop is waiting while the running motion command is past its deadline, the running command is considered
+#    hung: its Future fails with TimeoutError, the thread running it is abandoned and a fresh thread takes over the
+#    queue. A hung SetChannel/StartJogging call can therefore delay a stop by at most the motion lane timeout;
+#  - poll commands are never abandoned: a slow poll is not hung, and an abandoned one would go on using the port
+#    while the fresh thread sends the stop. They read several stages one transaction at a time and give way to a
+#    waiting stop between two (see poller.py), so a stop waits for at most one transaction, which the transport's
+#    own timeout bounds.
+
+import heapq
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+LANE_STOP   = 0
+LANE_MOTION = 1
+LANE_POLL   = 2
+
+# Default timeouts (seconds) of each lane, see above.
+LANE_TIMEOUTS = dict({LANE_STOP:1.0, LANE_MOTION:0.25, LANE_POLL:0.1})
+
+class _Command:
+    __slots__ = ("future","function","args","lane","axes","deadline")
+
+    def __init__(self,future,function,args,lane,axes,deadline):
+        self.future = future
+        self.function = function
+        self.args = args
+        self.lane = lane
+        self.axes = axes
+        self.deadline = deadline
+
+class MotionWorker:
+    # <summary>
+    # timeouts: maps each lane to its default timeout, LANE_TIMEOUTS if not given.
+    # on_hung: called (from the watchdog thread) after a hung command has been abandoned, e.g. to forget cached
+    # controller state.
+    # </summary>
+    def __init__(self,strName="motion-io",timeouts=None,on_hung=None,fWatchdogPeriod=0.005):
+        self.strName = strName
+        self.timeouts = dict(LANE_TIMEOUTS if timeouts is None else timeouts)
+        self.on_hung = on_hung
+        self.fWatchdogPeriod = fWatchdogPeriod
+        self.callbacks = queue.SimpleQueue()
+        self.condition = threading.Condition()
+        self.heap = []
+        self.nSequence = 0
+        self.running = None
+        self.nGeneration = 0
+        self.bShutdown = False
+        # counters: commands cancelled by a stop, dropped because their deadline passed, and abandoned while hung
+        self.nCancelled = 0
+        self.nExpired = 0
+        self.nAbandoned = 0
+        self.thread = self._start_executor()
+        self.watchdog = threading.Thread(target=self._watch,name=strName+"-watchdog",daemon=True)
+        self.watchdog.start()
+
+    def _start_executor(self):
+        thread = threading.Thread(target=self._run,args=(self.nGeneration,),
+                                  name="{}-{}".format(self.strName,self.nGeneration),daemon=True)
+        thread.start()
+        return thread
+
+    def _run(self,nGeneration):
+        while True:
+            with self.condition:
+                while nGeneration == self.nGeneration and not self.heap and not self.bShutdown:
+                    self.condition.wait()
+                if nGeneration != self.nGeneration or not self.heap:
+                    return
+                command = heapq.heappop(self.heap)[2]
+                if command.lane != LANE_STOP and not command.future.done() and time.monotonic() > command.deadline:
+                    command.future.cancel()
+                    self.nExpired += 1
+                if not command.future.set_running_or_notify_cancel():
+                    continue
+                self.running = command
+
+            try:
+                result = command.function(*command.args)
+                exception = None
+            except BaseException as e:
+                exception = e
+
+            with self.condition:
+                if nGeneration != self.nGeneration: # abandoned by the watchdog, the Future has already failed
+                    return
+                self.running = None
+                if exception is None:
+                    command.future.set_result(result)
+                else:
+                    command.future.set_exception(exception)
+
+    def _watch(self):
+        while True:
+            with self.condition:
+                self.condition.wait(self.fWatchdogPeriod)
+                if self.bShutdown and not self.heap and self.running is None:
+                    return
+                hung = self.running
+                if (hung is None or hung.lane == LANE_POLL or not self.heap or self.heap[0][0] != LANE_STOP
+                        or time.monotonic() < hung.deadline):
+                    continue
+                self.running = None
+                self.nGeneration += 1
+                self.nAbandoned += 1
+                hung.future.set_exception(TimeoutError("{} did not complete before its deadline".format(
+                                          getattr(hung.function,"__name__",hung.function))))
+                self.thread = self._start_executor()
+            if self.on_hung is not None:
+                self.on_hung()
+
+    # <summary>
+    # Queues function(*args) for the worker thread and returns its Future.
+    # lane: LANE_STOP, LANE_MOTION or LANE_POLL. axes: the stages the command acts on; a stop cancels the queued commands
+    # that act on any of its axes. timeout: seconds from now until the command's deadline, the lane default if None.
+    # If callback is given, it will be called with the Future by Run_Callbacks once the command has finished,
+    # failed or been cancelled.
+    # </summary>
+    def Submit(self,function,*args,callback=None,lane=LANE_MOTION,axes=(),timeout=None):
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(lambda future:self.callbacks.put((callback,future)))
+        if timeout is None:
+            timeout = self.timeouts[lane]
+        command = _Command(future,function,args,lane,tuple(axes),time.monotonic()+timeout)
+
+        with self.condition:
+            if lane == LANE_STOP and command.axes:
+                for (nLane,nSequence,queued) in self.heap:
+                    if nLane != LANE_STOP and not queued.future.done() and set(queued.axes) & set(command.axes):
+                        if queued.future.cancel():
+                            self.nCancelled += 1
+            heapq.heappush(self.heap,(lane,self.nSequence,command))
+            self.nSequence += 1
+            self.condition.notify_all()
+        return future
+
+    # <summary>
+    # Returns the number of commands waiting (not cancelled) in each lane.
+    # </summary>
+    def Pending(self):
+        with self.condition:
+            pending = dict((lane,0) for lane in self.timeouts)
+            for (nLane,nSequence,command) in self.heap:
+                if not command.future.done():
+                    pending[nLane] = pending.get(nLane,0) + 1
+            return pending
+
+    # <summary>
+    # Runs the callbacks of the commands that have finished since the last call. Must be called from the thread that
+    # is allowed to touch the GUI. Returns the number of callbacks that were run.
+    # </summary>
+    def Run_Callbacks(self):
+        nCallbacks = 0
+        while True:
+            try:
+                (callback,future) = self.callbacks.get_nowait()
+            except queue.Empty:
+                return nCallbacks
+            callback(future)
+            nCallbacks += 1
+
+    # <summary>
+    # Lets the worker finish the commands already queued, then stops it. If bWait is True, blocks until it has.
+    # </summary>
+    def Shutdown(self,bWait=True):
+        with self.condition:
+            self.bShutdown = True
+            self.condition.notify_all()
+        if bWait:
+            self.thread.join()
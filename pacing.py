@@ -0,0 +1,128 @@
+######################## Adaptive command pacing ##############################
+
+# Stop_All_Motion used to sleep 100 ms between commands because "the AGU-C8 controller needs time to carry out its
+# commands". That delay was a guess, and it was paid on every command whether the controller needed it or not.
+# PacedCmdLib wraps a CmdLibAgilis object and learns the gap the controller actually needs instead:
+#  - every call is timed, and the round-trip time (RTT) is tracked as a moving average;
+#  - commands are only held back when the controller has shown it needs it: when a command fails (it returns False,
+#    a non-zero Open code, or raises), or when the controller reports an error, the minimum gap between commands is
+#    doubled (at least to the RTT);
+#  - the AG-UC8 does not answer set commands, so both transports report them as carried out once they are sent. The
+#    controller's error code (TE; GetErrorPreviousCommand in the .NET library, see agilis_dotnet.py) is therefore
+#    queried after the commands that start motion or change a setting (ERROR_CHECKED_COMMANDS), which the controller
+#    refuses while it is not ready for them. Stops, channel selections and queries are not followed by one, so a stop
+#    is never held up by an extra transaction;
+#  - every successful command shrinks the gap again by PACING_DECAY, down to fMinInterval: slowly, so the gap the
+#    controller needed is kept for a while rather than given up on the next command.
+# Throughput is therefore limited by how fast the controller answers, and only slowed down while it is struggling.
+
+import threading
+import time
+
+# Commands after which the controller's error code is queried (see the top of this file).
+ERROR_CHECKED_COMMANDS = ("StartJogging","RelativeMove","AbsoluteMove","SetStepAmplitude")
+
+PACING_DECAY = 0.9 # the gap is multiplied by this after every successful command
+
+# <summary>
+# Returns True if the result of a CmdLibAgilis call reports a failure. Open returns 0 on success, the other commands
+# return True, or a tuple whose first element is the status.
+# </summary>
+def Command_Failed(strCommand,result):
+    if strCommand == "Open":
+        return result != 0
+    if isinstance(result,tuple):
+        return not result[0]
+    return result is False
+
+class PacedCmdLib:
+    # <summary>
+    # fMinInterval / fMaxInterval: bounds of the gap enforced between the start of two commands (seconds).
+    # lochecked: the commands after which the controller is asked for its error code (one extra transaction each).
+    # Nothing is checked if the wrapped object has no GetErrorCode method.
+    # </summary>
+    def __init__(self,oCmdLib,fMinInterval=0.0,fMaxInterval=0.2,lochecked=ERROR_CHECKED_COMMANDS):
+        self.oCmdLib = oCmdLib
+        self.fMinInterval = fMinInterval
+        self.fMaxInterval = fMaxInterval
+        self.lochecked = frozenset(lochecked) if hasattr(oCmdLib,"GetErrorCode") else frozenset()
+        self.fInterval = fMinInterval
+        self.fRtt = None          # moving average of the command round-trip time
+        self.tNext = 0.0          # earliest time the next command may be sent
+        self.lock = threading.Lock()
+        self.paced = dict()       # paced versions of the wrapped methods, created on first use
+        # statistics
+        self.nCommands = 0
+        self.nErrors = 0
+        self.nErrorQueries = 0
+        self.fWaited = 0.0        # total time commands were held back
+        self.fBusy = 0.0          # total time spent inside commands
+
+    # Every method of the wrapped object is paced.
+    def __getattr__(self,strName):
+        attribute = getattr(self.oCmdLib,strName)
+        if not callable(attribute):
+            return attribute
+        if strName not in self.paced:
+            self.paced[strName] = lambda *args:self._call(strName,attribute,args)
+        return self.paced[strName]
+
+    def _call(self,strCommand,function,args):
+        with self.lock:
+            fWait = self.tNext - time.perf_counter()
+        if fWait > 0:
+            time.sleep(fWait)
+
+        tStart = time.perf_counter()
+        try:
+            result = function(*args)
+            bFailed = Command_Failed(strCommand,result)
+        except:
+            self._record(tStart,time.perf_counter(),True)
+            raise
+        tEnd = time.perf_counter()
+        if not bFailed and strCommand in self.lochecked:
+            with self.lock:
+                self.nErrorQueries += 1
+            try:
+                (bStatus,nError) = self.oCmdLib.GetErrorCode()
+            except:
+                self._record(tStart,tEnd,True,max(fWait,0.0))
+                raise
+            bFailed = not bStatus or nError != 0
+        self._record(tStart,tEnd,bFailed,max(fWait,0.0))
+        return result
+
+    def _record(self,tStart,tEnd,bFailed,fWaited=0.0):
+        fRtt = tEnd - tStart
+        with self.lock:
+            self.nCommands += 1
+            self.fWaited += fWaited
+            self.fBusy += fRtt
+            self.fRtt = fRtt if self.fRtt is None else 0.8*self.fRtt + 0.2*fRtt
+            if bFailed:
+                self.nErrors += 1
+                self.fInterval = min(self.fMaxInterval,max(2*self.fInterval,self.fRtt))
+            else:
+                self.fInterval = max(self.fMinInterval,PACING_DECAY*self.fInterval)
+            self.tNext = tStart + self.fInterval
+
+    # <summary>
+    # Returns the pacing statistics as a dict.
+    # </summary>
+    def Pacing_Stats(self):
+        with self.lock:
+            return dict({"commands":self.nCommands, "errors":self.nErrors, "error_queries":self.nErrorQueries,
+                         "interval":self.fInterval,
+                         "rtt":self.fRtt, "waited":self.fWaited, "busy":self.fBusy,
+                         "rate":self.nCommands/(self.fBusy+self.fWaited) if self.nCommands else 0.0})
+
+    # <summary>
+    # Returns a human-readable summary of Pacing_Stats.
+    # </summary>
+    def Pacing_Report(self):
+        stats = self.Pacing_Stats()
+        return ("Pacing: {} commands, {} errors ({} error queries), mean RTT = {:.1f} ms, current gap = {:.1f} ms, "
+                "held back {:.3f} s in total, {:.0f} commands/s while busy").format(
+                stats["commands"],stats["errors"],stats["error_queries"],1000*(stats["rtt"] or 0.0),
+                1000*stats["interval"],stats["waited"],stats["rate"])
@@ -0,0 +1,237 @@
+######################## Channel switch planner ##############################
+
+# x and y are on channel 1 and z on channel 3 (stage_map), and the controller drives one channel at a time: every
+# alternation between z and x/y in a move program costs a SetChannel transaction and stops the other channel. Plan
+# reorders a program of relative moves to switch channels as rarely as possible, without breaking its ordering
+# constraints:
+#  - the moves of a stage always keep their order;
+#  - (i, j) in constraints: move i must be completed before move j starts (indices into the program);
+#  - BARRIER in the program: every move before it is completed before any move after it starts.
+# The moves are ordered greedily: stay on the current channel while any move on it is free to go, otherwise switch to
+# the channel with the most moves free to go. The result is cut into batches of moves on one channel with no
+# constraint between them, which StepMover carries out one after the other (both axes of a batch at the same time).
+# A batch is only handed to StepMover once every move of the previous one has completed with all its steps: if one
+# fails, is cancelled (e.g. by a stop) or ends short, the moves after it may depend on it, so they are all cancelled.
+#
+# Plan reports the channel switches of the program as written and as planned, and the time that saves, before
+# anything is sent to the controller:
+#
+#     plan = Plan ([('z',10), ('x',5), ('z',-10), ('y',5)], constraints = [(1,3)])
+#     print (plan.Report ())
+#     lofutures = Execute_Plan (mover, plan)
+
+import heapq
+import threading
+from concurrent.futures import Future
+
+import motion
+
+BARRIER = "barrier"
+
+# Estimated cost (seconds) of one channel switch: a SetChannel transaction. Used when the round-trip time measured by
+# PacedCmdLib (see pacing.py) is not available.
+CHANNEL_SWITCH_COST = 0.005
+
+# <summary>
+# Returns the estimated cost of a channel switch on oCmdLib: the command round-trip time measured so far, or
+# CHANNEL_SWITCH_COST.
+# </summary>
+def Switch_Cost(oCmdLib=None):
+    if oCmdLib is not None and hasattr(oCmdLib,"Pacing_Stats"):
+        fRtt = oCmdLib.Pacing_Stats()["rtt"]
+        if fRtt:
+            return fRtt
+    return CHANNEL_SWITCH_COST
+
+# <summary>
+# Returns the number of channel switches needed to send the moves in order, starting on channel nCurrent.
+# </summary>
+def Count_Switches(lochannels,nCurrent=None):
+    nSwitches = 0
+    for nChannel in lochannels:
+        if nChannel != nCurrent:
+            if nCurrent is not None:
+                nSwitches += 1
+            nCurrent = nChannel
+    return nSwitches
+
+class MovePlan:
+    def __init__(self):
+        self.lobatches = []    # lists of (index in the program, stage, steps), one channel per list
+        self.lochannels = []   # the channel of each batch
+        self.nMoves = 0
+        self.nSwitchesBefore = 0
+        self.nSwitchesAfter = 0
+        self.fSwitchCost = CHANNEL_SWITCH_COST
+
+    def Time_Saved(self):
+        return (self.nSwitchesBefore - self.nSwitchesAfter)*self.fSwitchCost
+
+    def Report(self):
+        return ("Plan: {} moves in {} batches, {} -> {} channel switches, about {:.0f} ms saved "
+                "({:.1f} ms per switch)").format(self.nMoves,len(self.lobatches),self.nSwitchesBefore,
+                self.nSwitchesAfter,1000*self.Time_Saved(),1000*self.fSwitchCost)
+
+# <summary>
+# Plans a program: a list of (stage, steps) moves and BARRIERs. constraints: (i, j) pairs of program indices, move i
+# before move j. nCurrent: the channel selected now (e.g. oCmdLib.nChannel). Returns a MovePlan, see the top of this
+# file. Raises ValueError if the constraints contradict each other.
+# </summary>
+def Plan(loprogram,constraints=(),nCurrent=None,stage_map=None,fSwitchCost=None):
+    stage_map = motion.stage_map if stage_map is None else stage_map
+    nNodes = len(loprogram)
+    successors = [[] for i in range(nNodes)]
+    predecessors = [[] for i in range(nNodes)]
+    nPredecessors = [0]*nNodes
+
+    def edge(i,j):
+        successors[i].append(j)
+        predecessors[j].append(i)
+        nPredecessors[j] += 1
+
+    last_of_stage = dict()
+    nLastBarrier = None
+    lobefore_barrier = []
+    for (i,item) in enumerate(loprogram):
+        if item == BARRIER:
+            for j in lobefore_barrier:
+                edge(j,i)
+            lobefore_barrier = []
+            nLastBarrier = i
+            continue
+        (stage,nSteps) = item
+        if stage not in stage_map:
+            raise ValueError("Unknown stage {!r} in move {}".format(stage,i))
+        if stage in last_of_stage:
+            edge(last_of_stage[stage],i)
+        last_of_stage[stage] = i
+        if nLastBarrier is not None:
+            edge(nLastBarrier,i)
+        lobefore_barrier.append(i)
+    for (i,j) in constraints:
+        if loprogram[i] == BARRIER or loprogram[j] == BARRIER:
+            continue
+        edge(i,j)
+
+    def channel(i):
+        return stage_map[loprogram[i][0]][0]
+
+    # Moves free to go, by channel, as heaps of program indices (so that ties keep the program order)
+    ready = dict()
+    lobarriers = []
+    def release(i):
+        if loprogram[i] == BARRIER:
+            lobarriers.append(i)
+        else:
+            heapq.heappush(ready.setdefault(channel(i),[]),i)
+
+    for i in range(nNodes):
+        if nPredecessors[i] == 0:
+            release(i)
+
+    plan = MovePlan()
+    plan.fSwitchCost = CHANNEL_SWITCH_COST if fSwitchCost is None else fSwitchCost
+    nChannel = nCurrent
+    batch = []
+    batch_stages = dict() # maps the nodes of the batch to the stages of the batch they wait for (themselves included)
+    nDone = 0
+    while lobarriers or any(ready.values()):
+        if lobarriers:
+            i = lobarriers.pop()
+            waits = set()
+            for j in predecessors[i]:
+                waits |= batch_stages.get(j,set())
+            if waits:
+                batch_stages[i] = waits
+        else:
+            if not ready.get(nChannel):
+                # Switch to the channel with the most moves free to go
+                nChannel = max((nChan for nChan in ready if ready[nChan]),
+                               key=lambda nChan:(len(ready[nChan]),-ready[nChan][0]))
+            i = heapq.heappop(ready[nChannel])
+            (stage,nSteps) = loprogram[i]
+            waits = set([stage])
+            for j in predecessors[i]:
+                waits |= batch_stages.get(j,set())
+            # A new batch on another channel, or if the move must wait for a move of the other axis in this batch
+            if batch and (channel(batch[0][0]) != nChannel or len(waits) > 1):
+                plan.lobatches.append(batch)
+                plan.lochannels.append(channel(batch[0][0]))
+                batch = []
+                batch_stages = dict()
+                waits = set([stage])
+            batch.append((i,stage,nSteps))
+            batch_stages[i] = waits
+        nDone += 1
+        for j in successors[i]:
+            nPredecessors[j] -= 1
+            if nPredecessors[j] == 0:
+                release(j)
+    if nDone != nNodes:
+        raise ValueError("The ordering constraints contradict each other.")
+    if batch:
+        plan.lobatches.append(batch)
+        plan.lochannels.append(channel(batch[0][0]))
+
+    plan.nMoves = sum(len(batch) for batch in plan.lobatches)
+    plan.nSwitchesBefore = Count_Switches([channel(i) for i in range(nNodes) if loprogram[i] != BARRIER],nCurrent)
+    plan.nSwitchesAfter = Count_Switches(plan.lochannels,nCurrent)
+    return plan
+
+# <summary>
+# Carries out a plan with mover, a stepmove.StepMover, batch after batch (see the top of this file). Returns the
+# Futures of the moves in program order (BARRIERs left out), right away: each one completes like the StepMover
+# Future of its move, or is cancelled if a batch before it did not go through. A Future cancelled before its batch
+# starts leaves that move out. If callback is given, it is called with each Future by the worker's Run_Callbacks.
+# </summary>
+def Execute_Plan(mover,plan,callback=None):
+    futures = dict((i,Future()) for batch in plan.lobatches for (i,stage,nSteps) in batch)
+    if callback is not None:
+        for future in futures.values():
+            future.add_done_callback(lambda future:mover.worker.callbacks.put((callback,future)))
+    lock = threading.Lock()
+
+    # Cancels a move's Future, and tells whoever waits on it (concurrent.futures.wait, as_completed).
+    def cancel(future):
+        if future.cancel():
+            future.set_running_or_notify_cancel()
+
+    def start(nBatch):
+        while nBatch < len(plan.lobatches):
+            lobatch = [(i,stage,nSteps) for (i,stage,nSteps) in plan.lobatches[nBatch] if not futures[i].cancelled()]
+            if lobatch:
+                break
+            nBatch += 1
+        else:
+            return
+        state = dict({"remaining":len(lobatch),"ok":True})
+        lomoved = mover.Move_List([(stage,nSteps) for (i,stage,nSteps) in lobatch])
+        for ((i,stage,nSteps),moved) in zip(lobatch,lomoved):
+            moved.add_done_callback(lambda moved,i=i,nSteps=nSteps:finish(nBatch,state,i,nSteps,moved))
+
+    # Runs when a move of batch nBatch completes: passes its outcome on, and once the whole batch has completed,
+    # starts the next batch or cancels the moves of all the batches left.
+    def finish(nBatch,state,i,nSteps,moved):
+        bOk = not moved.cancelled() and moved.exception() is None and moved.result() == nSteps
+        if futures[i].done():
+            pass # cancelled by the caller while its batch was running
+        elif moved.cancelled():
+            cancel(futures[i])
+        elif moved.exception() is not None:
+            futures[i].set_exception(moved.exception())
+        else:
+            futures[i].set_result(moved.result())
+        with lock:
+            state["ok"] = state["ok"] and bOk
+            state["remaining"] -= 1
+            if state["remaining"]:
+                return
+        if state["ok"]:
+            start(nBatch + 1)
+            return
+        for batch in plan.lobatches[nBatch+1:]:
+            for (j,stage,nSteps) in batch:
+                cancel(futures[j])
+
+    start(0)
+    return [futures[i] for i in sorted(futures)]
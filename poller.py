@@ -0,0 +1,140 @@
+######################## Step counter poller ##############################
+
+# The GUI has no position feedback, and a script that wants one has to query the controller itself, competing with the
+# motion commands for the serial link. PositionPoller reads the step counters (TP) of the stages in the background and
+# publishes them in a snapshot that anyone can read without a query and without a lock:
+#  - while a stage is moving (according to fnMoving), its counter is read every fMovingInterval seconds, and once
+#    more when it stops, so the snapshot ends on its final position;
+#  - idle stages are read every fIdleInterval seconds, or never if fIdleInterval is None;
+#  - the reads are commands in the lowest lane of the motion worker (LANE_POLL), so any stop or motion command goes
+#    first: no read is queued while such commands are waiting, and a read of several stages gives way between two
+#    stages. A command that arrives during a read still waits for that one transaction;
+#  - while anything moves, only the channel that is already selected is read: selecting another channel would stop
+#    the stages moving on it;
+#  - a read that is cancelled or fails is tried again at the next tick, but one the transport cannot carry out at all
+#    (AttributeError, TypeError: a method it does not have) would fail the same way for ever: it is recorded as an
+#    event and polling stops.
+#
+# The snapshot is a dict that is replaced, never modified, so reading poller.snapshot (or Position) always gives a
+# consistent picture: stage -> (step counter, time of the reading).
+
+import threading
+import time
+
+import motion
+from events import Record
+from motion_worker import LANE_STOP, LANE_MOTION, LANE_POLL
+
+POLL_MOVING_INTERVAL = 0.05 # seconds between two reads of a moving stage
+POLL_IDLE_INTERVAL = 2.0    # seconds between two reads of an idle stage
+
+# <summary>
+# Runs on the motion worker: reads the step counters of the stages. Stages on another channel than the selected one
+# are only read if fnMoving() returns no stage. It is asked here, on the worker thread, because a motion command may
+# have run since the read was queued. If fnYield() returns True between two reads (a command is waiting), the
+# remaining stages are left for later. Returns a dict mapping the stages that were read to their step counter.
+# </summary>
+def Read_Step_Counters(oCmdLib,stage_map,lostages,fnMoving,fnYield=None):
+    counts = dict()
+    bSwitch = not any(fnMoving())
+    nSelected = getattr(oCmdLib,"nChannel",None)
+    # The selected channel first, so that at most one round of channel switches is needed
+    for (i,stage) in enumerate(sorted(lostages,key=lambda stage:(stage_map[stage][0] != nSelected,stage_map[stage]))):
+        if i > 0 and fnYield is not None and fnYield():
+            return counts # the waiting command selects its own channel
+        (nChannel,nAxis) = stage_map[stage]
+        if getattr(oCmdLib,"nChannel",None) != nChannel:
+            if not bSwitch or not oCmdLib.SetChannel(nChannel):
+                continue
+        (bStatus,nSteps) = oCmdLib.GetStepCount(nAxis)
+        if bStatus:
+            counts[stage] = nSteps
+    # Go back to the channel that was selected, so the next motion command does not have to
+    if nSelected is not None and getattr(oCmdLib,"nChannel",None) != nSelected:
+        oCmdLib.SetChannel(nSelected)
+    return counts
+
+class PositionPoller:
+    # <summary>
+    # worker: the MotionWorker that owns the controller. fnMoving returns the stages that are (or are about to be)
+    # moving, e.g. from axis_status. fnCmdLib and stage_map: see stepmove.StepMover.
+    # </summary>
+    def __init__(self,worker,fnMoving,fnCmdLib=None,stage_map=None,fMovingInterval=POLL_MOVING_INTERVAL,
+                 fIdleInterval=POLL_IDLE_INTERVAL):
+        self.worker = worker
+        self.fnMoving = fnMoving
+        self.fnCmdLib = (lambda:motion.oCmdLib) if fnCmdLib is None else fnCmdLib
+        self.stage_map = motion.stage_map if stage_map is None else stage_map
+        self.fMovingInterval = fMovingInterval
+        self.fIdleInterval = fIdleInterval
+        self.snapshot = dict()
+        self.last_read = dict()  # maps stages to the time they were last read (or tried)
+        self.was_moving = set()
+        # statistics
+        self.nReads = 0
+        self.nYielded = 0        # ticks skipped because motion commands were waiting
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run,name="position-poller",daemon=True)
+        self.thread.start()
+
+    # <summary>
+    # Returns (step counter, age of the reading in seconds) of the stage, or (None, None) if it was never read.
+    # </summary>
+    def Position(self,stage):
+        entry = self.snapshot.get(stage)
+        if entry is None:
+            return (None,None)
+        return (entry[0],time.monotonic() - entry[1])
+
+    # <summary>
+    # Returns the stages that are due to be read now.
+    # </summary>
+    def _due(self,tNow):
+        moving = set(self.fnMoving())
+        # Stages that just stopped are read once more, for their final position
+        lodue = [stage for stage in moving | self.was_moving
+                 if tNow - self.last_read.get(stage,0.0) >= self.fMovingInterval or stage not in moving]
+        self.was_moving = moving
+        if self.fIdleInterval is not None:
+            lodue += [stage for stage in self.stage_map if stage not in moving and stage not in lodue
+                      and tNow - self.last_read.get(stage,0.0) >= self.fIdleInterval]
+        return lodue
+
+    # Returns True if stop or motion commands are waiting on the worker.
+    def _yield(self):
+        pending = self.worker.Pending()
+        return bool(pending.get(LANE_STOP) or pending.get(LANE_MOTION))
+
+    def _run(self):
+        while not self.stop.wait(self.fMovingInterval):
+            if self._yield():
+                self.nYielded += 1
+                continue
+            tNow = time.monotonic()
+            lodue = self._due(tNow)
+            if not lodue:
+                continue
+            for stage in lodue:
+                self.last_read[stage] = tNow
+            future = self.worker.Submit(Read_Step_Counters,self.fnCmdLib(),self.stage_map,lodue,self.fnMoving,
+                                        self._yield,lane=LANE_POLL,axes=lodue)
+            try:
+                counts = future.result()
+            except (AttributeError,TypeError) as e:
+                Record("Read_Step_Counters",result=False,strMessage="Position polling stopped: {!r}".format(e))
+                raise
+            except BaseException: # cancelled by a stop, stale or failed: try again next time
+                for stage in lodue:
+                    self.last_read.pop(stage,None)
+                self.was_moving |= set(lodue)
+                continue
+            if counts:
+                tRead = time.monotonic()
+                snapshot = dict(self.snapshot)
+                snapshot.update((stage,(nSteps,tRead)) for (stage,nSteps) in counts.items())
+                self.snapshot = snapshot
+                self.nReads += len(counts)
+
+    def Shutdown(self):
+        self.stop.set()
+        self.thread.join()
@@ -0,0 +1,159 @@
+######################## Raster scans ##############################
+
+# Tiling a sample used to mean holding the arrow keys. The scan engine visits a grid of sites with relative step
+# moves (see stepmove.py), and calls a function at every site, e.g. to trigger a camera:
+#  - Grid computes the sites with NumPy: nColumns x nRows sites, nColumnStep x steps apart along a row and nRowStep y
+#    steps between rows, row by row, serpentine (every other row backwards, no flyback) or raster (every row
+#    forwards). An optional z offset per site (nRows x nColumns array) focuses each site;
+#  - Site_Moves turns the grid into the relative moves of each site, a chunk of rows at a time, and Lookahead keeps a
+#    few sites ready ahead of the stages, so even a huge grid is never turned into Python objects all at once;
+#  - Run_Scan moves to each site, waits for the moves to complete, dwells, then calls on_site(site). The moves of the
+#    next nAhead sites are already queued with StepMover, each site's waiting for the site before it to be done, so
+#    StepMover starts the next site the moment Run_Scan releases the current one, and Run_Scan only ever waits on the
+#    oldest. x and y share a channel, so they step at the same time; a z move (focus) comes after them, at the new x/y
+#    position, whichever channel is selected, and costs two channel switches per site.
+# Run_Scan returns ScanStats: the throughput in sites per minute and the jitter of the time between two sites.
+#
+# NumPy is only imported when a scan is planned, so importing the motion library stays cheap.
+
+import collections
+import time
+from concurrent.futures import Future
+
+SCAN_LOOKAHEAD = 8   # sites kept ready ahead of the stages
+SCAN_CHUNK_ROWS = 16 # rows turned into moves at a time
+
+# <summary>
+# One site of a scan: its number, row and column, its offset from the start (x, y, z steps, see Grid), and the relative
+# moves that bring the stages there from the previous site, as (stage, steps).
+# </summary>
+Site = collections.namedtuple("Site",["nIndex","nRow","nColumn","offset","lomoves"])
+
+# <summary>
+# Returns the sites of a grid as NumPy arrays (rows, columns, x, y, z), in the order they are visited. x, y and z are
+# offsets in steps from where the stages are when the scan starts (the first site, in x and y). z: None, or an
+# nRows x nColumns array of z offsets.
+# </summary>
+def Grid(nColumns,nRows,nColumnStep,nRowStep,bSerpentine=True,z=None):
+    import numpy as np
+    rows = np.repeat(np.arange(nRows),nColumns)
+    columns = np.tile(np.arange(nColumns),nRows)
+    if bSerpentine:
+        odd = rows % 2 == 1
+        columns[odd] = nColumns - 1 - columns[odd]
+    x = columns*nColumnStep
+    y = rows*nRowStep
+    if z is None:
+        z_offsets = np.zeros(nRows*nColumns,dtype=np.int64)
+    else:
+        z = np.asarray(z,dtype=np.int64)
+        if z.shape != (nRows,nColumns):
+            raise ValueError("z must be an array of {} rows and {} columns".format(nRows,nColumns))
+        z_offsets = z[rows,columns]
+    return (rows,columns,x.astype(np.int64),y.astype(np.int64),z_offsets)
+
+# <summary>
+# Yields the Site of every grid point (see Grid), converting nChunkRows rows of the grid at a time.
+# </summary>
+def Site_Moves(grid,nChunkRows=SCAN_CHUNK_ROWS):
+    import numpy as np
+    (rows,columns,x,y,z) = grid
+    offsets = np.stack([x,y,z],axis=1)
+    moves = np.diff(offsets,axis=0,prepend=np.zeros((1,3),dtype=offsets.dtype))
+    nChunk = nChunkRows*(int(columns.max(initial=0))+1)
+    lostages = ('x','y','z')
+    for nStart in range(0,len(rows),nChunk):
+        chunk = slice(nStart,nStart+nChunk)
+        for (nIndex,nRow,nColumn,offset,move) in zip(range(nStart,len(rows)),rows[chunk].tolist(),
+                                                     columns[chunk].tolist(),offsets[chunk].tolist(),
+                                                     moves[chunk].tolist()):
+            yield Site(nIndex,nRow,nColumn,tuple(offset),
+                       [(stage,nSteps) for (stage,nSteps) in zip(lostages,move) if nSteps])
+
+# <summary>
+# Yields the items of iterable, keeping the next nAhead items fetched in advance.
+# </summary>
+def Lookahead(iterable,nAhead=SCAN_LOOKAHEAD):
+    iterator = iter(iterable)
+    buffer = collections.deque()
+    for item in iterator:
+        buffer.append(item)
+        if len(buffer) > nAhead:
+            yield buffer.popleft()
+    while buffer:
+        yield buffer.popleft()
+
+class ScanStats:
+    def __init__(self):
+        self.nSites = 0
+        self.fElapsed = 0.0
+        self.lotimes = [] # time each site was reached (after its dwell), seconds from the start
+
+    # <summary>
+    # Returns the throughput (sites per minute) and the time between consecutive sites (ms): mean, standard
+    # deviation (the jitter), median and 99th percentile, as a dict.
+    # </summary>
+    def Summary(self):
+        import numpy as np
+        intervals = 1000*np.diff(np.asarray(self.lotimes)) if len(self.lotimes) > 1 else np.zeros(1)
+        return dict({"sites":self.nSites, "elapsed":self.fElapsed,
+                     "sites_per_minute":60*self.nSites/self.fElapsed if self.fElapsed > 0 else 0.0,
+                     "interval_mean":float(intervals.mean()), "jitter":float(intervals.std()),
+                     "interval_p50":float(np.percentile(intervals,50)),
+                     "interval_p99":float(np.percentile(intervals,99))})
+
+    def Report(self):
+        summary = self.Summary()
+        return ("Scan: {} sites in {:.2f} s, {:.0f} sites/min, {:.1f} ms between sites "
+                "(jitter {:.1f} ms, p50 {:.1f} ms, p99 {:.1f} ms)").format(
+                summary["sites"],summary["elapsed"],summary["sites_per_minute"],summary["interval_mean"],
+                summary["jitter"],summary["interval_p50"],summary["interval_p99"])
+
+# <summary>
+# Visits the sites (e.g. Lookahead(Site_Moves(Grid(...)))) with mover, a stepmove.StepMover: moves to each site,
+# waits fDwell seconds, then calls on_site(site) if given. The moves of up to nAhead sites are queued ahead (see the
+# top of this file). Stops early, raising RuntimeError, if a move falls short (e.g. the stages were stopped), and as
+# soon as bStop() returns True; the moves queued ahead are then cancelled. Returns the ScanStats.
+# </summary>
+def Run_Scan(mover,sites,fDwell=0.0,on_site=None,bStop=None,fTimeout=60.0,nAhead=SCAN_LOOKAHEAD):
+    stats = ScanStats()
+    tStart = time.perf_counter()
+    if bStop is not None and bStop():
+        return stats
+    iterator = iter(sites)
+    queued = collections.deque() # (site, Futures of its moves, Future set once the stages may leave the site)
+    previous = None
+    released = None
+    try:
+        while True:
+            while len(queued) < max(nAhead,1):
+                site = next(iterator,None)
+                if site is None:
+                    break
+                released = Future()
+                queued.append((site,mover.Move_List(site.lomoves,after=previous,bCurrentFirst=False),released))
+                previous = released
+            if not queued:
+                break
+            (site,lofutures,released) = queued.popleft()
+            for ((stage,nSteps),future) in zip(site.lomoves,lofutures):
+                nMoved = future.result(timeout=fTimeout)
+                if nMoved != nSteps:
+                    raise RuntimeError("Site {}: {} moved {} of {} steps, scan stopped.".format(
+                                       site.nIndex,stage,nMoved,nSteps))
+            if fDwell > 0:
+                time.sleep(fDwell)
+            stats.lotimes.append(time.perf_counter() - tStart)
+            if on_site is not None:
+                on_site(site)
+            stats.nSites += 1
+            if bStop is not None and bStop():
+                break
+            released.set_result(True)
+    finally:
+        # The sites queued ahead that were not reached: their moves are cancelled by StepMover
+        for future in [released] + [released for (site,lofutures,released) in queued]:
+            if future is not None:
+                future.cancel()
+    stats.fElapsed = time.perf_counter() - tStart
+    return stats
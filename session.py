@@ -0,0 +1,301 @@
+######################## Session recorder and replay ##############################
+
+# Repeats a manual alignment done with the GUI. The recorder appends every start, stop and speed change the GUI
+# carries out (run_motor, stop_motor, manage_speeds, and emergency stops) to a binary session log: fixed-size records
+#     (time, kind, axis, direction, value)   struct "<dBBbB", 12 bytes
+# with monotonic timestamps. Each run of the GUI begins a new session with a KIND_SESSION record, whose time is the
+# wall clock time the session began. The log is only ever appended to. A record cut short by a crash can only be the
+# last one: Open cuts it off before the new session is appended, so that the records after it stay aligned.
+#
+# The replay engine turns a session back into jogs (stage, direction, speed, start, stop) and carries them out with
+# Start_Motion/Stop_Motion on the motion worker, against the controller or the simulator:
+#  - in real time, or with every idle gap (no stage moving) shortened to fIdleGap seconds;
+#  - taps of a key (consecutive jogs of a stage in the same direction at the same speed) merged into one jog as long
+#    as their durations together, unless a jog on another channel came in between (selecting it would have stopped
+#    the stage).
+# Run with: python session.py [session log] [--list] [--session N] [--realtime] [--no-merge] [--simulate]
+
+import argparse
+import collections
+import os
+import struct
+import sys
+import threading
+import time
+
+# Where the sessions are recorded. Can be changed with the environment variable AGILIS_SESSION_LOG.
+SESSION_LOG_PATH = os.environ.get ("AGILIS_SESSION_LOG",
+                                   os.path.join (os.path.expanduser ("~"), ".micropositioners", "session.bin"))
+
+RECORD = struct.Struct("<dBBbB")
+
+KIND_SESSION  = 0 # a new session begins (time: wall clock)
+KIND_START    = 1 # a stage starts jogging (value: speed)
+KIND_STOP     = 2 # a stage stops
+KIND_SPEED    = 3 # the speed of a stage is set (value: speed)
+KIND_STOP_ALL = 4 # every stage stops (emergency stop)
+
+AXES = ('x','y','z')
+DIRECTIONS = dict({"":0,"positive":1,"negative":-1})
+
+REPLAY_IDLE_GAP = 0.2 # seconds an idle gap is shortened to when replaying compressed
+
+# <summary>
+# A recorded event; t in seconds from the start of its session.
+# </summary>
+Event = collections.namedtuple("Event",["t","nKind","axis","direction","nValue"])
+
+# <summary>
+# A jog to replay: stage, direction and speed, started at tStart and stopped at tStop (seconds).
+# </summary>
+Jog = collections.namedtuple("Jog",["axis","direction","nSpeed","tStart","tStop"])
+
+############################ Recording ##############################
+
+class SessionRecorder:
+    # <summary>
+    # fnClock: the monotonic clock of the timestamps (seconds).
+    # </summary>
+    def __init__(self,fnClock=time.monotonic):
+        self.fnClock = fnClock
+        self.f = None
+        self.lock = threading.Lock()
+        self.nRecords = 0
+
+    # <summary>
+    # Opens the session log (see SESSION_LOG_PATH) for appending and begins a new session. Until then, nothing is
+    # recorded. A record cut short at the end of the log is cut off first. Failing to open it is reported, and nothing
+    # is recorded.
+    # </summary>
+    def Open(self,strPath=SESSION_LOG_PATH):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(strPath)),exist_ok=True)
+            self.f = open(strPath,"ab")
+            nSize = self.f.seek(0,os.SEEK_END)
+            if nSize % RECORD.size:
+                self.f.truncate(nSize - nSize % RECORD.size)
+        except OSError as e:
+            print("Could not open the session log {}: {}".format(strPath,e))
+            return
+        self._write(KIND_SESSION,t=time.time())
+
+    def _write(self,nKind,axis="",direction="",nValue=0,t=None,bFlush=False):
+        if self.f is None:
+            return
+        record = RECORD.pack(self.fnClock() if t is None else t,nKind,AXES.index(axis) if axis else 255,
+                             DIRECTIONS[direction or ""],nValue)
+        with self.lock:
+            self.f.write(record)
+            self.nRecords += 1
+            if bFlush:
+                self.f.flush()
+
+    def Start(self,axis,direction,nSpeed):
+        self._write(KIND_START,axis,direction,nSpeed)
+
+    # Stops are flushed: whenever nothing moves, the log on disk is complete.
+    def Stop(self,axis,direction):
+        self._write(KIND_STOP,axis,direction,bFlush=True)
+
+    def Speed(self,axis,nSpeed):
+        self._write(KIND_SPEED,axis,nValue=nSpeed)
+
+    def Stop_All(self):
+        self._write(KIND_STOP_ALL,bFlush=True)
+
+    def Close(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+# The session recorder of the GUI.
+SESSION = SessionRecorder()
+
+############################ Reading ##############################
+
+# <summary>
+# Yields the sessions of a session log, oldest first, as (wall clock time it began, list of Events). The file is read
+# in chunks.
+# </summary>
+def Read_Sessions(strPath=SESSION_LOG_PATH,nChunkRecords=4096):
+    lodirections = dict((nDirection,strDirection) for (strDirection,nDirection) in DIRECTIONS.items())
+    tBegan = None
+    loevents = []
+    tZero = None
+    with open(strPath,"rb") as f:
+        while True:
+            chunk = f.read(RECORD.size*nChunkRecords)
+            chunk = chunk[:len(chunk) - len(chunk) % RECORD.size] # a record cut short can only be the last one
+            if not chunk:
+                break
+            for (t,nKind,nAxis,nDirection,nValue) in RECORD.iter_unpack(chunk):
+                if nKind == KIND_SESSION:
+                    if tBegan is not None or loevents:
+                        yield (tBegan,loevents)
+                    (tBegan,loevents,tZero) = (t,[],None)
+                    continue
+                if tZero is None:
+                    tZero = t
+                loevents.append(Event(t - tZero,nKind,AXES[nAxis] if nAxis < len(AXES) else "",
+                                      lodirections.get(nDirection,""),nValue))
+    if tBegan is not None or loevents:
+        yield (tBegan,loevents)
+
+############################ Replay ##############################
+
+# <summary>
+# Returns the jogs of a session (a list of Events), in the order they started. Jogs still running when the session
+# ends are stopped at its last event.
+# </summary>
+def Session_Jogs(loevents):
+    lojogs = []
+    running = dict() # maps stages to (direction, speed, start)
+    for event in loevents:
+        if event.nKind == KIND_START and event.axis not in running:
+            running[event.axis] = (event.direction,event.nValue,event.t)
+        elif event.nKind == KIND_STOP and event.axis in running:
+            (direction,nSpeed,tStart) = running.pop(event.axis)
+            lojogs.append(Jog(event.axis,direction,nSpeed,tStart,event.t))
+        elif event.nKind == KIND_STOP_ALL:
+            for (axis,(direction,nSpeed,tStart)) in running.items():
+                lojogs.append(Jog(axis,direction,nSpeed,tStart,event.t))
+            running.clear()
+    tEnd = loevents[-1].t if loevents else 0.0
+    for (axis,(direction,nSpeed,tStart)) in running.items():
+        lojogs.append(Jog(axis,direction,nSpeed,tStart,tEnd))
+    return sorted(lojogs,key=lambda jog:jog.tStart)
+
+# <summary>
+# Merges the taps of a key: a jog is appended to the previous jog of its stage if they have the same direction and
+# speed, and no jog on another channel started in between. The merged jog keeps the start of the first, and lasts as
+# long as both together. stage_map: see motion.py.
+# </summary>
+def Merge_Jogs(lojogs,stage_map):
+    lomerged = []
+    last = dict() # maps stages to the index of their last jog in lomerged
+    for jog in lojogs:
+        i = last.get(jog.axis)
+        if i is not None:
+            previous = lomerged[i]
+            nChannel = stage_map[jog.axis][0]
+            if (previous.direction == jog.direction and previous.nSpeed == jog.nSpeed and
+                not any(stage_map[other.axis][0] != nChannel for other in lomerged[i+1:])):
+                lomerged[i] = previous._replace(tStop=previous.tStop + jog.tStop - jog.tStart)
+                continue
+        last[jog.axis] = len(lomerged)
+        lomerged.append(jog)
+    return lomerged
+
+# <summary>
+# Returns the schedule of the jogs: a list of (time, bStart, jog), in time order. If fIdleGap is given, every gap in
+# which no stage moves is shortened to at most fIdleGap seconds, and the schedule begins with the first jog.
+# </summary>
+def Schedule(lojogs,fIdleGap=None):
+    loactions = sorted([(jog.tStart,True,jog) for jog in lojogs] + [(jog.tStop,False,jog) for jog in lojogs],
+                       key=lambda action:(action[0],action[1])) # stops first
+    if fIdleGap is None:
+        return loactions
+    loschedule = []
+    nMoving = 0
+    fShift = loactions[0][0] if loactions else 0.0
+    tPrevious = fShift
+    for (t,bStart,jog) in loactions:
+        if nMoving == 0 and t - tPrevious > fIdleGap:
+            fShift += t - tPrevious - fIdleGap
+        nMoving += 1 if bStart else -1
+        loschedule.append((t - fShift,bStart,jog))
+        tPrevious = t
+    return loschedule
+
+# <summary>
+# Waits for a motion command. Returns True if it was carried out and succeeded.
+# </summary>
+def Succeeded(future):
+    try:
+        return bool(future.result())
+    except BaseException:
+        return False
+
+# <summary>
+# Carries out a schedule (see Schedule) with Start_Motion/Stop_Motion on the motion worker, which owns an initialized
+# controller. Stops everything if a command fails or the replay is interrupted. Returns (bResult, seconds it took).
+# </summary>
+def Replay(loschedule,worker):
+    import motion
+    from motion_worker import LANE_STOP
+
+    lofutures = []
+    tStart = time.perf_counter()
+    bResult = False
+    try:
+        for (t,bStart,jog) in loschedule:
+            fWait = tStart + t - time.perf_counter()
+            if fWait > 0:
+                time.sleep(fWait)
+            if bStart:
+                lofutures.append(worker.Submit(motion.Start_Motion,jog.axis,jog.direction,jog.nSpeed,axes=[jog.axis]))
+            else:
+                lofutures.append(worker.Submit(motion.Stop_Motion,jog.axis,lane=LANE_STOP,axes=[jog.axis]))
+            if any(future.done() and not Succeeded(future) for future in lofutures[-2:]):
+                break
+        else:
+            bResult = all([Succeeded(future) for future in lofutures])
+    finally:
+        if not bResult:
+            worker.Submit(motion.Stop_All_Motion,lane=LANE_STOP,axes=motion.stage_map).result()
+    return (bResult,time.perf_counter() - tStart)
+
+def main(argv=None):
+    import motion
+    from motion_worker import MotionWorker, LANE_STOP
+    from batch import Open_Simulator, Close_Device, INITIALIZE_TIMEOUT
+
+    parser = argparse.ArgumentParser(description="Replays a GUI session from the session log.")
+    parser.add_argument("log",nargs="?",default=SESSION_LOG_PATH,help="the session log")
+    parser.add_argument("--list",action="store_true",help="only list the sessions in the log")
+    parser.add_argument("--session",type=int,default=-1,help="the session to replay (default: the last one)")
+    parser.add_argument("--realtime",action="store_true",help="keep the idle gaps")
+    parser.add_argument("--idle-gap",type=float,default=REPLAY_IDLE_GAP,help="seconds an idle gap is shortened to")
+    parser.add_argument("--no-merge",action="store_true",help="replay every tap of a key")
+    parser.add_argument("--simulate",action="store_true",help="use the simulated controller")
+    args = parser.parse_args(argv)
+
+    losessions = list(Read_Sessions(args.log))
+    if args.list or not losessions:
+        for (i,(tBegan,loevents)) in enumerate(losessions):
+            lojogs = Session_Jogs(loevents)
+            print("{:3}: {}  {} jogs, {:.1f} s".format(i,time.strftime("%Y-%m-%d %H:%M:%S",time.localtime(tBegan or 0)),
+                                                        len(lojogs),loevents[-1].t if loevents else 0.0))
+        if not losessions:
+            print("No sessions in {}".format(args.log))
+        return
+
+    (tBegan,loevents) = losessions[args.session]
+    lojogs = Session_Jogs(loevents)
+    if not args.no_merge:
+        lojogs = Merge_Jogs(lojogs,motion.stage_map)
+    loschedule = Schedule(lojogs,None if args.realtime else args.idle_gap)
+    fSession = loevents[-1].t if loevents else 0.0
+    fReplay = loschedule[-1][0] if loschedule else 0.0
+    print("Session of {:.1f} s: {} jogs, {} to replay in {:.1f} s".format(fSession,len(Session_Jogs(loevents)),
+                                                                         len(lojogs),fReplay))
+
+    worker = MotionWorker(on_hung=lambda:motion.oCmdLib.Invalidate())
+    if not worker.Submit(Open_Simulator if args.simulate else motion.Initializer,lane=LANE_STOP,
+                         timeout=INITIALIZE_TIMEOUT).result():
+        worker.Shutdown()
+        sys.exit("Could not open the controller.")
+    try:
+        (bResult,fElapsed) = Replay(loschedule,worker)
+    except KeyboardInterrupt:
+        bResult = False
+        fElapsed = 0.0
+    worker.Submit(Close_Device,lane=LANE_STOP,timeout=INITIALIZE_TIMEOUT)
+    worker.Shutdown()
+    print("Replayed in {:.1f} s{}".format(fElapsed,"" if bResult else ", FAILED"))
+    if not bResult:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+######################## Relative step moves ##############################
+
+# Jogging (Start_Motion/Stop_Motion) leaves the distance travelled to the operator's reaction time. StepMover moves a
+# stage by an exact number of steps with the controller's relative move command (PR), and returns a Future per move
+# that completes with the number of steps the controller counted (TP) once the axis is ready again. If the move was
+# stopped on the way (e.g. by a stop), that number falls short of the steps asked for, and the stage's remaining moves
+# in the list are cancelled.
+#
+# The controller refuses a relative move while the axis is still moving, and only drives one channel at a time, so:
+#  - a list of moves is grouped by channel (the channel currently selected first, unless the list asks for its own
+#    order, then in order of first appearance), and the moves of each stage keep their order; every channel is
+#    finished before the next one is selected;
+#  - within a channel, both axes step at the same time, and every turn on the motion worker does as much as it can in
+#    one go: select the channel, poll the moving axes, and start the next move of every axis that is ready. An axis
+#    that finishes its move is therefore given its next one in the same turn, without another round trip through the
+#    worker;
+#  - turns are ordinary motion commands on the motion worker (see motion_worker.py), so stops still overtake them,
+#    and a stop of a stage cancels the turn queued for it, and with it the moves that had not started yet.
+
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import CancelledError, Future
+
+import motion
+
+STEP_POLL_INTERVAL = 0.01   # seconds between two polls of the moving axes
+STEP_COMMAND_TIMEOUT = 1.0  # seconds a turn may wait on the motion worker before it is stale
+
+class StepMove:
+    __slots__ = ("stage","nChannel","nAxis","nSteps","future","nStart")
+
+    def __init__(self,stage,nChannel,nAxis,nSteps,future):
+        self.stage = stage
+        self.nChannel = nChannel
+        self.nAxis = nAxis
+        self.nSteps = nSteps
+        self.future = future
+        self.nStart = 0 # step counter when the move was started
+
+# <summary>
+# Groups the moves by channel: the channel nCurrent first (if there are moves for it), then in order of first
+# appearance. Returns a list of (channel, moves), the moves of each channel in their original order.
+# </summary>
+def Group_By_Channel(lomoves,nCurrent=None):
+    groups = collections.OrderedDict()
+    for move in lomoves:
+        groups.setdefault(move.nChannel,[]).append(move)
+    if nCurrent in groups:
+        groups.move_to_end(nCurrent,last=False)
+    return list(groups.items())
+
+# <summary>
+# Runs on the motion worker: one turn of a channel. Selects nChannel, polls the status of the axes of poll (axis ->
+# step counter the move in progress should end at), and starts the move of every axis of starts (axis -> StepMove)
+# that is (now) ready, unless its last move ended short of its target (it was stopped, and its next moves with it) or
+# the move was cancelled.
+# Returns (bStatus, done, started): done maps the polled axes that are ready to their step counter, started maps the
+# axes that were started to their step counter before the move. bStatus is False if a command failed.
+# </summary>
+def Step_Turn(oCmdLib,nChannel,poll,starts):
+    done = dict()
+    started = dict()
+    if not oCmdLib.SetChannel(nChannel):
+        return (False,done,started)
+    for nAxis in poll:
+        (bStatus,nState) = oCmdLib.GetAxisStatus(nAxis)
+        if bStatus and nState == 0:
+            (bStatus,done[nAxis]) = oCmdLib.GetStepCount(nAxis)
+        if not bStatus:
+            done.pop(nAxis,None)
+            return (False,done,started)
+    for (nAxis,move) in starts.items():
+        if nAxis in poll and done.get(nAxis) != poll[nAxis]:
+            continue # still moving, or stopped on the way
+        if nAxis in done:
+            nCount = done[nAxis]
+        else:
+            (bStatus,nCount) = oCmdLib.GetStepCount(nAxis)
+            if not bStatus:
+                return (False,done,started)
+        if not move.future.set_running_or_notify_cancel():
+            continue
+        if not oCmdLib.RelativeMove(nAxis,move.nSteps):
+            return (False,done,started)
+        started[nAxis] = nCount
+    return (True,done,started)
+
+class StepMover:
+    # <summary>
+    # worker: the MotionWorker that owns the controller. fnCmdLib returns the controller library object to use
+    # (motion.oCmdLib by default), stage_map maps stages to (channel, axis) (motion.stage_map by default).
+    # </summary>
+    def __init__(self,worker,fnCmdLib=None,stage_map=None,fPollInterval=STEP_POLL_INTERVAL):
+        self.worker = worker
+        self.fnCmdLib = (lambda:motion.oCmdLib) if fnCmdLib is None else fnCmdLib
+        self.stage_map = motion.stage_map if stage_map is None else stage_map
+        self.fPollInterval = fPollInterval
+        self.batches = queue.SimpleQueue()
+        # statistics
+        self.nMoves = 0
+        self.nTurns = 0
+        self.nChannelGroups = 0
+        self.thread = threading.Thread(target=self._run,name="step-moves",daemon=True)
+        self.thread.start()
+
+    # <summary>
+    # Moves stage by nSteps (negative = backwards). Returns the Future of the move, see the top of this file.
+    # If callback is given, it is called with the Future by the worker's Run_Callbacks (i.e. on the Tk thread).
+    # </summary>
+    def Move(self,stage,nSteps,callback=None):
+        return self.Move_List([(stage,nSteps)],callback)[0]
+
+    # <summary>
+    # Queues a list of (stage, steps) moves, carried out with as few channel switches as possible (see the top of
+    # this file). Returns the list of their Futures, in the same order. Lists are carried out one after the other.
+    # after: a Future the list waits for before it starts, e.g. so that it can be queued ahead while the stages are
+    # still needed where they are; if it is cancelled (or fails), so are the moves of the list. bCurrentFirst: False
+    # to take the channels in order of first appearance, whichever channel is selected when the list starts.
+    # </summary>
+    def Move_List(self,lomoves,callback=None,after=None,bCurrentFirst=True):
+        lostepmoves = []
+        for (stage,nSteps) in lomoves:
+            (nChannel,nAxis) = self.stage_map[stage]
+            future = Future()
+            if callback is not None:
+                future.add_done_callback(lambda future:self.worker.callbacks.put((callback,future)))
+            lostepmoves.append(StepMove(stage,nChannel,nAxis,int(nSteps),future))
+        self.batches.put((lostepmoves,after,bCurrentFirst))
+        return [move.future for move in lostepmoves]
+
+    def _run(self):
+        while True:
+            item = self.batches.get()
+            if item is None:
+                return
+            (lomoves,after,bCurrentFirst) = item
+            self.nMoves += len(lomoves)
+            try:
+                if after is not None:
+                    after.result()
+                nCurrent = getattr(self.fnCmdLib(),"nChannel",None) if bCurrentFirst else None
+                for (nChannel,lochannelmoves) in Group_By_Channel(lomoves,nCurrent):
+                    self.nChannelGroups += 1
+                    self._run_channel(nChannel,lochannelmoves)
+            except BaseException as e:
+                for move in lomoves:
+                    # A move that was started cannot be cancelled any more: it fails with the exception instead
+                    if not move.future.done() and not (isinstance(e,CancelledError) and move.future.cancel()):
+                        move.future.set_exception(e)
+
+    def _run_channel(self,nChannel,lomoves):
+        pending = dict() # maps axes to the moves not started yet
+        for move in lomoves:
+            pending.setdefault(move.nAxis,collections.deque()).append(move)
+        moving = dict()  # maps axes to the move in progress
+        lostages = sorted(set(move.stage for move in lomoves),key=str)
+
+        while pending or moving:
+            for nAxis in list(pending):
+                while pending[nAxis] and pending[nAxis][0].future.cancelled():
+                    pending[nAxis].popleft()
+                if not pending[nAxis]:
+                    del pending[nAxis]
+            if not pending and not moving:
+                return
+            poll = dict((nAxis,move.nStart + move.nSteps) for (nAxis,move) in moving.items())
+            starts = dict((nAxis,lopending[0]) for (nAxis,lopending) in pending.items())
+            oCmdLib = self.fnCmdLib()
+            (bStatus,done,started) = self.worker.Submit(Step_Turn,oCmdLib,nChannel,poll,starts,
+                                                        axes=lostages,timeout=STEP_COMMAND_TIMEOUT).result()
+            self.nTurns += 1
+            for (nAxis,nCount) in done.items():
+                move = moving.pop(nAxis)
+                if not move.future.done():
+                    move.future.set_result(nCount - move.nStart)
+                if nCount - move.nStart != move.nSteps and nAxis in pending:
+                    # The move was cut short: whatever stopped the stage also stops its remaining moves
+                    for move in pending.pop(nAxis):
+                        move.future.cancel()
+            for (nAxis,nCount) in started.items():
+                move = starts[nAxis]
+                move.nStart = nCount
+                moving[nAxis] = move
+                if pending.get(nAxis) and pending[nAxis][0] is move:
+                    pending[nAxis].popleft()
+                    if not pending[nAxis]:
+                        del pending[nAxis]
+            if not bStatus:
+                raise RuntimeError("A relative move on channel {} failed.".format(nChannel))
+            if not done and not started:
+                time.sleep(self.fPollInterval)
+
+    # <summary>
+    # Stops the sequencer thread once the queued lists have been carried out.
+    # </summary>
+    def Shutdown(self):
+        self.batches.put(None)
+        self.thread.join()